@@ -0,0 +1,337 @@
+"""
+Local, incremental replacement of the affiliate query (see `queries.py`) for recent days.
+
+The engine keeps the first trade (and hence the first appData and referrer) of every owner,
+along with the daily trade count and volume of each owner and the referred volume of
+each referrer. Every run only ingests the trades newer than the watermark of the
+previous run and updates the affected (owner, day) and (referrer, day) rows in place.
+Trades are fetched with some overlap (to catch trades indexed late by Dune)
+and deduplicated by their id.
+"""
+from __future__ import annotations
+
+import json
+import os
+import time
+from collections.abc import Iterator, Mapping
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Optional
+
+import numpy as np
+import numpy.typing as npt
+from duneapi.util import open_query
+
+from dune_api_scripts.local_env import QUERY_DIR
+from dune_api_scripts.query_cache import cache_ttl, cached_fetch
+from dune_api_scripts.utils import (
+    open_for_reading,
+    open_for_writing,
+    referrer_index,
+    temporary_path,
+)
+
+if TYPE_CHECKING:
+    from duneapi.api import DuneAPI
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+# A row of affiliate-trades.sql (or affiliate-first-trades.sql)
+Trade = Mapping[str, Any]
+
+
+def trade_id(trade: Trade) -> str:
+    """Identifies a trade by its transaction and position therein"""
+    return f"{trade['tx_hash']}/{trade['evt_index']}"
+
+
+def timestamp(block_time: str) -> int:
+    """Parses block times as returned by Dune (e.g. `2021-10-18T12:34:56+00:00`)"""
+    return int(datetime.fromisoformat(block_time).timestamp())
+
+
+def day_string(day: int) -> str:
+    """Formats days (since 1970-01-01) like the `day` column of the affiliate query"""
+    return datetime.fromtimestamp(day * SECONDS_PER_DAY, tz=timezone.utc).isoformat()
+
+
+def referrer_address(referrer: Optional[str]) -> Optional[str]:
+    """Converts referrers of the referrer index (dune addresses) to hex addresses"""
+    return referrer.replace("\\x", "0x") if referrer else None
+
+
+def daily_totals(
+    owners: npt.NDArray[np.int64],
+    days: npt.NDArray[np.int64],
+    volumes: npt.NDArray[np.float64],
+) -> Iterator[tuple[int, int, int, float]]:
+    """Number of trades and volume per (owner, day) of trades given as arrays"""
+    first_day, num_days = int(days.min()), int(days.max() - days.min() + 1)
+    groups, group_of_trade = np.unique(
+        owners * num_days + days - first_day, return_inverse=True
+    )
+    counts = np.bincount(group_of_trade)
+    totals = np.bincount(group_of_trade, weights=volumes)
+    for group, count, total in zip(groups, counts, totals):
+        owner, day = divmod(int(group), num_days)
+        yield owner, first_day + day, int(count), float(total)
+
+
+@dataclass
+class FirstTrade:
+    """The first trade of an owner, determining their referrer"""
+
+    time: int
+    app_data: Optional[str]
+    referrer: Optional[str]
+
+
+@dataclass
+class DailyStats:
+    """Trades of an owner on a day"""
+
+    trades: int = 0
+    volume: float = 0.0
+
+
+@dataclass
+class Referred:
+    """Trades of all owners referred by a referrer on a day"""
+
+    volume: float = 0.0
+    referrals: set[str] = field(default_factory=set)
+
+
+@dataclass
+class AffiliateState:
+    """Everything needed to produce affiliate rows of recent days"""
+
+    watermark: Optional[int] = None
+    # Ids (and times) of the trades ingested within the overlap before the watermark.
+    recent_trades: dict[str, int] = field(default_factory=dict)
+    owners: dict[str, FirstTrade] = field(default_factory=dict)
+    daily: dict[tuple[str, int], DailyStats] = field(default_factory=dict)
+    referred: dict[tuple[str, int], Referred] = field(default_factory=dict)
+    # Days whose rows changed since the state was loaded (not persisted).
+    changed_days: set[int] = field(default_factory=set)
+
+    @classmethod
+    def load(cls, path: str | Path) -> AffiliateState:
+        """Loads the state persisted at `path` (or returns an empty one)"""
+        try:
+            with open_for_reading(path) as file:
+                content = json.load(file)
+        except FileNotFoundError:
+            return cls()
+        state = cls(
+            watermark=content["watermark"],
+            recent_trades=content["recent_trades"],
+            owners={
+                owner: FirstTrade(*first_trade)
+                for owner, first_trade in content["owners"].items()
+            },
+        )
+        for owner, day, trades, volume in content["daily"]:
+            state.add_stats(owner, day, DailyStats(trades, volume))
+        state.changed_days.clear()
+        return state
+
+    def save(self, data_folder: str, path: str | Path) -> None:
+        """Persists the state (compressed) to `path`, replacing it atomically"""
+        tmp_file = temporary_path(data_folder, Path(path).name)
+        with open_for_writing(tmp_file, compress=True) as file:
+            json.dump(
+                {
+                    "watermark": self.watermark,
+                    "recent_trades": self.recent_trades,
+                    "owners": {
+                        owner: [first.time, first.app_data, first.referrer]
+                        for owner, first in self.owners.items()
+                    },
+                    "daily": [
+                        [owner, day, stats.trades, stats.volume]
+                        for (owner, day), stats in self.daily.items()
+                    ],
+                },
+                file,
+            )
+        os.replace(tmp_file, path)
+
+    def add_stats(self, owner: str, day: int, stats: DailyStats) -> None:
+        """Adds trades of `owner` on `day` to their stats and those of their referrer"""
+        daily = self.daily.setdefault((owner, day), DailyStats())
+        daily.trades += stats.trades
+        daily.volume += stats.volume
+        self.changed_days.add(day)
+        self.add_referred(owner, day, stats)
+
+    def add_referred(self, owner: str, day: int, stats: DailyStats) -> None:
+        """Adds trades of `owner` on `day` to the referred volume of their referrer"""
+        first_trade = self.owners.get(owner)
+        if first_trade is None or first_trade.referrer is None:
+            return
+        referred = self.referred.setdefault((first_trade.referrer, day), Referred())
+        referred.volume += stats.volume
+        referred.referrals.add(owner)
+        self.changed_days.add(day)
+
+    def record_first_trades(
+        self, trades: list[Trade], referrers: Mapping[str, Optional[str]]
+    ) -> None:
+        """Records the earliest of `trades` of every owner not seen before"""
+        if not trades:
+            return
+        owner_names, owners = np.unique(
+            [trade["owner"] for trade in trades], return_inverse=True
+        )
+        times = np.array([timestamp(trade["block_time"]) for trade in trades])
+        positions = np.array([int(trade["evt_index"]) for trade in trades])
+        order = np.lexsort((positions, times, owners))
+        _, first_of_owner = np.unique(owners[order], return_index=True)
+        for index in order[first_of_owner]:
+            owner = str(owner_names[owners[index]])
+            if owner in self.owners and self.owners[owner].time <= times[index]:
+                continue
+            app_data = trades[index]["app_data"]
+            self.owners[owner] = FirstTrade(
+                time=int(times[index]),
+                app_data=app_data,
+                referrer=referrer_address(referrers.get(app_data or "")),
+            )
+
+    def ingest(
+        self,
+        trades: list[Trade],
+        referrers: Mapping[str, Optional[str]],
+        overlap: int,
+    ) -> int:
+        """
+        Adds all `trades` not ingested before to the state. Returns their number.
+        Trades must be newer than the watermark minus `overlap`.
+        """
+        trades = [
+            trade for trade in trades if trade_id(trade) not in self.recent_trades
+        ]
+        if not trades:
+            return 0
+        self.record_first_trades(trades, referrers)
+        owner_names, owners = np.unique(
+            [trade["owner"] for trade in trades], return_inverse=True
+        )
+        times = np.array([timestamp(trade["block_time"]) for trade in trades])
+        volumes = np.array([float(trade["usd_value"] or 0) for trade in trades])
+        for owner, day, count, volume in daily_totals(
+            owners, times // SECONDS_PER_DAY, volumes
+        ):
+            self.add_stats(str(owner_names[owner]), day, DailyStats(count, volume))
+
+        self.recent_trades.update(zip(map(trade_id, trades), map(int, times)))
+        self.watermark = max(self.watermark or 0, int(times.max()))
+        self.recent_trades = {
+            trade: trade_time
+            for trade, trade_time in self.recent_trades.items()
+            if trade_time >= self.watermark - overlap
+        }
+        return len(trades)
+
+    def resolve_referrers(self, referrers: Mapping[str, Optional[str]]) -> None:
+        """
+        Assigns referrers to owners whose first appData was not known to refer anyone
+        when they were ingested (e.g. since the App Data file wasn't updated yet).
+        """
+        resolved = set()
+        for owner, first_trade in self.owners.items():
+            if first_trade.referrer is None:
+                first_trade.referrer = referrer_address(
+                    referrers.get(first_trade.app_data or "")
+                )
+                if first_trade.referrer is not None:
+                    resolved.add(owner)
+        for (owner, day), stats in self.daily.items():
+            if owner in resolved:
+                self.add_referred(owner, day, stats)
+
+    def prune(self, first_day: int) -> None:
+        """Drops all stats of days before `first_day`"""
+        self.daily = {
+            key: stats for key, stats in self.daily.items() if key[1] >= first_day
+        }
+        self.referred = {
+            key: referred
+            for key, referred in self.referred.items()
+            if key[1] >= first_day
+        }
+
+    def rows(self, day: int) -> list[dict[str, Any]]:
+        """Rows of `day` in the shape of the affiliate query's output"""
+        owners = {owner for owner, row_day in self.daily if row_day == day}
+        owners |= {referrer for referrer, row_day in self.referred if row_day == day}
+        rows = []
+        for owner in sorted(owners):
+            stats = self.daily.get((owner, day))
+            referred = self.referred.get((owner, day))
+            rows.append(
+                {
+                    "owner": owner,
+                    "day": day_string(day),
+                    "total_referred_volume": referred.volume if referred else None,
+                    "referrals": sorted(referred.referrals) if referred else [],
+                    "number_of_trades": stats.trades if stats else None,
+                    "cowswap_usd_volume": stats.volume if stats else None,
+                    "usd_volume_all_exchanges": 0,
+                }
+            )
+        return rows
+
+
+def fetch_trades(
+    dune: DuneAPI, query_file: str, parameter: str, value: int
+) -> list[Trade]:
+    """
+    Fetches the trades of `query_file`, passing a timestamp as `parameter`.
+    They are queried at `QUERY_ID_AFFILIATE_TRADES`, which must not be shared with
+    any other job (as each execution replaces the SQL of the query).
+    """
+    # pylint: disable=import-outside-toplevel
+    from duneapi.types import DuneQuery
+
+    query = DuneQuery(
+        query_id=int(os.environ["QUERY_ID_AFFILIATE_TRADES"]),
+        name=f"Affiliate trades ({parameter} {value})",
+        raw_sql=open_query(f"{QUERY_DIR}/{query_file}").replace(
+            f"{{{{{parameter}}}}}",
+            datetime.fromtimestamp(value, tz=timezone.utc).strftime(
+                "%Y-%m-%d %H:%M:%S"
+            ),
+        ),
+    )
+    return list(cached_fetch(dune, query, ttl=cache_ttl("affiliate_trades", 60)))
+
+
+def update_affiliate_state(
+    dune: DuneAPI, data_folder: str, overlap: int, keep_days: int
+) -> AffiliateState:
+    """
+    Loads the persisted state, ingests all trades since its watermark and persists it again.
+    The initial run fetches the first trade of every owner and the trades of the last
+    `keep_days` days.
+    """
+    state_file = os.path.join(data_folder, "affiliate_state.json.gz")
+    state = AffiliateState.load(state_file)
+    today = int(time.time()) // SECONDS_PER_DAY
+    referrers = referrer_index()
+    if state.watermark is None:
+        since = (today - keep_days) * SECONDS_PER_DAY
+        state.record_first_trades(
+            fetch_trades(dune, "affiliate-first-trades.sql", "Until", since), referrers
+        )
+        state.watermark = since
+    trades = fetch_trades(
+        dune, "affiliate-trades.sql", "Since", state.watermark - overlap
+    )
+    print(f"Ingested {state.ingest(trades, referrers, overlap)} new trades")
+    state.resolve_referrers(referrers)
+    state.prune(today - keep_days)
+    state.save(data_folder, state_file)
+    return state
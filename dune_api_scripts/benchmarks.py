@@ -0,0 +1,332 @@
+"""
+Benchmarks of the data paths of the scripts on synthetic data sets:
+    python -m dune_api_scripts.benchmarks --sizes 10000 100000 1000000
+Throughput (rows per second) and peak memory are recorded per path and data set size.
+With `--update-baseline` the results are stored as the new baseline, otherwise the run
+fails if any path is slower, or uses more memory, than its baseline by more than
+the factor `--threshold`.
+"""
+from __future__ import annotations
+
+import argparse
+import contextlib
+import csv
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections.abc import Callable, Iterator
+from dataclasses import asdict, dataclass
+from datetime import date, datetime, timedelta, timezone
+from typing import Any
+
+from dune_api_scripts.local_env import DUNE_DATA_DIR
+from dune_api_scripts.queries import build_query_for_affiliate_data
+from dune_api_scripts.update.retention_store import RetentionStore
+from dune_api_scripts.update.user_retention import Retention
+from dune_api_scripts.utils import (
+    _parse_app_data_file,
+    _referrer_index,
+    app_data_entries,
+    build_string_for_affiliate_referrals_pairs,
+    open_for_writing,
+    store_as_json_file,
+)
+
+DEFAULT_SIZES = [10_000, 100_000, 1_000_000]
+DEFAULT_BASELINE = os.path.join(DUNE_DATA_DIR, "benchmark_baseline.json")
+
+# Prepares a synthetic data set of the given size in the given folder,
+# returning the operation to be measured.
+Setup = Callable[[str, int], Callable[[], Any]]
+
+
+@dataclass
+class Measurement:
+    """Performance of a path on a data set of a given size"""
+
+    rows_per_second: float
+    peak_bytes: int
+
+
+def random_address(rng: random.Random) -> str:
+    """A random hex address"""
+    return f"0x{rng.getrandbits(160):040x}"
+
+
+def synthetic_app_data(folder: str, size: int) -> None:
+    """
+    Writes an App Data file with `size` hashes (half of which have a referrer)
+    and points the environment to it, dropping all indices of previous data sets.
+    """
+    rng = random.Random(size)
+    content_map = {
+        f"0x{rng.getrandbits(256):064x}": {
+            "version": "0.1.0",
+            "appCode": "CowSwap",
+            "metadata": (
+                {"referrer": {"address": random_address(rng), "version": "0.1.0"}}
+                if i % 2
+                else {}
+            ),
+        }
+        for i in range(size)
+    }
+    app_data_file = os.path.join(folder, "app_data_referral_relationship.json")
+    with open(app_data_file, "w", encoding="utf-8") as file:
+        json.dump(content_map, file)
+    os.environ["APP_DATA_REFERRAL_RELATION_FILE"] = app_data_file
+    os.environ["DUNE_DATA_FOLDER"] = folder
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(os.path.join(folder, "app_data_referral_index.json"))
+    _parse_app_data_file.cache_clear()
+    _referrer_index.cache_clear()
+
+
+def synthetic_user_data(size: int) -> list[dict[str, Any]]:
+    """`size` rows shaped like the results of the affiliate query"""
+    rng = random.Random(size)
+    owners = [random_address(rng) for _ in range(max(size // 10, 1))]
+    return [
+        {
+            "owner": rng.choice(owners),
+            "day": f"{date(2021, 3, 1) + timedelta(days=i % 365)}T00:00:00+00:00",
+            "total_referred_volume": rng.random() * 1000 if i % 5 == 0 else None,
+            "referrals": rng.sample(owners, 2) if i % 5 == 0 else [],
+            "number_of_trades": rng.randint(1, 20),
+            "cowswap_usd_volume": rng.random() * 10_000,
+            "usd_volume_all_exchanges": 0,
+        }
+        for i in range(size)
+    ]
+
+
+def synthetic_retention(size: int) -> list[dict[str, str]]:
+    """`size` retention rows (as parsed from csv) of consecutive days"""
+    first_day = date(2021, 5, 29)
+    return [
+        {
+            "day": str(first_day + timedelta(days=i)),
+            "retained": str(i % 97),
+            "hybrid": str(i % 13),
+            "lost": str(i % 31),
+            "gone": str(i % 7),
+        }
+        for i in range(size)
+    ]
+
+
+def setup_referral_pairs(folder: str, size: int) -> Callable[[], Any]:
+    """Builds the referral pairs of the affiliate query from a fresh App Data file"""
+    synthetic_app_data(folder, size)
+    return build_string_for_affiliate_referrals_pairs
+
+
+def setup_app_data_entries(folder: str, size: int) -> Callable[[], Any]:
+    """Builds the values of the raw app data view from a fresh App Data file"""
+    synthetic_app_data(folder, size)
+    return app_data_entries
+
+
+def setup_affiliate_query(folder: str, size: int) -> Callable[[], Any]:
+    """Builds the entire affiliate query from a fresh App Data file"""
+    synthetic_app_data(folder, size)
+    return lambda: build_query_for_affiliate_data("'2021-03-01'", "'2022-03-01'")
+
+
+def setup_store_user_data(folder: str, size: int) -> Callable[[], Any]:
+    """Stores user data into an empty data folder"""
+    os.environ["DUNE_DATA_FOLDER"] = folder
+    records = synthetic_user_data(size)
+    return lambda: store_as_json_file(records, int(time.time()))
+
+
+def setup_retention_from_dict(_folder: str, size: int) -> Callable[[], Any]:
+    """Parses retention records"""
+    rows = synthetic_retention(size)
+    return lambda: [Retention.from_dict(row) for row in rows]
+
+
+def setup_retention_csv(folder: str, size: int) -> Callable[[], Any]:
+    """Migrates a retention csv file into a new retention store"""
+    rows = synthetic_retention(size)
+    legacy_csv = os.path.join(folder, "retention.csv")
+    with open(legacy_csv, "w", encoding="utf-8") as file:
+        writer = csv.DictWriter(file, fieldnames=list(rows[0]), lineterminator="\n")
+        writer.writeheader()
+        writer.writerows(rows)
+    store_path = os.path.join(folder, "retention.sqlite")
+    return lambda: RetentionStore.open(store_path, legacy_csv).close()
+
+
+def setup_retention_values(folder: str, size: int) -> Callable[[], Any]:
+    """Renders the retention view values after a daily run added one day to the store"""
+    rows = [Retention.from_dict(row) for row in synthetic_retention(size + 1)]
+    store = RetentionStore(os.path.join(folder, "retention.sqlite"))
+    store.append([(r.day, r.retained, r.hybrid, r.lost, r.gone) for r in rows[:-1]])
+    store.values(lambda counts: str(Retention(*counts)))
+    last = rows[-1]
+    store.append([(last.day, last.retained, last.hybrid, last.lost, last.gone)])
+    return lambda: store.values(lambda counts: str(Retention(*counts)))
+
+
+def setup_store_todays_trading_data(folder: str, size: int) -> Callable[[], Any]:
+    """Runs the job storing today's trading data against a replaying Dune stand-in"""
+    # pylint: disable=import-outside-toplevel
+    from dune_api_scripts.fake_dune import FakeDuneAPI, FakeDuneConfig, recording_path
+    from dune_api_scripts.store_query_result_for_todays_trading_data import (
+        store_todays_trading_data,
+        todays_trading_data_query,
+    )
+
+    synthetic_app_data(folder, 100)
+    os.environ["QUERY_ID_TODAYS_TRADING_DATA"] = "1"
+    # Recorded for the days queried now (the benchmark is not run around midnight).
+    query = todays_trading_data_query(datetime.now(timezone.utc))
+    with open_for_writing(recording_path(folder, query), compress=True) as file:
+        json.dump(synthetic_user_data(size), file)
+    dune = FakeDuneAPI(FakeDuneConfig(recordings=folder))
+    return lambda: store_todays_trading_data(dune)
+
+
+BENCHMARKS: dict[str, Setup] = {
+    "build_string_for_affiliate_referrals_pairs": setup_referral_pairs,
+    "app_data_entries": setup_app_data_entries,
+    "build_query_for_affiliate_data": setup_affiliate_query,
+    "store_as_json_file": setup_store_user_data,
+    "Retention.from_dict": setup_retention_from_dict,
+    "RetentionStore.open": setup_retention_csv,
+    "RetentionStore.values": setup_retention_values,
+    "store_todays_trading_data": setup_store_todays_trading_data,
+}
+
+
+@contextlib.contextmanager
+def isolated_environment() -> Iterator[str]:
+    """A temporary data folder, restoring the environment afterwards"""
+    environment = dict(os.environ)
+    try:
+        with tempfile.TemporaryDirectory() as folder:
+            yield folder
+    finally:
+        os.environ.clear()
+        os.environ.update(environment)
+
+
+def measure(setup: Setup, size: int) -> Measurement:
+    """
+    Measures the operation prepared by `setup` on a data set of `size` rows.
+    Time and memory are measured in separate runs, as tracing memory slows down execution.
+    """
+    with isolated_environment() as folder, contextlib.redirect_stdout(io.StringIO()):
+        operation = setup(folder, size)
+        start = time.perf_counter()
+        operation()
+        duration = time.perf_counter() - start
+    with isolated_environment() as folder, contextlib.redirect_stdout(io.StringIO()):
+        operation = setup(folder, size)
+        tracemalloc.start()
+        try:
+            operation()
+            _, peak_bytes = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+    return Measurement(rows_per_second=size / duration, peak_bytes=peak_bytes)
+
+
+def run_benchmarks(
+    sizes: list[int], names: list[str]
+) -> dict[str, dict[str, Measurement]]:
+    """Measures all benchmarks `names` on data sets of all `sizes`"""
+    results: dict[str, dict[str, Measurement]] = {}
+    for name in names:
+        for size in sizes:
+            measurement = measure(BENCHMARKS[name], size)
+            results.setdefault(name, {})[str(size)] = measurement
+            print(
+                f"{name} ({size} rows): {measurement.rows_per_second:.0f} rows/s, "
+                f"peak memory {measurement.peak_bytes / 2**20:.1f} MiB"
+            )
+    return results
+
+
+def regressions(
+    results: dict[str, dict[str, Measurement]],
+    baseline: dict[str, dict[str, dict[str, float]]],
+    threshold: float,
+) -> list[str]:
+    """Descriptions of all results worse than their baseline by more than `threshold`"""
+    found = []
+    for name, by_size in results.items():
+        for size, measurement in by_size.items():
+            if size not in baseline.get(name, {}):
+                continue
+            expected = baseline[name][size]
+            if measurement.rows_per_second * threshold < expected["rows_per_second"]:
+                found.append(
+                    f"{name} ({size} rows): throughput dropped from "
+                    f"{expected['rows_per_second']:.0f} to "
+                    f"{measurement.rows_per_second:.0f} rows/s"
+                )
+            if measurement.peak_bytes > expected["peak_bytes"] * threshold:
+                found.append(
+                    f"{name} ({size} rows): peak memory grew from "
+                    f"{expected['peak_bytes']} to {measurement.peak_bytes} bytes"
+                )
+    return found
+
+
+def benchmark_args() -> argparse.Namespace:
+    """Arguments selecting benchmarks, data set sizes and the baseline"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+    parser.add_argument(
+        "--benchmarks", nargs="+", choices=list(BENCHMARKS), default=list(BENCHMARKS)
+    )
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=1.5,
+        help="Factor by which a path may be slower (or use more memory) than baseline",
+    )
+    parser.add_argument("--update-baseline", action="store_true")
+    return parser.parse_args()
+
+
+def main() -> int:
+    """Runs the benchmarks and compares them against (or updates) the baseline"""
+    args = benchmark_args()
+    results = run_benchmarks(args.sizes, args.benchmarks)
+    if args.update_baseline:
+        baseline = {}
+        with contextlib.suppress(FileNotFoundError):
+            with open(args.baseline, encoding="utf-8") as file:
+                baseline = json.load(file)
+        for name, by_size in results.items():
+            baseline.setdefault(name, {}).update(
+                {size: asdict(measurement) for size, measurement in by_size.items()}
+            )
+        os.makedirs(os.path.dirname(os.path.abspath(args.baseline)), exist_ok=True)
+        with open(args.baseline, "w", encoding="utf-8") as file:
+            json.dump(baseline, file, indent=2)
+        print(f"Updated baseline {args.baseline}")
+        return 0
+    try:
+        with open(args.baseline, encoding="utf-8") as file:
+            baseline = json.load(file)
+    except FileNotFoundError:
+        print(f"No baseline at {args.baseline}, run with --update-baseline first")
+        return 1
+    found = regressions(results, baseline, args.threshold)
+    for regression in found:
+        print(f"Regression: {regression}")
+    return 1 if found else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
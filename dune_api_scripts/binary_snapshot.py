@@ -0,0 +1,276 @@
+"""
+Binary snapshots of user data files, which can be memory mapped and searched by owner
+instead of parsing all json files. With `USER_DATA_BINARY=1`, the store scripts write
+a snapshot `user_data_binary/{name}.bin` next to every json file `user_data/{name}.json`.
+
+All integers are little endian. A snapshot consists of
+  - a header (see `HEADER`),
+  - a fan-out index of 256 cumulative record counts by the first byte of the owner,
+  - fixed width records (see `RECORD`) sorted by their 20 byte owner,
+  - the address dictionary of all referrals (20 bytes each),
+  - the referrals of all records (u32 indices into the address dictionary) and
+  - the distinct days (newline separated utf-8 strings), referenced by index.
+"""
+from __future__ import annotations
+
+import bisect
+import itertools
+import json
+import mmap
+import os
+import struct
+import sys
+from collections.abc import Iterator, Mapping
+from pathlib import Path
+from typing import Any, BinaryIO, Optional
+
+from dune_api_scripts.instrumentation import stage
+
+MAGIC = b"CUD\x01"
+# magic, record size, number of records, addresses, referrals, bytes of days, download
+HEADER = struct.Struct("<4sIIIIIq")
+FANOUT = struct.Struct("<256I")
+# owner, day index, null flags, cowswap_usd_volume, number_of_trades,
+# total_referred_volume, usd_volume_all_exchanges, first referral, number of referrals
+RECORD = struct.Struct("<20sIB3xdQddII")
+ADDRESS_SIZE = 20
+REFERRAL = struct.Struct("<I")
+RECORDS_OFFSET = HEADER.size + FANOUT.size
+
+# Flags of the nullable fields of a record, set if the value is null.
+NULLABLE = {
+    "cowswap_usd_volume": 1,
+    "number_of_trades": 2,
+    "total_referred_volume": 4,
+    "usd_volume_all_exchanges": 8,
+}
+
+
+def address_bytes(address: str) -> bytes:
+    """Parses a hex address prefixed by `0x` (or `\\x`, as used by Dune)"""
+    return bytes.fromhex(address[2:])
+
+
+def write_snapshot(
+    file: BinaryIO, rows: list[Mapping[str, Any]], time_of_download: int
+) -> int:
+    """Writes user data `rows` as binary snapshot to `file`, returns the bytes written"""
+    rows = sorted(rows, key=lambda row: address_bytes(row["owner"]))
+    addresses = sorted(
+        {address_bytes(r) for row in rows for r in row["referrals"] or []}
+    )
+    address_index = {address: index for index, address in enumerate(addresses)}
+    days: dict[str, int] = {}
+    fanout = [0] * 256
+    records: list[bytes] = []
+    referrals: list[int] = []
+    for row in rows:
+        owner = address_bytes(row["owner"])
+        fanout[owner[0]] += 1
+        flags = sum(flag for key, flag in NULLABLE.items() if row.get(key) is None)
+        records.append(
+            RECORD.pack(
+                owner,
+                days.setdefault(row["day"], len(days)),
+                flags,
+                row.get("cowswap_usd_volume") or 0.0,
+                int(row.get("number_of_trades") or 0),
+                row.get("total_referred_volume") or 0.0,
+                row.get("usd_volume_all_exchanges") or 0.0,
+                len(referrals),
+                len(row["referrals"] or []),
+            )
+        )
+        referrals.extend(
+            address_index[address_bytes(r)] for r in row["referrals"] or []
+        )
+    day_bytes = "\n".join(days).encode("utf-8")
+
+    sections = [
+        HEADER.pack(
+            MAGIC,
+            RECORD.size,
+            len(records),
+            len(addresses),
+            len(referrals),
+            len(day_bytes),
+            time_of_download,
+        ),
+        FANOUT.pack(*itertools.accumulate(fanout)),
+        b"".join(records),
+        b"".join(addresses),
+        struct.pack(f"<{len(referrals)}I", *referrals),
+        day_bytes,
+    ]
+    for section in sections:
+        file.write(section)
+    return sum(map(len, sections))
+
+
+class BinarySnapshot:
+    """Memory mapped reader of a binary snapshot"""
+
+    def __init__(self, path: str | Path):
+        with open(path, "rb") as file:
+            self.buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        (
+            magic,
+            record_size,
+            self.num_records,
+            num_addresses,
+            num_referrals,
+            day_bytes,
+            self.time_of_download,
+        ) = HEADER.unpack_from(self.buffer)
+        if magic != MAGIC or record_size != RECORD.size:
+            raise ValueError(f"{path} is not a binary user data snapshot")
+        self.fanout = FANOUT.unpack_from(self.buffer, HEADER.size)
+        self.addresses_offset = RECORDS_OFFSET + self.num_records * RECORD.size
+        self.referrals_offset = self.addresses_offset + num_addresses * ADDRESS_SIZE
+        days_offset = self.referrals_offset + num_referrals * REFERRAL.size
+        self.days = (
+            self.buffer[days_offset : days_offset + day_bytes]
+            .decode("utf-8")
+            .split("\n")
+        )
+
+    def __enter__(self) -> BinarySnapshot:
+        return self
+
+    def __exit__(self, *_: Any) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Unmaps the snapshot"""
+        self.buffer.close()
+
+    def __len__(self) -> int:
+        return int(self.num_records)
+
+    def owner(self, index: int) -> bytes:
+        """Owner of the record at `index`"""
+        offset = RECORDS_OFFSET + index * RECORD.size
+        return self.buffer[offset : offset + ADDRESS_SIZE]
+
+    def address(self, index: int) -> str:
+        """Hex address at `index` of the address dictionary"""
+        offset = self.addresses_offset + index * ADDRESS_SIZE
+        return "0x" + self.buffer[offset : offset + ADDRESS_SIZE].hex()
+
+    def record(self, index: int) -> dict[str, Any]:
+        """The record at `index` in the shape of the json rows"""
+        (
+            owner,
+            day,
+            flags,
+            cowswap_usd_volume,
+            number_of_trades,
+            total_referred_volume,
+            usd_volume_all_exchanges,
+            first_referral,
+            num_referrals,
+        ) = RECORD.unpack_from(self.buffer, RECORDS_OFFSET + index * RECORD.size)
+        referrals = struct.unpack_from(
+            f"<{num_referrals}I",
+            self.buffer,
+            self.referrals_offset + first_referral * REFERRAL.size,
+        )
+        values = {
+            "cowswap_usd_volume": cowswap_usd_volume,
+            "number_of_trades": number_of_trades,
+            "total_referred_volume": total_referred_volume,
+            "usd_volume_all_exchanges": usd_volume_all_exchanges,
+        }
+        return {
+            "owner": "0x" + owner.hex(),
+            "day": self.days[day],
+            "referrals": [self.address(referral) for referral in referrals],
+            **{
+                key: None if flags & NULLABLE[key] else value
+                for key, value in values.items()
+            },
+        }
+
+    def rows(self) -> Iterator[dict[str, Any]]:
+        """All records, sorted by owner"""
+        return (self.record(index) for index in range(len(self)))
+
+    def lookup(self, owner: str) -> list[dict[str, Any]]:
+        """All records of `owner`, found by binary search"""
+        key = address_bytes(owner)
+        low = self.fanout[key[0] - 1] if key[0] else 0
+        high = self.fanout[key[0]]
+        first = bisect.bisect_left(range(low, high), key, key=self.owner) + low
+        last = bisect.bisect_right(range(first, high), key, key=self.owner) + first
+        return [self.record(index) for index in range(first, last)]
+
+
+def normalized(row: Mapping[str, Any]) -> dict[str, Any]:
+    """Json row with lower case addresses, as read from a snapshot"""
+    return {
+        **dict.fromkeys(NULLABLE),
+        **row,
+        "owner": "0x" + row["owner"][2:].lower(),
+        "referrals": ["0x" + r[2:].lower() for r in row["referrals"] or []],
+    }
+
+
+def verify_snapshot(json_path: str | Path, snapshot_file: str | Path) -> None:
+    """Raises a `ValueError` unless the snapshot holds the same rows as the json file"""
+    with open(json_path, encoding="utf-8") as file:
+        content = json.load(file)
+    expected = sorted(
+        map(normalized, content["user_data"]),
+        key=lambda row: address_bytes(row["owner"]),
+    )
+    with BinarySnapshot(snapshot_file) as snapshot:
+        if snapshot.time_of_download != content["time_of_download"]:
+            raise ValueError(f"{snapshot_file} differs in time of download")
+        for index, (row, record) in enumerate(zip(expected, snapshot.rows())):
+            if row != record:
+                raise ValueError(f"Row {index} of {snapshot_file} differs: {record}")
+        if len(expected) != len(snapshot):
+            raise ValueError(f"{snapshot_file} has {len(snapshot)} rows")
+
+
+def snapshot_path(data_folder: str, json_path: str | Path) -> Path:
+    """Path of the binary snapshot of the user data file `json_path`"""
+    return Path(data_folder + "/user_data_binary/") / f"{Path(json_path).stem}.bin"
+
+
+def export_snapshot(
+    data_folder: str, json_path: str | Path, verify: bool = False
+) -> Optional[Path]:
+    """
+    Writes the binary snapshot of the user data file `json_path` (if enabled
+    with `USER_DATA_BINARY=1`), replacing any previous snapshot atomically.
+    """
+    if os.environ.get("USER_DATA_BINARY", "") != "1":
+        return None
+    with open(json_path, encoding="utf-8") as file:
+        content = json.load(file)
+    path = snapshot_path(data_folder, json_path)
+    os.makedirs(path.parent, exist_ok=True)
+    tmp_path = Path(f"{path}.tmp")
+    with stage("write_binary_snapshot") as measurement, open(tmp_path, "wb") as file:
+        measurement.rows = len(content["user_data"])
+        measurement.bytes = write_snapshot(
+            file, content["user_data"], content["time_of_download"]
+        )
+    os.replace(tmp_path, path)
+    if verify:
+        verify_snapshot(json_path, path)
+    return path
+
+
+if __name__ == "__main__":
+    # Converts (and verifies) the given user data files.
+    os.environ["USER_DATA_BINARY"] = "1"
+    for user_data_file in sys.argv[1:]:
+        print(
+            export_snapshot(
+                os.environ.get("DUNE_DATA_FOLDER", "./data/dune_data"),
+                user_data_file,
+                verify=True,
+            )
+        )
@@ -0,0 +1,178 @@
+"""
+Compacts the daily `user_data_from{day}.json` files of closed days into one snapshot
+`user_data_snapshot_{month}.json` per month, so that the number of files (and their
+size) read by the service on startup stays bounded:
+    python -m dune_api_scripts.compact_user_data
+Rows are deduplicated on (owner, day), the row of the newest download winning.
+The entire history file and today's file are never touched.
+
+A day is only closed once it can't be rewritten by the job storing today's trading
+data anymore, i.e. after the last `max(AFFILIATE_KEEP_DAYS, 1)` days (which covers
+the previous day queried shortly after midnight). Otherwise a rewritten daily file
+would be served along with the snapshot, counting the rows of its day twice.
+
+For the same reason, the service (reloading `user_data/` every few seconds) must never
+see a snapshot along with the daily files merged into it. The snapshot is staged in
+`user_data_compaction/` along with a marker listing its daily files, which are retired
+before the snapshot is moved into `user_data/`. Compactions interrupted in between
+are completed by the next run.
+"""
+from __future__ import annotations
+
+import json
+import os
+import re
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Optional
+
+from dune_api_scripts.binary_snapshot import export_snapshot, snapshot_path
+from dune_api_scripts.instrumentation import instrumented, stage
+from dune_api_scripts.local_env import DUNE_DATA_DIR
+from dune_api_scripts.utils import (
+    load_json_or_default,
+    open_for_reading,
+    row_key,
+    temporary_path,
+    write_json_atomically,
+    write_user_data,
+)
+
+SECONDS_PER_DAY = 24 * 60 * 60
+DAILY_FILE = re.compile(r"^user_data_from(\d+)\.json$")
+
+
+def month_of(day_timestamp: int) -> str:
+    """Month (`YYYY-MM`) of a download day given as timestamp"""
+    return datetime.fromtimestamp(day_timestamp, tz=timezone.utc).strftime("%Y-%m")
+
+
+def open_days() -> int:
+    """Number of days before today whose daily files may still be rewritten"""
+    return max(int(os.getenv("AFFILIATE_KEEP_DAYS", "2")), 1)
+
+
+def closed_daily_files(user_data: Path, today: int) -> dict[str, list[Path]]:
+    """
+    Daily files of all closed days (see `open_days`) before `today` (a day timestamp),
+    grouped by month
+    """
+    cutoff = today - open_days() * SECONDS_PER_DAY
+    by_month: dict[str, list[Path]] = {}
+    for path in sorted(user_data.iterdir()):
+        match = DAILY_FILE.match(path.name)
+        if match and int(match.group(1)) < cutoff:
+            by_month.setdefault(month_of(int(match.group(1))), []).append(path)
+    return by_month
+
+
+def merged_rows(files: list[Path]) -> tuple[list[dict[str, Any]], int]:
+    """
+    Rows of all `files` deduplicated on (owner, day), keeping the row of the newest
+    download, along with the time of the newest download.
+    """
+    newest: dict[str, tuple[int, dict[str, Any]]] = {}
+    latest_download = 0
+    for path in files:
+        with stage("read_user_data") as measurement, open_for_reading(path) as file:
+            content = json.load(file)
+            measurement.rows = len(content["user_data"])
+            measurement.bytes = os.path.getsize(path)
+        time_of_download = int(content["time_of_download"])
+        latest_download = max(latest_download, time_of_download)
+        for row in content["user_data"]:
+            key = row_key(row)
+            if key not in newest or newest[key][0] <= time_of_download:
+                newest[key] = (time_of_download, row)
+    return [row for _, row in newest.values()], latest_download
+
+
+def retire(data_folder: str, daily_file: Path) -> None:
+    """Removes a compacted daily file along with its state files and binary snapshot"""
+    daily_file.unlink(missing_ok=True)
+    state_path = Path(data_folder + "/user_data_state/")
+    for state_file in [
+        state_path / f"{daily_file.stem}.digests.json",
+        state_path / f"{daily_file.stem}.changes.json",
+        snapshot_path(data_folder, daily_file),
+    ]:
+        if state_file.exists():
+            state_file.unlink()
+
+
+def pending_marker(staged: Path) -> Path:
+    """Marker listing the daily files merged into the `staged` snapshot"""
+    return staged.with_name(f"{staged.stem}.pending.json")
+
+
+def publish_snapshot(data_folder: str, staged: Path) -> None:
+    """
+    Retires the daily files listed in the marker of the `staged` snapshot,
+    then moves the snapshot into `user_data/` and removes the marker.
+    """
+    marker = pending_marker(staged)
+    user_data = Path(data_folder + "/user_data/")
+    daily_files = load_json_or_default(marker, {"daily_files": []})["daily_files"]
+    for name in daily_files:
+        retire(data_folder, user_data / name)
+    snapshot = user_data / staged.name
+    if staged.exists():
+        os.replace(staged, snapshot)
+        export_snapshot(data_folder, snapshot)
+    marker.unlink(missing_ok=True)
+    print(f"Compacted {len(daily_files)} daily files into {snapshot}")
+
+
+def compact_month(data_folder: str, month: str, daily_files: list[Path]) -> None:
+    """
+    Merges `daily_files` into the snapshot of `month` (along with an existing one)
+    and replaces them by it (see `publish_snapshot`).
+    """
+    snapshot = Path(data_folder + "/user_data/") / f"user_data_snapshot_{month}.json"
+    files = ([snapshot] if snapshot.exists() else []) + daily_files
+    rows, latest_download = merged_rows(files)
+    staging = Path(data_folder + "/user_data_compaction/")
+    os.makedirs(staging, exist_ok=True)
+    staged = staging / snapshot.name
+    tmp_file = temporary_path(data_folder, snapshot.name)
+    write_user_data(tmp_file, rows, latest_download)
+    os.replace(tmp_file, staged)
+    # Only once the marker exists, the compaction is completed after interruptions.
+    write_json_atomically(
+        data_folder,
+        pending_marker(staged),
+        {"daily_files": [daily_file.name for daily_file in daily_files]},
+    )
+    publish_snapshot(data_folder, staged)
+
+
+def complete_interrupted_compactions(data_folder: str) -> None:
+    """Publishes the staged snapshots of compactions interrupted after their marker"""
+    staging = Path(data_folder + "/user_data_compaction/")
+    if not staging.is_dir():
+        return
+    for marker in sorted(staging.glob("*.pending.json")):
+        publish_snapshot(
+            data_folder, marker.with_name(marker.name.replace(".pending", ""))
+        )
+
+
+@instrumented("compact_user_data")
+def compact_user_data(data_folder: str, today: Optional[int] = None) -> None:
+    """
+    Compacts the daily files of all closed days before `today` (a day timestamp,
+    defaulting to the current day) into monthly snapshots.
+    """
+    if today is None:
+        today = int(time.time()) // SECONDS_PER_DAY * SECONDS_PER_DAY
+    user_data = Path(data_folder + "/user_data/")
+    if not user_data.is_dir():
+        return
+    complete_interrupted_compactions(data_folder)
+    for month, daily_files in closed_daily_files(user_data, today).items():
+        compact_month(data_folder, month, daily_files)
+
+
+if __name__ == "__main__":
+    compact_user_data(DUNE_DATA_DIR)
@@ -0,0 +1,96 @@
+"""
+Single long running entry point scheduling all jobs on their own intervals:
+    python -m dune_api_scripts.daemon --environment prod
+(or `--environments barn prod` to update the views of several environments at once).
+All jobs share one authenticated Dune connection instead of logging in on every run;
+it only logs in again once its session expired or was rejected (see `session.py`).
+Intervals (in seconds) can be configured with `DAEMON_INTERVAL_<JOB NAME>`.
+"""
+import logging
+import os
+
+from dune_api_scripts.compact_user_data import compact_user_data
+from dune_api_scripts.local_env import DUNE_DATA_DIR, dune_connection
+from dune_api_scripts.scheduler import Job, Scheduler
+from dune_api_scripts.store_query_result_all_distinct_app_data import (
+    store_all_distinct_app_data,
+)
+from dune_api_scripts.store_query_result_for_entire_history_trading_data import (
+    store_entire_history,
+)
+from dune_api_scripts.store_query_result_for_todays_trading_data import (
+    store_todays_trading_data,
+)
+from dune_api_scripts.update.user_retention import update_retention
+from dune_api_scripts.update.utils import (
+    Environment,
+    selected_environments,
+    update_parser,
+)
+from dune_api_scripts.update_appdata_view import update_app_data_views
+
+
+def interval(job_name: str, default: int) -> int:
+    """Interval in seconds for job `job_name`"""
+    return int(os.environ.get(f"DAEMON_INTERVAL_{job_name.upper()}", default))
+
+
+def all_jobs(environments: list[Environment], retention_workers: int) -> list[Job]:
+    """All jobs run by the daemon"""
+    return [
+        Job(
+            name="todays_trading_data",
+            interval=interval("todays_trading_data", 5 * 60),
+            run=store_todays_trading_data,
+        ),
+        Job(
+            name="all_distinct_app_data",
+            interval=interval("all_distinct_app_data", 30 * 60),
+            run=store_all_distinct_app_data,
+        ),
+        Job(
+            name="entire_history",
+            interval=interval("entire_history", 60 * 60),
+            run=store_entire_history,
+        ),
+        Job(
+            name="app_data_views",
+            interval=interval("app_data_views", 30 * 60),
+            run=lambda dune: update_app_data_views(dune, environments),
+        ),
+        Job(
+            name="retention",
+            interval=interval("retention", 60 * 60),
+            run=lambda dune: update_retention(
+                dune,
+                environments,
+                retention_workers,
+                local=os.environ.get("RETENTION_LOCAL", "") == "1",
+                chunk_days=int(os.environ.get("RETENTION_CHUNK_DAYS", 30)),
+            ),
+        ),
+        Job(
+            name="compact_user_data",
+            interval=interval("compact_user_data", 6 * 60 * 60),
+            run=lambda _dune: compact_user_data(DUNE_DATA_DIR),
+        ),
+    ]
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s", level=logging.INFO
+    )
+    parser = update_parser()
+    parser.add_argument(
+        "--retention-workers",
+        type=int,
+        default=int(os.environ.get("RETENTION_MAX_WORKERS", 4)),
+    )
+    args = parser.parse_args()
+    scheduler = Scheduler(
+        dune=dune_connection(),
+        jobs=all_jobs(selected_environments(args), args.retention_workers),
+        data_folder=DUNE_DATA_DIR,
+    )
+    scheduler.run_forever()
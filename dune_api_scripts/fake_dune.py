@@ -0,0 +1,282 @@
+"""
+A local stand-in for the Dune API, so that the jobs can be run (and load tested)
+end to end without network access:
+    DUNE_FAKE=record python -m dune_api_scripts.store_query_result_for_todays_trading_data
+    DUNE_FAKE=replay python -m dune_api_scripts.store_query_result_for_todays_trading_data
+With `record`, results of the live API are stored in `DUNE_FAKE_RECORDINGS`, keyed by
+query id, SQL and parameters of each execution (as the query cache, see `QueryCache.key`),
+since many queries share the same query id.
+With `replay`, no request leaves the process: queries are "executed" by replaying
+these recordings (executing queries without recording fails), optionally scaled to
+`DUNE_FAKE_ROWS` rows, after `DUNE_FAKE_LATENCY` (+ up to `DUNE_FAKE_LATENCY_JITTER`)
+seconds. Executions fail with probability `DUNE_FAKE_ERROR_RATE`, requests fail
+with an HTTP error (resp. time out) with probability `DUNE_FAKE_HTTP_ERROR_RATE`
+(resp. `DUNE_FAKE_TIMEOUT_RATE`).
+"""
+from __future__ import annotations
+
+import hashlib
+import itertools
+import json
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from dataclasses import dataclass, replace
+from pathlib import Path
+from typing import Any, Optional
+
+import requests
+from duneapi.api import DuneAPI
+from duneapi.types import DuneQuery, DuneRecord, Post, QueryParameter
+
+from dune_api_scripts.query_cache import QueryCache
+from dune_api_scripts.utils import open_for_reading, open_for_writing
+
+HEX_ADDRESS = re.compile(r"^(0x|\\x)[0-9a-fA-F]{40}$")
+
+
+class MissingRecording(LookupError):
+    """Raised when executing a query without recording in replay mode"""
+
+
+def recording_path(folder: str | Path, query: DuneQuery) -> Path:
+    """File holding the recorded result rows of `query` (with its parameters)"""
+    return Path(folder) / f"{QueryCache.key(query)}.json.gz"
+
+
+class QueryTrackingDuneAPI(DuneAPI):
+    """
+    Keeps the query last initiated at each query id, to identify the recording of
+    executions (which only pass the query id and parameters to Dune).
+    """
+
+    def __init__(self, username: str, password: str, recordings: str | Path):
+        super().__init__(username, password)
+        self.recordings = recordings
+        self.lock = threading.Lock()
+        self.queries: dict[int, DuneQuery] = {}
+        self.recording_paths: dict[str, Path] = {}
+
+    def initiate_query(self, query: DuneQuery) -> bool:
+        with self.lock:
+            self.queries[query.query_id] = query
+        return super().initiate_query(query)
+
+    def execute_query(self, query: DuneQuery) -> str:
+        return self.execute(query.query_id, query.parameters)
+
+    def execute(
+        self, query_id: int, parameters: Optional[list[QueryParameter]] = None
+    ) -> str:
+        with self.lock:
+            query = self.queries.get(query_id)
+        path = None
+        if query is not None:
+            query = replace(query, parameters=parameters or [])
+            path = recording_path(self.recordings, query)
+        self.check_recording(query_id, path)
+        job_id = super().execute(query_id, parameters)
+        if path is not None:
+            with self.lock:
+                self.recording_paths[job_id] = path
+        return job_id
+
+    def check_recording(self, query_id: int, path: Optional[Path]) -> None:
+        """Hook validating the recording `path` before executing `query_id`"""
+
+
+def scale_rows(rows: list[DuneRecord], count: int) -> list[DuneRecord]:
+    """
+    Repeats `rows` until there are `count` of them. Addresses in repeated rows
+    are replaced by (deterministic) new ones, so that they represent other users.
+    """
+    if not rows:
+        return []
+
+    def distinct(value: Any, copy: int) -> Any:
+        if copy == 0 or not isinstance(value, str) or not HEX_ADDRESS.match(value):
+            return value
+        digest = hashlib.sha1(f"{value}/{copy}".encode()).hexdigest()
+        return value[:2] + digest
+
+    return [
+        {key: distinct(value, index // len(rows)) for key, value in row.items()}
+        for index, row in zip(range(count), itertools.cycle(rows))
+    ]
+
+
+def json_response(content: Any, status_code: int = 200) -> requests.Response:
+    """A response of the Dune API with json `content`"""
+    response = requests.Response()
+    response.status_code = status_code
+    response.encoding = "utf-8"
+    response._content = json.dumps(content).encode()  # pylint: disable=protected-access
+    return response
+
+
+def empty_response_data(post: Post) -> dict[str, Any]:
+    """Response data passing the validation of `post`, with all values unset"""
+    return {key: dict.fromkeys(inner) for key, inner in post.key_map.items()}
+
+
+@dataclass
+class FakeDuneConfig:
+    """Behaviour of the fake Dune API"""
+
+    recordings: str
+    rows: int = 0
+    latency: float = 0.0
+    latency_jitter: float = 0.0
+    error_rate: float = 0.0
+    http_error_rate: float = 0.0
+    timeout_rate: float = 0.0
+
+    @classmethod
+    def from_environment(cls) -> FakeDuneConfig:
+        """Reads the configuration from `DUNE_FAKE_*` environment variables"""
+        return cls(
+            recordings=os.environ.get(
+                "DUNE_FAKE_RECORDINGS",
+                os.path.join(
+                    os.environ.get("DUNE_DATA_FOLDER", "./data/dune_data"),
+                    "dune_recordings",
+                ),
+            ),
+            rows=int(os.environ.get("DUNE_FAKE_ROWS", 0)),
+            latency=float(os.environ.get("DUNE_FAKE_LATENCY", 0)),
+            latency_jitter=float(os.environ.get("DUNE_FAKE_LATENCY_JITTER", 0)),
+            error_rate=float(os.environ.get("DUNE_FAKE_ERROR_RATE", 0)),
+            http_error_rate=float(os.environ.get("DUNE_FAKE_HTTP_ERROR_RATE", 0)),
+            timeout_rate=float(os.environ.get("DUNE_FAKE_TIMEOUT_RATE", 0)),
+        )
+
+
+@dataclass
+class FakeExecution:
+    """An execution of a query, finishing at `done_at`"""
+
+    query_id: int
+    done_at: float
+    failed: bool
+
+
+class FakeDuneAPI(QueryTrackingDuneAPI):
+    """Answers all requests of the Dune API client locally"""
+
+    def __init__(self, config: FakeDuneConfig, seed: Optional[int] = None):
+        super().__init__("fake", "fake", config.recordings)
+        self.config = config
+        self.ping_frequency = min(self.ping_frequency, 1)
+        self.rng = random.Random(seed)
+        self.executions: dict[str, FakeExecution] = {}
+        self.results: dict[Path, list[DuneRecord]] = {}
+
+    def login(self) -> None:
+        pass
+
+    def refresh_auth_token(self) -> None:
+        pass
+
+    def check_recording(self, query_id: int, path: Optional[Path]) -> None:
+        if path is None or not path.is_file():
+            raise MissingRecording(
+                f"No recording of query {query_id} with the executed SQL and parameters"
+            )
+
+    def replayed_rows(self, path: Path) -> list[DuneRecord]:
+        """The recorded result at `path` (scaled if configured)"""
+        if path not in self.results:
+            with open_for_reading(path) as file:
+                rows: list[DuneRecord] = json.load(file)
+            self.results[path] = (
+                scale_rows(rows, self.config.rows) if self.config.rows else rows
+            )
+        return self.results[path]
+
+    def post_dune_request(self, post: Post, is_get: bool = False) -> requests.Response:
+        with self.lock:
+            chance = self.rng.random()
+            if chance < self.config.timeout_rate:
+                raise requests.Timeout("Injected timeout of fake Dune API")
+            if chance < self.config.timeout_rate + self.config.http_error_rate:
+                return json_response({"error": "Injected error"}, status_code=502)
+            request: dict[str, Any] = dict(post.data)
+            operation, variables = request["operationName"], request["variables"]
+            if operation == "ExecuteQuery":
+                return self._execute(post, variables["query_id"])
+            if operation == "GetExecution":
+                return self._get_execution(variables["execution_id"])
+            return json_response({"data": empty_response_data(post)})
+
+    def _execute(self, post: Post, query_id: int) -> requests.Response:
+        job_id = str(uuid.uuid4())
+        latency = self.config.latency + self.rng.random() * self.config.latency_jitter
+        self.executions[job_id] = FakeExecution(
+            query_id=query_id,
+            done_at=time.monotonic() + latency,
+            failed=self.rng.random() < self.config.error_rate,
+        )
+        data = empty_response_data(post)
+        data["execute_query_v2"]["job_id"] = job_id
+        return json_response({"data": data})
+
+    def _get_execution(self, job_id: str) -> requests.Response:
+        execution = self.executions[job_id]
+        status: dict[str, Any] = dict.fromkeys(
+            [
+                "execution_queued",
+                "execution_running",
+                "execution_succeeded",
+                "execution_failed",
+            ]
+        )
+        if time.monotonic() < execution.done_at:
+            status["execution_running"] = {"execution_id": job_id}
+        elif execution.failed:
+            status["execution_failed"] = {
+                "execution_id": job_id,
+                "type": "FAILED_TYPE_EXECUTION_FAILED",
+                "message": "Injected execution failure",
+            }
+        else:
+            status["execution_succeeded"] = {
+                "execution_id": job_id,
+                "data": self.replayed_rows(self.recording_paths[job_id]),
+            }
+        return json_response({"data": {"get_execution": status}})
+
+
+class RecordingDuneAPI(QueryTrackingDuneAPI):
+    """Talks to the live Dune API, recording the results of all executions"""
+
+    def __init__(self, username: str, password: str, recordings: str):
+        super().__init__(username, password, recordings)
+        os.makedirs(recordings, exist_ok=True)
+
+    def post_dune_request(self, post: Post, is_get: bool = False) -> requests.Response:
+        response = super().post_dune_request(post, is_get)
+        request: dict[str, Any] = dict(post.data)
+        if request["operationName"] == "GetExecution" and response.status_code == 200:
+            succeeded = response.json()["data"]["get_execution"]["execution_succeeded"]
+            path = self.recording_paths.get(request["variables"]["execution_id"])
+            if succeeded is not None and path is not None:
+                with open_for_writing(path, compress=True) as file:
+                    json.dump(succeeded["data"], file)
+        return response
+
+
+def dune_from_environment(mode: str) -> DuneAPI:
+    """Connection of the given `DUNE_FAKE` mode (`replay` or `record`)"""
+    config = FakeDuneConfig.from_environment()
+    if mode == "replay":
+        return FakeDuneAPI(config)
+    if mode == "record":
+        dune = RecordingDuneAPI(
+            os.environ["DUNE_USER"], os.environ["DUNE_PASSWORD"], config.recordings
+        )
+        dune.login()
+        return dune
+    raise ValueError(f"Unknown DUNE_FAKE mode {mode}, expected replay or record")
@@ -0,0 +1,235 @@
+"""
+End-to-end freshness of the data served from the dune data folder.
+
+After committing its files, every store job records
+  - the block time of the newest trade (or settlement) in its result,
+  - the time its result was downloaded and
+  - the time its files were committed,
+appending them to the rolling log `freshness/{job}.jsonl` (keeping the last
+`FRESHNESS_LOG_SIZE` entries). The latest entry and the percentiles of the lag
+(commit time minus newest block time) over the log are written to the status file
+`freshness_status.json` and exported as Prometheus textfile
+`metrics/dune_bridge_freshness_{job}.prom`.
+
+    python -m dune_api_scripts.freshness --max-lag 3600
+prints the status and exits with 1 if the latest lag of any job exceeds `--max-lag`,
+e.g. for readiness checks.
+"""
+from __future__ import annotations
+
+import argparse
+import contextlib
+import fcntl
+import json
+import os
+import sys
+import time
+from collections.abc import Iterable, Iterator, MutableMapping
+from datetime import datetime, timezone
+from typing import Any, Optional, TypeVar
+
+from dune_api_scripts.utils import load_json_or_default, write_json_atomically
+
+PERCENTILES = [50, 90, 99]
+
+Record = TypeVar("Record", bound=MutableMapping[str, Any])
+
+
+def block_timestamp(block_time: Any) -> Optional[float]:
+    """
+    Parses block times (timestamps or strings as returned by Dune,
+    e.g. `2021-10-18T12:34:56+00:00`), treating those without time zone as UTC.
+    """
+    if block_time is None or block_time == "":
+        return None
+    if isinstance(block_time, (int, float)):
+        return float(block_time)
+    parsed = datetime.fromisoformat(str(block_time).replace("Z", "+00:00"))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+
+def newest_block_time(block_times: Iterable[Any]) -> Optional[float]:
+    """The newest of all `block_times` (ignoring missing ones)"""
+    timestamps = [t for t in map(block_timestamp, block_times) if t is not None]
+    return max(timestamps, default=None)
+
+
+def strip_block_times(
+    records: Iterable[Record], newest: dict[str, Optional[float]]
+) -> Iterator[Record]:
+    """
+    Passes through `records` without their `newest_block_time` column
+    (which is not part of the files read by the service),
+    keeping the newest of them in `newest["block_time"]`.
+    """
+    newest.setdefault("block_time", None)
+    for record in records:
+        block_time = newest_block_time(
+            [record.pop("newest_block_time", None), newest["block_time"]]
+        )
+        newest["block_time"] = block_time
+        yield record
+
+
+def percentile(values: list[float], rank: float) -> float:
+    """Nearest rank percentile of (non-empty) `values`"""
+    ordered = sorted(values)
+    index = max(int(-(-rank * len(ordered) // 100)) - 1, 0)
+    return ordered[index]
+
+
+def freshness_summary(entries: list[dict[str, Any]]) -> dict[str, Any]:
+    """Latest entry of a job along with the lag percentiles over all `entries`"""
+    lags = [entry["lag"] for entry in entries if entry["lag"] is not None]
+    return {
+        **entries[-1],
+        "samples": len(lags),
+        "lag_percentiles": {
+            f"p{rank}": percentile(lags, rank) if lags else None for rank in PERCENTILES
+        },
+    }
+
+
+def prometheus_text(job: str, summary: dict[str, Any]) -> str:
+    """Freshness of `job` in the Prometheus text exposition format"""
+    label = f'job="{job}"'
+    lines = [
+        "# TYPE dune_bridge_freshness_lag_seconds summary",
+        *(
+            f'dune_bridge_freshness_lag_seconds{{{label},quantile="{rank / 100}"}} '
+            f"{summary['lag_percentiles'][f'p{rank}']}"
+            for rank in PERCENTILES
+            if summary["lag_percentiles"][f"p{rank}"] is not None
+        ),
+        f"dune_bridge_freshness_lag_seconds_count{{{label}}} {summary['samples']}",
+        "# TYPE dune_bridge_newest_block_timestamp_seconds gauge",
+        f"dune_bridge_newest_block_timestamp_seconds{{{label}}} "
+        f"{summary['newest_block_time'] or 0}",
+        "# TYPE dune_bridge_committed_timestamp_seconds gauge",
+        f"dune_bridge_committed_timestamp_seconds{{{label}}} {summary['committed_at']}",
+    ]
+    return "\n".join(lines) + "\n"
+
+
+@contextlib.contextmanager
+def locked(data_folder: str) -> Iterator[None]:
+    """Guards the freshness log and status against concurrent jobs"""
+    os.makedirs(os.path.join(data_folder, "freshness"), exist_ok=True)
+    lock_file = os.path.join(data_folder, "freshness", "freshness.lock")
+    with open(lock_file, "a", encoding="utf-8") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+def append_to_log(
+    log_file: str, entry: dict[str, Any], size: int
+) -> list[dict[str, Any]]:
+    """Appends `entry` to the log, keeping its last `size` entries, and returns them"""
+    try:
+        with open(log_file, encoding="utf-8") as file:
+            entries = [json.loads(line) for line in file if line.strip()]
+    except FileNotFoundError:
+        entries = []
+    entries = (entries + [entry])[-size:]
+    tmp_file = f"{log_file}.{os.getpid()}.tmp"
+    with open(tmp_file, "w", encoding="utf-8") as file:
+        file.writelines(json.dumps(e) + "\n" for e in entries)
+    os.replace(tmp_file, log_file)
+    return entries
+
+
+def export_metrics(data_folder: str, job: str, summary: dict[str, Any]) -> None:
+    """Writes the freshness `summary` of `job` as Prometheus textfile"""
+    metrics_folder = os.path.join(data_folder, "metrics")
+    os.makedirs(metrics_folder, exist_ok=True)
+    # Hidden temporary file, as the textfile collector reads all `*.prom` files.
+    tmp_file = os.path.join(metrics_folder, f".freshness_{job}.tmp")
+    with open(tmp_file, "w", encoding="utf-8") as file:
+        file.write(prometheus_text(job, summary))
+    os.replace(
+        tmp_file, os.path.join(metrics_folder, f"dune_bridge_freshness_{job}.prom")
+    )
+
+
+def record_freshness(
+    job: str,
+    newest: Optional[float],
+    downloaded_at: float,
+    committed_at: Optional[float] = None,
+) -> dict[str, Any]:
+    """
+    Records the freshness of the files just committed by `job`
+    (with `newest` block time, downloaded at `downloaded_at`) and returns its summary.
+    """
+    data_folder = os.environ.get("DUNE_DATA_FOLDER", "./data/dune_data")
+    committed_at = time.time() if committed_at is None else committed_at
+    entry = {
+        "job": job,
+        "newest_block_time": newest,
+        "downloaded_at": downloaded_at,
+        "committed_at": committed_at,
+        "lag": None if newest is None else committed_at - newest,
+    }
+    with locked(data_folder):
+        entries = append_to_log(
+            os.path.join(data_folder, "freshness", f"{job}.jsonl"),
+            entry,
+            int(os.getenv("FRESHNESS_LOG_SIZE", "1000")),
+        )
+        summary = freshness_summary(entries)
+        status_file = os.path.join(data_folder, "freshness_status.json")
+        status = load_json_or_default(status_file, {})
+        status[job] = summary
+        write_json_atomically(data_folder, status_file, status)
+        export_metrics(data_folder, job, summary)
+    lag = "unknown" if entry["lag"] is None else f"{entry['lag']:.0f}s"
+    print(f"Data of {job} lags the chain by {lag}")
+    return summary
+
+
+def stale_jobs(status: dict[str, Any], max_lag: float, now: float) -> list[str]:
+    """
+    Jobs whose data lagged the chain by more than `max_lag` seconds when it was
+    committed, or whose last commit is older than `max_lag` seconds.
+    """
+    return sorted(
+        job
+        for job, summary in status.items()
+        if (summary["lag"] is not None and summary["lag"] > max_lag)
+        or now - summary["committed_at"] > max_lag
+    )
+
+
+def main() -> int:
+    """Prints the freshness status, returns 1 if any of the (given) jobs is stale"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--max-lag",
+        type=float,
+        default=float(os.getenv("FRESHNESS_MAX_LAG", "3600")),
+        help="Maximum lag (in seconds) of ready data",
+    )
+    parser.add_argument("--jobs", nargs="+", help="Only check these jobs")
+    args = parser.parse_args()
+    data_folder = os.environ.get("DUNE_DATA_FOLDER", "./data/dune_data")
+    status = load_json_or_default(
+        os.path.join(data_folder, "freshness_status.json"), {}
+    )
+    if args.jobs:
+        status = {job: status[job] for job in args.jobs if job in status}
+        missing = sorted(set(args.jobs) - set(status))
+        if missing:
+            print(f"No freshness recorded for {missing}")
+            return 1
+    print(json.dumps(status, indent=2))
+    stale = stale_jobs(status, args.max_lag, time.time())
+    if stale:
+        print(f"Stale data of {stale}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,204 @@
+"""
+Lightweight instrumentation of the stages of each job run (building SQL, Dune requests,
+awaiting results, writing files), recording their durations, row counts and bytes.
+
+Job entry points are wrapped with `instrumented_run(job)`, and stages within a run
+are measured with `stage(name)`. Repeated stages of a run are accumulated.
+Once a run finishes, its stages are
+  - exported as Prometheus textfile `metrics/dune_bridge_{job}.prom` and
+  - appended to the json lines run log `run_log.jsonl`
+in the dune data folder. Once the run log exceeds `RUN_LOG_MAX_BYTES`, it is rotated
+to `run_log.jsonl.1` (replacing the previous one).
+Stages outside of any run are not recorded.
+"""
+from __future__ import annotations
+
+import contextlib
+import contextvars
+import fcntl
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from collections.abc import Callable, Iterator
+from dataclasses import asdict, dataclass, field
+from typing import Any, Optional, TypeVar
+
+log = logging.getLogger(__name__)
+
+Result = TypeVar("Result")
+
+_CURRENT_RUN: contextvars.ContextVar[Optional[Run]] = contextvars.ContextVar(
+    "current_run", default=None
+)
+_RUN_LOG_LOCK = threading.Lock()
+
+
+@dataclass
+class Stage:
+    """Accumulated measurements of a stage within a run"""
+
+    count: int = 0
+    seconds: float = 0.0
+    rows: int = 0
+    bytes: int = 0
+
+
+@dataclass
+class Measurement:
+    """Rows and bytes processed by a single execution of a stage"""
+
+    rows: int = 0
+    bytes: int = 0
+
+
+@dataclass
+class Run:
+    """All stages of a job run"""
+
+    job: str
+    started_at: float = field(default_factory=time.time)
+    stages: dict[str, Stage] = field(default_factory=dict)
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def record(self, name: str, seconds: float, measurement: Measurement) -> None:
+        """Adds a finished stage execution"""
+        with self.lock:
+            accumulated = self.stages.setdefault(name, Stage())
+            accumulated.count += 1
+            accumulated.seconds += seconds
+            accumulated.rows += measurement.rows
+            accumulated.bytes += measurement.bytes
+
+
+@contextlib.contextmanager
+def stage(name: str) -> Iterator[Measurement]:
+    """
+    Measures the duration of the enclosed block as stage `name` of the current run.
+    Rows and bytes can be set on the yielded measurement.
+    """
+    measurement = Measurement()
+    start = time.monotonic()
+    try:
+        yield measurement
+    finally:
+        run = _CURRENT_RUN.get()
+        if run is not None:
+            run.record(name, time.monotonic() - start, measurement)
+
+
+def current_job() -> Optional[str]:
+    """The job of the current run (if any)"""
+    run = _CURRENT_RUN.get()
+    return None if run is None else run.job
+
+
+def in_current_run(function: Callable[..., Result]) -> Callable[..., Result]:
+    """
+    Wraps `function` to be executed within the current run,
+    for it to be submitted to another thread.
+    """
+    return functools.partial(contextvars.copy_context().run, function)
+
+
+@contextlib.contextmanager
+def instrumented_run(job: str) -> Iterator[Run]:
+    """
+    Records all stages of the enclosed block as a run of `job` and exports them.
+    Nested runs are recorded as a stage of the enclosing run.
+    """
+    if _CURRENT_RUN.get() is not None:
+        with stage(job):
+            yield _CURRENT_RUN.get()  # type: ignore[misc]
+        return
+    run = Run(job=job)
+    token = _CURRENT_RUN.set(run)
+    status = "failed"
+    start = time.monotonic()
+    try:
+        yield run
+        status = "succeeded"
+    except SystemExit:
+        # Scripts exit early when there is nothing to do.
+        status = "exited"
+        raise
+    finally:
+        _CURRENT_RUN.reset(token)
+        try:
+            export_run(run, time.monotonic() - start, status)
+        except OSError:
+            log.exception(f"Failed to export metrics of {job}")
+
+
+def instrumented(job: str) -> Callable[[Callable[..., Result]], Callable[..., Result]]:
+    """Decorator recording each call as a run of `job`"""
+
+    def decorator(function: Callable[..., Result]) -> Callable[..., Result]:
+        @functools.wraps(function)
+        def wrapper(*args: Any, **kwargs: Any) -> Result:
+            with instrumented_run(job):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def prometheus_text(run: Run, seconds: float, status: str) -> str:
+    """Metrics of `run` in the Prometheus text exposition format"""
+    job = f'job="{run.job}"'
+    lines = [
+        "# TYPE dune_bridge_run_duration_seconds gauge",
+        f"dune_bridge_run_duration_seconds{{{job}}} {seconds}",
+        "# TYPE dune_bridge_run_success gauge",
+        f"dune_bridge_run_success{{{job}}} {int(status != 'failed')}",
+        "# TYPE dune_bridge_run_timestamp_seconds gauge",
+        f"dune_bridge_run_timestamp_seconds{{{job}}} {run.started_at}",
+    ]
+    for metric in ["count", "seconds", "rows", "bytes"]:
+        name = f"dune_bridge_stage_{metric}"
+        lines.append(f"# TYPE {name} gauge")
+        lines.extend(
+            f'{name}{{{job},stage="{stage_name}"}} {getattr(stage_data, metric)}'
+            for stage_name, stage_data in sorted(run.stages.items())
+        )
+    return "\n".join(lines) + "\n"
+
+
+def append_to_run_log(log_file: str, entry: dict[str, Any]) -> None:
+    """Appends `entry` to the run log, rotating it once it exceeds its maximum size"""
+    max_bytes = int(os.getenv("RUN_LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+    with _RUN_LOG_LOCK, open(log_file, "a", encoding="utf-8") as file:
+        # Other processes (scripts run on their own) append to the same log.
+        fcntl.flock(file, fcntl.LOCK_EX)
+        file.write(json.dumps(entry) + "\n")
+        file.flush()
+        if file.tell() >= max_bytes:
+            os.replace(log_file, f"{log_file}.1")
+
+
+def export_run(run: Run, seconds: float, status: str) -> None:
+    """Writes the metrics of `run` and appends it to the run log"""
+    data_folder = os.environ.get("DUNE_DATA_FOLDER", "./data/dune_data")
+    metrics_folder = os.path.join(data_folder, "metrics")
+    os.makedirs(metrics_folder, exist_ok=True)
+    metrics_file = os.path.join(metrics_folder, f"dune_bridge_{run.job}.prom")
+    # Hidden temporary file, as the textfile collector reads all `*.prom` files.
+    tmp_file = os.path.join(metrics_folder, f".{run.job}.{os.getpid()}.tmp")
+    with open(tmp_file, "w", encoding="utf-8") as file:
+        file.write(prometheus_text(run, seconds, status))
+    os.replace(tmp_file, metrics_file)
+
+    with run.lock:
+        stages = {name: asdict(stage_data) for name, stage_data in run.stages.items()}
+    entry = {
+        "job": run.job,
+        "started_at": run.started_at,
+        "seconds": seconds,
+        "status": status,
+        "stages": stages,
+    }
+    append_to_run_log(os.path.join(data_folder, "run_log.jsonl"), entry)
+    log.info(f"{run.job} {status} after {seconds:.1f}s: {json.dumps(stages)}")
@@ -1,11 +1,22 @@
 """
 A single location where all common environment variables are parsed.
 Each script will likely import something from here.
+
+Importing `duneapi` pulls in web3 (taking well over a second), so it must not be
+imported at module level by any entry point. Modules import it where it is
+used instead and only import its types for type checking.
 """
+from __future__ import annotations
+
+import functools
 import os
+import threading
+from typing import TYPE_CHECKING
 
 from dotenv import load_dotenv
-from duneapi.api import DuneAPI
+
+if TYPE_CHECKING:
+    from duneapi.api import DuneAPI
 
 load_dotenv()
 
@@ -15,5 +26,40 @@ DUNE_DATA_DIR = os.environ.get("DUNE_DATA_FOLDER", "./data/dune_data")
 # TODO - rename `dune_api_scripts` to anything shorter (e.g. scripts or tasks)
 QUERY_DIR = os.environ.get("QUERY_DIR", "./dune_api_scripts/queries")
 
-# TODO - every script should just import this!
-DUNE_CONNECTION = DuneAPI.new_from_environment()
+_CONNECTION_LOCK = threading.Lock()
+
+
+def dune_connection() -> DuneAPI:
+    """
+    Returns the Dune connection shared within the process.
+    It is only created (and logged in) on first use, rather than on import.
+    With `DUNE_FAKE` set, a local stand-in is used instead (see `fake_dune.py`).
+    Requests are subject to the shared request budget (see `request_budget.py`),
+    unless `DUNE_BUDGET=0`, and the session is renewed when it expires
+    (see `session.py`).
+    """
+    with _CONNECTION_LOCK:
+        return _new_dune_connection()
+
+
+@functools.lru_cache(maxsize=1)
+def _new_dune_connection() -> DuneAPI:
+    # pylint: disable=import-outside-toplevel
+    from dune_api_scripts.request_budget import BudgetConfig, RequestBudget, budgeted
+    from dune_api_scripts.session import logged_in
+
+    dune: DuneAPI
+    if os.environ.get("DUNE_FAKE"):
+        from dune_api_scripts.fake_dune import dune_from_environment
+
+        dune = dune_from_environment(os.environ["DUNE_FAKE"])
+    else:
+        from duneapi import api
+
+        dune = api.DuneAPI.new_from_environment()
+    if os.environ.get("DUNE_BUDGET", "1") != "0":
+        # Requests of all processes share the budget of the Dune account.
+        budget = RequestBudget(DUNE_DATA_DIR, BudgetConfig.from_environment())
+        dune = budgeted(dune, budget)
+    # Long running processes (the daemon) outlive a single session.
+    return logged_in(dune, float(os.environ.get("DUNE_SESSION_MAX_AGE", 3600)))
@@ -1,15 +1,23 @@
 """
 A collection of fixed dune queries which, when combined make the entire affiliate query.
 """
+from .instrumentation import stage
 from .utils import build_string_for_affiliate_referrals_pairs
 
 
 def build_query_for_affiliate_data(start_date: str, end_date: str) -> str:
-    # TODO - do not pass string representations of dates.
-    # TODO - use proper SQL file for this!
     """
     Returns one large query which fetches affiliate data in given date range.
     """
+    with stage("build_sql") as measurement:
+        query = _affiliate_query(start_date, end_date)
+        measurement.bytes = len(query.encode("utf-8"))
+    return query
+
+
+def _affiliate_query(start_date: str, end_date: str) -> str:
+    # TODO - do not pass string representations of dates.
+    # TODO - use proper SQL file for this!
     query_affiliate = (
         """WITH
     -- first table is representing affiliate inputs from outside of dune
@@ -72,6 +80,7 @@ def build_query_for_affiliate_data(start_date: str, end_date: str) -> str:
         date_trunc('day', block_time) as day,
         count(*) as number_of_trades,
         sum(trade_value_usd) as cowswap_usd_volume,
+        max(block_time) as newest_block_time,
         trader::TEXT as owner
     FROM gnosis_protocol_v2."trades" trades
         where trades.block_time between {start_date} and {end_date}
@@ -103,9 +112,11 @@ def build_query_for_affiliate_data(start_date: str, end_date: str) -> str:
         referrals,
         number_of_trades,
         cowswap_usd_volume,
-        0 as usd_volume_all_exchanges
+        0 as usd_volume_all_exchanges,
         -- This value will be set in the future with a new join of tables. 
         -- It's not yet published here as we don't need it at the beginning.
+        -- Only used to track freshness, stripped before storing (see freshness.py).
+        tr.newest_block_time
     from affiliate_program_results ar
     full outer join user_stats_of_gp tr 
     on ar.referrer = tr.owner and (ar.day = tr.day or ar.day = null or tr.day = null)
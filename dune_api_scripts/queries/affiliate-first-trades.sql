@@ -0,0 +1,12 @@
+-- The first trade of every owner who traded until {{Until}},
+-- used to initialize the state of the local affiliate engine (see affiliate_engine.py).
+select distinct on (trader)
+       Replace(trader::text, '\x', '0x')   as owner,
+       block_time,
+       Replace(tx_hash::text, '\x', '0x')  as tx_hash,
+       evt_index,
+       Replace(app_data::text, '\x', '0x') as app_data,
+       trade_value_usd                     as usd_value
+from gnosis_protocol_v2."trades"
+where block_time <= '{{Until}}'
+order by trader, block_time, evt_index
@@ -0,0 +1,11 @@
+-- All trades settled after {{Since}}, along with the appData of their order.
+-- Consumed by the local affiliate engine (see affiliate_engine.py).
+select Replace(trader::text, '\x', '0x')   as owner,
+       block_time,
+       Replace(tx_hash::text, '\x', '0x')  as tx_hash,
+       evt_index,
+       Replace(app_data::text, '\x', '0x') as app_data,
+       trade_value_usd                     as usd_value
+from gnosis_protocol_v2."trades"
+where block_time > '{{Since}}'
+order by block_time, evt_index
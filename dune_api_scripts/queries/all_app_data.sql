@@ -1,20 +1,27 @@
+-- All distinct appData of trades settled after {{StartTime}},
+-- along with the latest block time they were settled at.
 With trade_call_data_and_hash as (
     SELECT
         jsonb_array_elements(trades) as trade_call_data,
-        "call_tx_hash"
+        "call_tx_hash",
+        call_block_time
     FROM
         gnosis_protocol_v2."GPv2Settlement_call_settle" call
     where
-        call_block_time > '2021-10-09'
+        call_block_time > '{{StartTime}}'
 ),
 decoded_trade_call_data_and_hash as (
     SELECT
         trade_call_data -> 'appData' as appdata,
-        "call_tx_hash"
+        "call_tx_hash",
+        call_block_time
     FROM
         trade_call_data_and_hash
 )
 Select
-    distinct(appdata)
+    appdata,
+    max(call_block_time) as block_time
 from
-    decoded_trade_call_data_and_hash
\ No newline at end of file
+    decoded_trade_call_data_and_hash
+group by
+    appdata
@@ -1,3 +1,3 @@
 CREATE OR REPLACE VIEW
-    dune_user_generated.cow_protocol_raw_app_data_{{Environment}} (hash, content)
+    dune_user_generated.cow_protocol_raw_app_data_{{Environment}}_page_{{Page}} (hash, content)
 AS VALUES {{VALUES}};
\ No newline at end of file
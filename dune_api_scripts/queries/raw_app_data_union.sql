@@ -0,0 +1,4 @@
+CREATE OR REPLACE VIEW
+    dune_user_generated.cow_protocol_raw_app_data_{{Environment}} (hash, content)
+-- Raw app data is split into pages of views, which are all combined here.
+AS ({{RawAppDataPages}});
\ No newline at end of file
@@ -0,0 +1,45 @@
+-- Trading activity of all CoW Protocol users, from which retention on every day
+-- from {{StartDate}} until {{EndDate}} is computed locally (see update/retention_engine.py).
+-- Days are given as number of days since 1970-01-01:
+--   first_trade: day (rounded down) of the trader's first CoW Protocol trade
+--   cow, other:  distinct days (rounded up) with trades on CoW Protocol and on other DEXs,
+--                i.e. the first day on which the trade counts as one of the past {{NumDays}} days
+with
+cow_trades as (
+    select
+        owner          as trader,
+        evt_block_time as block_time
+    from gnosis_protocol_v2."GPv2Settlement_evt_Trade"
+    where evt_block_time between '2021-04-28' and date('{{EndDate}}')
+),
+
+first_trades as (
+    select
+        trader,
+        min(block_time) as block_time
+    from cow_trades
+    group by trader
+)
+
+select trader,
+       'first_trade'                                    as source,
+       floor(extract(epoch from block_time) / 86400)    as day
+from first_trades
+union all
+select distinct
+       trader,
+       'cow'                                            as source,
+       ceil(extract(epoch from block_time) / 86400)     as day
+from cow_trades
+where block_time > date('{{StartDate}}') - interval '{{NumDays}} days'
+union all
+-- Trades on other DEXs are only relevant for CoW Protocol users
+select distinct
+       trader_a                                         as trader,
+       'other'                                          as source,
+       ceil(extract(epoch from dex.trades.block_time) / 86400) as day
+from dex.trades
+join first_trades on trader = trader_a
+where project != 'CoW Protocol'
+  and dex.trades.block_time > date('{{StartDate}}') - interval '{{NumDays}} days'
+  and dex.trades.block_time <= date('{{EndDate}}')
@@ -0,0 +1,75 @@
+-- Retention (as in retention-on-date.sql) of every day from {{StartDate}} until {{EndDate}},
+-- one row per day, so that a range of days is fetched with a single execution.
+with
+days as (
+    select generate_series(date('{{StartDate}}'), date('{{EndDate}}'), interval '1 day') as day
+),
+
+cow_trades as (
+    select
+        owner          as trader,
+        evt_block_time as block_time
+    from gnosis_protocol_v2."GPv2Settlement_evt_Trade"
+    where evt_block_time between '2021-04-28' and date('{{EndDate}}')
+),
+
+-- CowProtocol Users whose first trade was {{NumDays}} days before each day
+counted_traders as (
+    select
+        day,
+        trader
+    from days
+    join (
+        select trader, min(block_time) as first_trade
+        from cow_trades
+        group by trader
+    ) first_trades
+        on first_trade < day - interval '{{NumDays}} days'
+),
+
+-- Users who traded on CowProtocol in the {{NumDays}} days before each day
+cow_recent as (
+    select distinct
+        day,
+        trader
+    from days
+    join cow_trades
+        on block_time > day - interval '{{NumDays}} days'
+        and block_time <= day
+),
+
+-- Users who traded on other dexes in the {{NumDays}} days before each day
+other_recent as (
+    select distinct
+        day,
+        trader_a as trader
+    from days
+    join dex.trades
+        on block_time > day - interval '{{NumDays}} days'
+        and block_time <= day
+    where project != 'CoW Protocol'
+      and trader_a in (select trader from cow_trades)
+),
+
+pre_classification as (
+    select
+        counted_traders.day,
+        cow_recent.trader is not null   as cow_recent,
+        other_recent.trader is not null as other_recent
+    from counted_traders
+    left outer join cow_recent
+        on cow_recent.day = counted_traders.day
+        and cow_recent.trader = counted_traders.trader
+    left outer join other_recent
+        on other_recent.day = counted_traders.day
+        and other_recent.trader = counted_traders.trader
+)
+
+select date(day)                                                                 as day,
+       sum(case when cow_recent and not other_recent then 1 else 0 end)         as retained,
+       sum(case when cow_recent and other_recent then 1 else 0 end)             as hybrid,
+       sum(case when not cow_recent and other_recent then 1 else 0 end)         as lost,
+       sum(case when not cow_recent and not other_recent then 1 else 0 end)     as gone
+from pre_classification
+group by day
+order by day
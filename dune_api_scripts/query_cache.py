@@ -0,0 +1,180 @@
+"""
+Content addressed on-disk cache for Dune query results.
+Entries are keyed by a hash of the query id, the rendered SQL and its parameters.
+Each entry file's modification time is the time the result was fetched
+(used for expiry) and its access time is the time it was last used
+(used for least recently used eviction).
+"""
+from __future__ import annotations
+
+import contextlib
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import TYPE_CHECKING, Optional
+
+from dune_api_scripts.instrumentation import stage
+from dune_api_scripts.utils import open_for_reading, open_for_writing, write_json_stream
+
+if TYPE_CHECKING:
+    from duneapi.api import DuneAPI
+    from duneapi.types import DuneQuery, DuneRecord
+
+DEFAULT_MAX_BYTES = 1024**3
+
+
+class QueryCache:
+    """Caches query results on disk for a given time to live"""
+
+    def __init__(self, path: str | Path, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        os.makedirs(self.path, exist_ok=True)
+
+    @classmethod
+    def from_environment(cls) -> QueryCache:
+        """Constructs the cache living in the dune data folder"""
+        data_dir = os.environ.get("DUNE_DATA_FOLDER", "./data/dune_data")
+        return cls(
+            path=os.path.join(data_dir, "query_cache"),
+            max_bytes=int(os.environ.get("DUNE_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES)),
+        )
+
+    @staticmethod
+    def key(query: DuneQuery) -> str:
+        """Content hash identifying the results of `query`"""
+        content = json.dumps(
+            {
+                "query_id": query.query_id,
+                "raw_sql": query.raw_sql,
+                "network": query.network.value,
+                "parameters": [p.to_dict() for p in query.parameters],
+            },
+            sort_keys=True,
+        )
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def _entry(self, key: str) -> Path:
+        return self.path / f"{key}.json.gz"
+
+    def get(self, query: DuneQuery, ttl: int) -> Optional[list[DuneRecord]]:
+        """Returns the cached results of `query` if fetched at most `ttl` seconds ago"""
+        entry = self.get_with_time(query, ttl)
+        return None if entry is None else entry[0]
+
+    def get_with_time(
+        self, query: DuneQuery, ttl: int
+    ) -> Optional[tuple[list[DuneRecord], float]]:
+        """Same as `get`, along with the time the cached results were fetched"""
+        entry = self._entry(self.key(query))
+        now = time.time()
+        try:
+            fetched_at = entry.stat().st_mtime
+            if now - fetched_at > ttl:
+                return None
+            with stage("cache_read") as measurement, open_for_reading(entry) as file:
+                records: list[DuneRecord] = json.load(file)["records"]
+                measurement.rows = len(records)
+            # Mark entry as recently used, without changing its fetch time.
+            os.utime(entry, (now, fetched_at))
+        except FileNotFoundError:
+            # Entry never existed or was evicted concurrently.
+            return None
+        return records, fetched_at
+
+    def put(self, query: DuneQuery, records: list[DuneRecord]) -> None:
+        """Stores `records` as the results of `query` and evicts old entries"""
+        entry = self._entry(self.key(query))
+        tmp_path = self.path / f".{entry.name}.{uuid.uuid4().hex}.tmp"
+        with stage("cache_write") as measurement:
+            with open_for_writing(tmp_path, compress=True) as file:
+                write_json_stream(
+                    file, "records", records, {"query_id": query.query_id}
+                )
+            os.replace(tmp_path, entry)
+            measurement.rows, measurement.bytes = len(records), entry.stat().st_size
+        self.evict()
+
+    def evict(self) -> None:
+        """Removes least recently used entries until the cache fits into `max_bytes`"""
+        entries = []
+        for entry in self.path.glob("*.json.gz"):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_atime, stat.st_size, entry))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries, key=lambda e: e[0]):
+            if total_size <= self.max_bytes:
+                break
+            entry.unlink(missing_ok=True)
+            total_size -= size
+
+
+def cache_ttl(name: str, default: int) -> int:
+    """Time to live (in seconds) of cached results for query `name`"""
+    return int(os.environ.get(f"DUNE_CACHE_TTL_{name.upper()}", default))
+
+
+def cached_fetch(
+    dune: DuneAPI, query: DuneQuery, ttl: int, cache: Optional[QueryCache] = None
+) -> list[DuneRecord]:
+    """
+    Returns results of `query` from cache when they are at most `ttl` seconds old,
+    otherwise fetches them from Dune and caches them.
+    """
+    return cached_fetch_with_time(dune, query, ttl, cache)[0]
+
+
+def cached_fetch_with_time(
+    dune: DuneAPI, query: DuneQuery, ttl: int, cache: Optional[QueryCache] = None
+) -> tuple[list[DuneRecord], float]:
+    """
+    Same as `cached_fetch`, along with the time the results were downloaded from Dune
+    (for cached results, the time they were cached rather than now).
+    """
+    if ttl <= 0:
+        return fetch(dune, query), time.time()
+    if cache is None:
+        cache = QueryCache.from_environment()
+    cached = cache.get_with_time(query, ttl)
+    if cached is not None:
+        print(f"Using cached results for {query.name}")
+        return cached
+    records = fetch(dune, query)
+    downloaded_at = time.time()
+    cache.put(query, records)
+    return records, downloaded_at
+
+
+def fetch(
+    dune: DuneAPI, query: DuneQuery, submission_lock: Optional[threading.Lock] = None
+) -> list[DuneRecord]:
+    """
+    Same as `dune.fetch`, but with its stages (updating the query, executing it
+    and awaiting the results) instrumented separately.
+    Queries sharing a query id pass a common `submission_lock`, so that updating and
+    executing the query never interleaves (awaiting the results still runs concurrently).
+    Each attempt updates the query again, as others may have replaced it meanwhile.
+    """
+    for _ in range(dune.max_retries):
+        try:
+            with submission_lock or contextlib.nullcontext():
+                with stage("initiate_query"):
+                    dune.initiate_query(query)
+                with stage("execute"):
+                    job_id = dune.execute(query.query_id, query.parameters)
+            with stage("await_results") as measurement:
+                records = dune.get_results(query, job_id)
+                measurement.rows = len(records)
+            return records
+        except RuntimeError as err:
+            print(f"Fetching {query.name} failed with {err}, trying again")
+            dune.login()
+            dune.refresh_auth_token()
+    raise RuntimeError(f"Maximum retries ({dune.max_retries}) exceeded")
@@ -0,0 +1,263 @@
+"""
+A request budget shared by all processes talking to the same Dune account.
+
+Every request to the Dune API takes a token from a token bucket
+(`DUNE_BUDGET_CAPACITY` tokens, refilled at `DUNE_BUDGET_RATE` tokens per second).
+Requests of a job wait while a request of a more urgent job (see `job_priority`)
+is waiting, so that latency critical jobs preempt bulk downloads and backfills.
+Rate limited (429) and failed (5xx) responses make all processes back off
+exponentially, and the request is retried (up to `DUNE_BUDGET_RETRIES` times) once
+the backoff is over, since the client does not check response statuses.
+After `DUNE_BUDGET_FAILURE_THRESHOLD` consecutive failures the circuit opens:
+requests fail immediately for `DUNE_BUDGET_COOLDOWN` seconds.
+The state is kept in `dune_budget.json` in the dune data folder, guarded by a file lock.
+"""
+from __future__ import annotations
+
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import time
+import uuid
+from collections.abc import Callable, Iterator
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any, Optional
+
+import requests
+
+from dune_api_scripts.instrumentation import current_job, stage
+
+if TYPE_CHECKING:
+    from duneapi.api import DuneAPI
+    from duneapi.types import Post
+
+log = logging.getLogger(__name__)
+
+# Lower values are more urgent. Jobs not listed (or run outside of any job) get 2.
+DEFAULT_PRIORITIES = {
+    "todays_trading_data": 0,
+    "app_data_views": 1,
+    "all_distinct_app_data": 1,
+    "retention": 2,
+    "entire_history": 3,
+}
+# Seconds after which the registration of a waiting request expires
+# (e.g. because its process died).
+WAITER_TTL = 5.0
+POLL_INTERVAL = 0.25
+
+
+def job_priority(job: Optional[str]) -> int:
+    """Priority of `job`, configurable via `DUNE_PRIORITY_<JOB NAME>`"""
+    if job is None:
+        return 2
+    return int(
+        os.environ.get(f"DUNE_PRIORITY_{job.upper()}", DEFAULT_PRIORITIES.get(job, 2))
+    )
+
+
+def is_failure(status: Optional[int]) -> bool:
+    """Whether a request failed (None if no response was received)"""
+    return status is None or status == 429 or status >= 500
+
+
+class CircuitOpenError(RuntimeError):
+    """Raised for requests while the circuit is open after repeated failures"""
+
+
+@dataclass
+class BudgetConfig:
+    """Limits of the request budget"""
+
+    capacity: float = 30.0
+    rate: float = 2.0
+    failure_threshold: int = 5
+    cooldown: float = 300.0
+    base_backoff: float = 2.0
+    max_backoff: float = 120.0
+    retries: int = 3
+
+    @classmethod
+    def from_environment(cls) -> BudgetConfig:
+        """Reads the configuration from `DUNE_BUDGET_*` environment variables"""
+        return cls(
+            capacity=float(os.environ.get("DUNE_BUDGET_CAPACITY", 30)),
+            rate=float(os.environ.get("DUNE_BUDGET_RATE", 2)),
+            failure_threshold=int(os.environ.get("DUNE_BUDGET_FAILURE_THRESHOLD", 5)),
+            cooldown=float(os.environ.get("DUNE_BUDGET_COOLDOWN", 300)),
+            base_backoff=float(os.environ.get("DUNE_BUDGET_BASE_BACKOFF", 2)),
+            max_backoff=float(os.environ.get("DUNE_BUDGET_MAX_BACKOFF", 120)),
+            retries=int(os.environ.get("DUNE_BUDGET_RETRIES", 3)),
+        )
+
+
+class RequestBudget:
+    """Token bucket, priorities, backoff and circuit breaker shared via a state file"""
+
+    def __init__(
+        self,
+        data_folder: str,
+        config: BudgetConfig,
+        now: Callable[[], float] = time.time,
+        sleep: Callable[[float], None] = time.sleep,
+    ):
+        self.state_file = os.path.join(data_folder, "dune_budget.json")
+        self.lock_file = os.path.join(data_folder, "dune_budget.lock")
+        os.makedirs(data_folder, exist_ok=True)
+        self.config = config
+        self.now = now
+        self.sleep = sleep
+
+    @contextlib.contextmanager
+    def state(self) -> Iterator[dict[str, Any]]:
+        """
+        The shared state, locked against other processes (and threads,
+        since each one locks its own open file description).
+        """
+        with open(self.lock_file, "a", encoding="utf-8") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(self.state_file, encoding="utf-8") as file:
+                    state = json.load(file)
+            except (FileNotFoundError, json.JSONDecodeError):
+                state = {}
+            now = self.now()
+            elapsed = max(now - state.get("updated_at", now), 0.0)
+            state["tokens"] = min(
+                self.config.capacity,
+                state.get("tokens", self.config.capacity) + elapsed * self.config.rate,
+            )
+            state["updated_at"] = now
+            state["waiters"] = {
+                waiter: entry
+                for waiter, entry in state.get("waiters", {}).items()
+                if entry[1] > now
+            }
+            try:
+                yield state
+            finally:
+                tmp_file = f"{self.state_file}.{os.getpid()}.tmp"
+                with open(tmp_file, "w", encoding="utf-8") as file:
+                    json.dump(state, file)
+                os.replace(tmp_file, self.state_file)
+
+    def acquire(self, priority: int) -> None:
+        """
+        Waits until a token is available to this request, no more urgent request is
+        waiting and no backoff is in effect. Raises `CircuitOpenError` while the
+        circuit is open.
+        """
+        waiter = uuid.uuid4().hex
+        with stage("await_budget"):
+            while True:
+                with self.state() as state:
+                    now = self.now()
+                    if state.get("circuit_open_until", 0) > now:
+                        state["waiters"].pop(waiter, None)
+                        raise CircuitOpenError(
+                            f"Dune requests suspended until {state['circuit_open_until']}"
+                        )
+                    preempted = any(
+                        other_priority < priority
+                        for other, (other_priority, _) in state["waiters"].items()
+                        if other != waiter
+                    )
+                    if (
+                        not preempted
+                        and state.get("backoff_until", 0) <= now
+                        and state["tokens"] >= 1
+                    ):
+                        state["tokens"] -= 1
+                        state["waiters"].pop(waiter, None)
+                        return
+                    state["waiters"][waiter] = [priority, now + WAITER_TTL]
+                    wait = max(
+                        state.get("backoff_until", 0) - now,
+                        (1 - state["tokens"]) / self.config.rate,
+                        0.0,
+                    )
+                self.sleep(min(max(wait, 0.01), POLL_INTERVAL))
+
+    def record(
+        self, status: Optional[int], retry_after: Optional[float] = None
+    ) -> None:
+        """
+        Records the outcome of a request: its status code,
+        or None if no response was received.
+        """
+        with self.state() as state:
+            now = self.now()
+            if not is_failure(status):
+                state["failures"] = 0
+                return
+            state["failures"] = failures = state.get("failures", 0) + 1
+            backoff = min(
+                self.config.base_backoff * 2 ** (failures - 1), self.config.max_backoff
+            )
+            state["backoff_until"] = max(
+                state.get("backoff_until", 0), now + max(backoff, retry_after or 0)
+            )
+            if failures >= self.config.failure_threshold:
+                state["circuit_open_until"] = now + self.config.cooldown
+                log.error(
+                    f"{failures} consecutive Dune request failures, "
+                    f"suspending requests for {self.config.cooldown}s"
+                )
+
+    def request(
+        self, send: Callable[[], requests.Response], priority: int
+    ) -> requests.Response:
+        """
+        Sends a request (via `send`) within the budget and records its outcome.
+        Failed requests are retried up to `retries` times, each retry waiting out
+        the shared backoff (and failing with `CircuitOpenError` once the circuit opens).
+        """
+        attempt = 0
+        while True:
+            self.acquire(priority)
+            try:
+                response = send()
+            except requests.RequestException:
+                self.record(None)
+                if attempt >= self.config.retries:
+                    raise
+            else:
+                retry_after = response.headers.get("Retry-After", "")
+                self.record(
+                    response.status_code,
+                    float(retry_after) if retry_after.isdigit() else None,
+                )
+                if not is_failure(response.status_code) or (
+                    attempt >= self.config.retries
+                ):
+                    return response
+            attempt += 1
+            log.warning(f"Dune request failed, retrying (attempt {attempt + 1})")
+
+
+def budgeted(dune: DuneAPI, budget: RequestBudget) -> DuneAPI:
+    """
+    Makes all requests of `dune` (which are all sent via `post_dune_request`)
+    and its logins go through `budget`, with the priority of the job they are sent for.
+    """
+    send, login = dune.post_dune_request, dune.login
+
+    def post_dune_request(post: Post, is_get: bool = False) -> requests.Response:
+        return budget.request(lambda: send(post, is_get), job_priority(current_job()))
+
+    def budgeted_login() -> None:
+        # A login takes a single token, though it sends a few requests.
+        budget.acquire(job_priority(current_job()))
+        try:
+            login()
+        except requests.RequestException:
+            budget.record(None)
+            raise
+        budget.record(200)
+
+    # Overriding the bound methods of the instance covers all methods calling them.
+    setattr(dune, "post_dune_request", post_dune_request)
+    setattr(dune, "login", budgeted_login)
+    return dune
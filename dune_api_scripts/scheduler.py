@@ -0,0 +1,139 @@
+"""
+A minimal scheduler running jobs periodically on a thread pool,
+sharing a single Dune connection between all of them.
+"""
+from __future__ import annotations
+
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any, Callable, Optional
+
+from dune_api_scripts.utils import write_json_atomically
+
+if TYPE_CHECKING:
+    from duneapi.api import DuneAPI
+
+log = logging.getLogger(__name__)
+
+
+@dataclass
+class JobStats:
+    """Run statistics of a job"""
+
+    runs: int = 0
+    failures: int = 0
+    skipped: int = 0
+    last_duration: Optional[float] = None
+    max_duration: float = 0.0
+    total_duration: float = 0.0
+
+    def record(self, duration: float, failed: bool) -> None:
+        """Records a finished run"""
+        self.runs += 1
+        self.failures += failed
+        self.last_duration = duration
+        self.max_duration = max(self.max_duration, duration)
+        self.total_duration += duration
+
+    def report(self) -> dict[str, Any]:
+        """Run statistics as json compatible dict"""
+        return {
+            "runs": self.runs,
+            "failures": self.failures,
+            "skipped": self.skipped,
+            "last_duration": self.last_duration,
+            "max_duration": self.max_duration,
+            "mean_duration": self.total_duration / self.runs if self.runs else None,
+        }
+
+
+@dataclass
+class Job:
+    """A job executed every `interval` seconds"""
+
+    name: str
+    interval: float
+    run: Callable[[DuneAPI], None]
+    next_run: float = 0.0
+    running: bool = False
+    stats: JobStats = field(default_factory=JobStats)
+
+
+class Scheduler:
+    """
+    Runs each job on its own interval. A job that is still running when it is due
+    again is skipped for that interval, so runs of the same job never overlap.
+    """
+
+    def __init__(
+        self,
+        dune: DuneAPI,
+        jobs: list[Job],
+        data_folder: Optional[str] = None,
+    ):
+        self.dune = dune
+        self.jobs = jobs
+        self.data_folder = data_folder
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max(len(jobs), 1))
+
+    def tick(self, now: float) -> float:
+        """Starts all due jobs and returns the time the next job is due"""
+        with self.lock:
+            for job in self.jobs:
+                if job.next_run > now:
+                    continue
+                job.next_run = now + job.interval
+                if job.running:
+                    log.warning(f"{job.name} is still running, skipping this run")
+                    job.stats.skipped += 1
+                    continue
+                job.running = True
+                self.executor.submit(self._run, job)
+            return min(job.next_run for job in self.jobs)
+
+    def _run(self, job: Job) -> None:
+        log.info(f"Starting {job.name}")
+        start = time.monotonic()
+        failed = False
+        try:
+            job.run(self.dune)
+        except SystemExit:
+            # Scripts exit early when there is nothing to do.
+            log.info(f"{job.name} exited early")
+        except Exception:  # pylint: disable=broad-except
+            failed = True
+            log.exception(f"{job.name} failed")
+        duration = time.monotonic() - start
+        with self.lock:
+            job.running = False
+            job.stats.record(duration, failed)
+            self._write_status()
+        log.info(f"{job.name} finished after {duration:.1f}s")
+
+    def _write_status(self) -> None:
+        status = {
+            job.name: {"interval": job.interval, "running": job.running}
+            | job.stats.report()
+            for job in self.jobs
+        }
+        if self.data_folder is None:
+            log.debug(json.dumps(status))
+            return
+        write_json_atomically(
+            self.data_folder, f"{self.data_folder}/scheduler_status.json", status
+        )
+
+    def run_forever(self) -> None:
+        """Keeps starting jobs as they are due"""
+        while True:
+            next_due = self.tick(time.monotonic())
+            time.sleep(max(next_due - time.monotonic(), 0.0))
+
+    def shutdown(self) -> None:
+        """Waits for all running jobs to finish"""
+        self.executor.shutdown(wait=True)
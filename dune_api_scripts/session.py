@@ -0,0 +1,121 @@
+"""
+Keeps the Dune session of a long running connection alive.
+
+Sessions expire, so the connection logs in again when its session is older than
+`DUNE_SESSION_MAX_AGE` seconds or when fetching the auth token of a request fails
+(after which the request is sent once more). Requests of all threads wait while
+the login is running, as it replaces the cookies and token of the shared session,
+and a login only starts once the requests in flight finished.
+"""
+from __future__ import annotations
+
+import contextlib
+import logging
+import threading
+import time
+from collections.abc import Callable, Iterator
+from typing import TYPE_CHECKING
+
+import requests
+
+if TYPE_CHECKING:
+    from duneapi.api import DuneAPI
+    from duneapi.types import Post
+
+log = logging.getLogger(__name__)
+
+
+def is_auth_failure(error: Exception) -> bool:
+    """Whether `error` was raised by the client failing to fetch an auth token"""
+    return isinstance(error, RuntimeError) and error.args[:1] == (
+        "Failed to fetch auth token",
+    )
+
+
+class DuneSession:
+    """
+    Serialises logins against requests: any number of requests run concurrently,
+    but none while logging in.
+    """
+
+    def __init__(
+        self,
+        login: Callable[[], None],
+        max_age: float,
+        now: Callable[[], float] = time.monotonic,
+    ):
+        self.login = login
+        self.max_age = max_age
+        self.now = now
+        self.condition = threading.Condition()
+        self.active_requests = 0
+        self.logging_in = False
+        # The connection is logged in when it is created.
+        self.logged_in_at = now()
+
+    @contextlib.contextmanager
+    def request(self) -> Iterator[None]:
+        """Context of a request, waiting for any login to finish first"""
+        with self.condition:
+            self.condition.wait_for(lambda: not self.logging_in)
+            self.active_requests += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.active_requests -= 1
+                self.condition.notify_all()
+
+    def refresh(self, logged_in_before: float) -> None:
+        """
+        Logs in again, unless that happened (by another thread) since `logged_in_before`.
+        Must not be called within a request.
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: not self.logging_in)
+            if self.logged_in_at > logged_in_before:
+                return
+            self.logging_in = True
+            self.condition.wait_for(lambda: self.active_requests == 0)
+        try:
+            log.info("Logging in to Dune again")
+            self.login()
+            self.logged_in_at = self.now()
+        finally:
+            with self.condition:
+                self.logging_in = False
+                self.condition.notify_all()
+
+    def refresh_if_expired(self) -> None:
+        """Logs in again if the session is older than `max_age`"""
+        if self.now() - self.logged_in_at > self.max_age:
+            self.refresh(self.now() - self.max_age)
+
+
+def logged_in(dune: DuneAPI, max_age: float) -> DuneAPI:
+    """
+    Makes all requests of `dune` (which are all sent via `post_dune_request`)
+    log in again when the session expired or was rejected.
+    Logins through `dune.login` (e.g. when retrying fetches) are coordinated as well.
+    """
+    session = DuneSession(dune.login, max_age)
+    send = dune.post_dune_request
+
+    def post_dune_request(post: Post, is_get: bool = False) -> requests.Response:
+        session.refresh_if_expired()
+        started = session.now()
+        try:
+            with session.request():
+                return send(post, is_get)
+        except RuntimeError as err:
+            if not is_auth_failure(err):
+                raise
+            log.warning(f"Dune rejected the session ({err}), logging in again")
+        session.refresh(started)
+        with session.request():
+            return send(post, is_get)
+
+    # Overriding the bound methods of the instance covers all methods calling them.
+    setattr(dune, "post_dune_request", post_dune_request)
+    setattr(dune, "login", lambda: session.refresh(session.now()))
+    return dune
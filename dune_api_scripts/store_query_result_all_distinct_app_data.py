@@ -1,36 +1,145 @@
 """
 Queries and stores all distinct app data in a file `distinct_app_data.json`
+
+Only settlements after the block time watermark of the previous run are queried
+(with an overlap of `APP_DATA_OVERLAP` seconds, for settlements indexed late).
+All hashes seen so far are kept in the append only log `app_data_state/hashes.ndjson`,
+and `distinct_app_data.json` is only rewritten when new hashes were found.
 """
+from __future__ import annotations
+
 import json
 import os
 import time
+from datetime import datetime, timedelta
 from pathlib import Path
-from dotenv import load_dotenv
-from duneapi.api import DuneAPI
-from duneapi.types import DuneQuery
+from typing import TYPE_CHECKING, Optional
+
 from duneapi.util import open_query
 
-if __name__ == "__main__":
-    load_dotenv()
-    entire_history_path = Path(os.environ["DUNE_DATA_FOLDER"] + "/app_data/")
-    os.makedirs(entire_history_path, exist_ok=True)
+from dune_api_scripts.freshness import block_timestamp, record_freshness
+from dune_api_scripts.instrumentation import instrumented, stage
+from dune_api_scripts.local_env import dune_connection
+from dune_api_scripts.query_cache import cache_ttl, cached_fetch_with_time
+from dune_api_scripts.utils import (
+    load_json_or_default,
+    open_for_writing,
+    temporary_path,
+    write_json_atomically,
+    write_json_stream,
+)
 
-    # initialize the environment
-    dune = DuneAPI.new_from_environment()
+if TYPE_CHECKING:
+    from duneapi.api import DuneAPI
+    from duneapi.types import DuneQuery, DuneRecord
 
-    # fetch query result id using query id
-    time_of_request = int(time.time())
-    dune_query = DuneQuery(
+# Settlements before carry no app data of interest.
+APP_DATA_START = "2021-10-09 00:00:00"
+
+
+def load_hashes(log_file: Path) -> set[str]:
+    """All hashes of the append only log (one json string per line)"""
+    try:
+        with open(log_file, encoding="utf-8") as file:
+            return {json.loads(line) for line in file if line.strip()}
+    except FileNotFoundError:
+        return set()
+
+
+def append_hashes(log_file: Path, hashes: list[str]) -> None:
+    """Appends `hashes` to the log, making sure they are persisted"""
+    with open(log_file, "a", encoding="utf-8") as file:
+        file.writelines(json.dumps(app_data) + "\n" for app_data in hashes)
+        file.flush()
+        os.fsync(file.fileno())
+
+
+def start_time(watermark: Optional[str], overlap: int) -> str:
+    """Block time to query settlements after"""
+    if watermark is None:
+        return APP_DATA_START
+    since = datetime.fromisoformat(watermark) - timedelta(seconds=overlap)
+    return since.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def write_distinct_app_data(
+    filename: Path, hashes: set[str], time_of_request: int
+) -> None:
+    """Replaces the app data file (read by the service) with all `hashes`"""
+    tmp_file = temporary_path(os.environ["DUNE_DATA_FOLDER"], filename.name)
+    with stage("write_app_data") as measurement, open_for_writing(tmp_file) as file:
+        measurement.rows = write_json_stream(
+            file,
+            "app_data",
+            ({"appdata": app_data_hash} for app_data_hash in sorted(hashes)),
+            {"time_of_download": time_of_request},
+        )
+        measurement.bytes = file.tell()
+    os.replace(tmp_file, filename)
+
+
+def advance_watermark(
+    watermark_file: Path, watermark: Optional[str], rows: list[DuneRecord]
+) -> Optional[str]:
+    """Persists the latest block time of all `rows` as the new watermark and returns it"""
+    block_times = [str(row["block_time"]) for row in rows if row.get("block_time")]
+    if watermark is not None:
+        block_times.append(watermark)
+    if not block_times:
+        return None
+    write_json_atomically(
+        os.environ["DUNE_DATA_FOLDER"],
+        watermark_file,
+        {"block_time": max(block_times)},
+    )
+    return max(block_times)
+
+
+def app_data_query(since: str) -> DuneQuery:
+    """Query of all app data settled after `since`"""
+    # pylint: disable=import-outside-toplevel
+    from duneapi.types import DuneQuery
+
+    return DuneQuery(
         query_id=int(os.getenv("QUERY_ID_ALL_APP_DATA", "142824")),
-        raw_sql=open_query("./dune_api_scripts/queries/all_app_data.sql"),
+        raw_sql=open_query("./dune_api_scripts/queries/all_app_data.sql").replace(
+            "{{StartTime}}", since
+        ),
     )
 
+
+@instrumented("all_distinct_app_data")
+def store_all_distinct_app_data(dune: DuneAPI) -> None:
+    """Fetches all app data settled since the last run and stores it"""
+    data_folder = os.environ["DUNE_DATA_FOLDER"]
+    entire_history_path = Path(data_folder + "/app_data/")
+    state_path = Path(data_folder + "/app_data_state/")
+    os.makedirs(entire_history_path, exist_ok=True)
+    os.makedirs(state_path, exist_ok=True)
+    watermark_file = state_path / "watermark.json"
+    log_file = state_path / "hashes.ndjson"
+
+    watermark = load_json_or_default(watermark_file, {}).get("block_time")
+    since = start_time(watermark, int(os.getenv("APP_DATA_OVERLAP", "3600")))
+    # fetch query result id using query id
+    time_of_request = int(time.time())
+
     # fetch query result
-    app_data = dune.fetch(dune_query)
+    app_data, downloaded_at = cached_fetch_with_time(
+        dune, app_data_query(since), ttl=cache_ttl("all_app_data", 600)
+    )
 
-    # parse dat
-    data_set = {"app_data": app_data, "time_of_download": time_of_request}
+    known = load_hashes(log_file)
+    new_hashes = sorted({row["appdata"] for row in app_data} - known)
+    filename = entire_history_path / "distinct_app_data.json"
+    print(f"Found {len(new_hashes)} new app data since {since}")
+    if new_hashes or not filename.is_file():
+        write_distinct_app_data(filename, known | set(new_hashes), time_of_request)
+        append_hashes(log_file, new_hashes)
 
-    filename = os.path.join(entire_history_path, Path("distinct_app_data.json"))
-    with open(filename, "w+", encoding="utf-8") as f:
-        json.dump(data_set, f, ensure_ascii=False, indent=4)
+    newest = advance_watermark(watermark_file, watermark, app_data)
+    record_freshness("all_distinct_app_data", block_timestamp(newest), downloaded_at)
+
+
+if __name__ == "__main__":
+    store_all_distinct_app_data(dune_connection())
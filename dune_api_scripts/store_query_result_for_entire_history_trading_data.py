@@ -3,49 +3,254 @@ Queries and stores the entire trading history in the file
 `user_data_entire_history.json`.
 Note that this file name is actually hard coded in
 `utils.open_downloaded_history_file`.
+
+The history is downloaded in shards of a few months each, which are fetched
+concurrently and persisted individually (outside of the `user_data` folder
+scanned by the service) before being merged into the final file.
+Shards that were already downloaded by a previous (failed) run are reused,
+except for the open shard ending today, which is downloaded again by every run.
+Once merged, all shards are deleted.
 """
+from __future__ import annotations
+
+import argparse
 import json
 import os
+import threading
 import time
 import datetime
-from duneapi.api import DuneAPI
-from duneapi.types import DuneQuery
-from dotenv import load_dotenv
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import TYPE_CHECKING, Optional
 
+from .binary_snapshot import export_snapshot
+from .freshness import newest_block_time, record_freshness, strip_block_times
+from .instrumentation import in_current_run, instrumented, stage
+from .local_env import dune_connection
 from .queries import build_query_for_affiliate_data
-from .utils import open_downloaded_history_file
+from .query_cache import fetch
+from .utils import (
+    consume,
+    month_windows,
+    open_downloaded_history_file,
+    open_for_reading,
+    open_for_writing,
+    temporary_path,
+    write_json_stream,
+)
+
+if TYPE_CHECKING:
+    from duneapi.api import DuneAPI
+    from duneapi.types import DuneQuery, DuneRecord
+
+HISTORY_START = datetime.date(2021, 3, 1)  # Launch date (approx)
 
 
 def build_query_for_all_trading_data() -> str:
     """
     Constructs query for all time trading data
     """
-    start_date = "'2021-03-01'"  # Launch date (approx)
+    start_date = f"'{HISTORY_START}'"
     today = datetime.date.today()
     # End date will be the midnight between yesterday and today, as hours are cut off
     end_date = f'\'{today.strftime("%Y-%m-%d")}\''
     return build_query_for_affiliate_data(start_date, end_date)
 
 
-if __name__ == "__main__":
-    load_dotenv()
+def shard_file(shard_dir: Path, start: datetime.date, end: datetime.date) -> Path:
+    """
+    Returns the path of the (compressed) shard holding trading data in [start, end).
+    The open shard ending today is named by its start only, as its end moves daily.
+    """
+    if end >= datetime.date.today():
+        return Path(os.path.join(shard_dir, f"user_data_{start}_open.json.gz"))
+    return Path(os.path.join(shard_dir, f"user_data_{start}_{end}.json.gz"))
+
+
+def is_open_shard(shard_path: Path) -> bool:
+    """Whether the shard at `shard_path` ends today (and is still incomplete)"""
+    return shard_path.name.endswith("_open.json.gz")
+
+
+def shard_query(query_id: int, start: datetime.date, end: datetime.date) -> DuneQuery:
+    """Query fetching trading data between `start` and `end`"""
+    # pylint: disable=import-outside-toplevel
+    from duneapi.types import DuneQuery
+
+    return DuneQuery(
+        query_id=query_id,
+        name=f"Trading data from {start} to {end}",
+        raw_sql=build_query_for_affiliate_data(f"'{start}'", f"'{end}'"),
+    )
+
+
+def rows_in_window(
+    data: list[DuneRecord],
+    window: tuple[datetime.date, datetime.date],
+    newest: dict[str, Optional[float]],
+) -> Iterator[DuneRecord]:
+    """
+    Rows of `data` within the half open date `window`, without their block time
+    (the newest of which is kept in `newest`, see `strip_block_times`).
+    """
+    start, end = window
+    # The query filters trades with an inclusive `between`,
+    # so trades at exactly `end` belong to (and are taken from) the next shard.
+    return (
+        row
+        for row in strip_block_times(consume(data), newest)
+        if str(start) <= str(row["day"])[:10] < str(end)
+    )
+
+
+def download_shard(
+    dune: DuneAPI,
+    submission_lock: threading.Lock,
+    query_id: int,
+    window: tuple[datetime.date, datetime.date],
+    shard_path: Path,
+) -> None:
+    """
+    Fetches trading data for the half open date `window` and persists it to `shard_path`.
+    All shards share the same query id, so updating the query and
+    executing it must not interleave with other shards (see `query_cache.fetch`,
+    which also retries failed executions). Awaiting the results happens concurrently.
+    """
+    start, end = window
+    dune_query = shard_query(query_id, start, end)
+    time_of_request = int(time.time())
+    data = fetch(dune, dune_query, submission_lock)
+    newest: dict[str, Optional[float]] = {}
+
+    # Write to temporary file first, so that only complete shards are ever skipped.
+    tmp_path = Path(f"{shard_path}.tmp")
+    with stage("write_shard") as measurement:
+        with open_for_writing(tmp_path, compress=True) as file:
+            measurement.rows = write_json_stream(
+                file,
+                "user_data",
+                rows_in_window(data, window, newest),
+                {"time_of_download": time_of_request, "newest_block_time": newest},
+            )
+        os.replace(tmp_path, shard_path)
+        measurement.bytes = shard_path.stat().st_size
+    print(f"Downloaded {measurement.rows} records from {start} to {end}")
+
+
+def download_missing_shards(
+    dune: DuneAPI,
+    windows: list[tuple[datetime.date, datetime.date]],
+    shard_dir: Path,
+    max_workers: int,
+) -> list[Path]:
+    """Downloads all shards not yet present in `shard_dir`, returns all shard paths"""
+    os.makedirs(shard_dir, exist_ok=True)
+    query_id = int(os.getenv("QUERY_ID_ENTIRE_HISTORY_TRADING_DATA", "157348"))
+    submission_lock = threading.Lock()
+    shard_paths = [shard_file(shard_dir, start, end) for start, end in windows]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(
+                in_current_run(download_shard),
+                dune,
+                submission_lock,
+                query_id,
+                window,
+                shard_path,
+            )
+            for window, shard_path in zip(windows, shard_paths)
+            if is_open_shard(shard_path) or not shard_path.is_file()
+        ]
+        print(f"Downloading {len(futures)} of {len(windows)} shards")
+        for future in futures:
+            future.result()
+    return shard_paths
+
+
+def merge_shards(shard_paths: list[Path], file_entire_history: Path) -> Optional[float]:
+    """
+    Merges the (chronologically ordered) shards into the entire history file,
+    holding only a single shard in memory at a time.
+    The file is replaced atomically, so that neither the service nor a later run
+    (which skips the download if the file exists) ever sees a partial file.
+    Returns the block time of the newest trade of all shards.
+    """
+    fields: dict[str, int] = {}
+    block_times: list[Optional[float]] = []
+
+    def shard_records() -> Iterator[object]:
+        for shard_path in shard_paths:
+            with open_for_reading(shard_path) as file:
+                shard = json.load(file)
+            # The merged history is only as recent as its oldest download.
+            fields["time_of_download"] = min(
+                shard["time_of_download"],
+                fields.get("time_of_download", shard["time_of_download"]),
+            )
+            # Shards downloaded before freshness was tracked lack the block time.
+            block_times.append((shard.get("newest_block_time") or {}).get("block_time"))
+            yield from consume(shard["user_data"])
+
+    tmp_file = temporary_path(os.environ["DUNE_DATA_FOLDER"], file_entire_history.name)
+    with stage("merge_shards") as measurement, open_for_writing(tmp_file) as file:
+        measurement.rows = write_json_stream(file, "user_data", shard_records(), fields)
+        measurement.bytes = file.tell()
+    os.replace(tmp_file, file_entire_history)
+    return newest_block_time(block_times)
+
+
+def remove_shards(shard_dir: Path) -> None:
+    """
+    Removes all shards once they are merged into the entire history file
+    (including those of previous runs, e.g. named after former open shard ends).
+    """
+    for shard_path in shard_dir.glob("user_data_*.json.gz*"):
+        shard_path.unlink(missing_ok=True)
+
+
+def entire_history_args() -> argparse.Namespace:
+    """Arguments used to configure the sharded download"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--months-per-shard",
+        type=int,
+        default=int(os.getenv("ENTIRE_HISTORY_MONTHS_PER_SHARD", "1")),
+    )
+    parser.add_argument(
+        "--max-workers",
+        type=int,
+        default=int(os.getenv("ENTIRE_HISTORY_MAX_WORKERS", "4")),
+    )
+    return parser.parse_args()
+
+
+@instrumented("entire_history")
+def store_entire_history(
+    dune: DuneAPI, months_per_shard: int = 1, max_workers: int = 4
+) -> None:
+    """Downloads missing shards of the entire history and merges them"""
     # Entire history does not need to be downloaded again,
     # if file was already downloaded in the past and exists.
     file_entire_history = open_downloaded_history_file()
 
-    # initialize the environment
-    dune = DuneAPI.new_from_environment()
-
-    # build query
-    time_of_request = int(time.time())
-    dune_query = DuneQuery(
-        query_id=int(os.getenv("QUERY_ID_ENTIRE_HISTORY_TRADING_DATA", "157348")),
-        raw_sql=build_query_for_all_trading_data(),
+    shard_dir = Path(os.environ["DUNE_DATA_FOLDER"] + "/user_data_shards/")
+    # End date will be the midnight between yesterday and today, as hours are cut off
+    shards = download_missing_shards(
+        dune,
+        windows=month_windows(HISTORY_START, datetime.date.today(), months_per_shard),
+        shard_dir=shard_dir,
+        max_workers=max_workers,
     )
+    downloaded_at = time.time()
+    newest = merge_shards(shards, file_entire_history)
+    remove_shards(shard_dir)
+    export_snapshot(os.environ["DUNE_DATA_FOLDER"], file_entire_history)
+    record_freshness("entire_history", newest, downloaded_at)
 
-    # fetch data
-    data = dune.fetch(dune_query)
-    data_set = {"user_data": data, "time_of_download": time_of_request}
 
-    with open(file_entire_history, "w+", encoding="utf-8") as f:
-        json.dump(data_set, f, ensure_ascii=False, indent=4)
+if __name__ == "__main__":
+    args = entire_history_args()
+    # Exits before logging in, if the entire history was already downloaded.
+    open_downloaded_history_file()
+    store_entire_history(dune_connection(), args.months_per_shard, args.max_workers)
@@ -2,43 +2,120 @@
 Queries and stores today's trading history in a file called
 `user_data_from{today's date}.json`.
 Note that this file name is dictated by method `utils.store_as_json_file`.
+The first run after midnight (UTC) also rewrites the file of the previous day,
+so that trades settled in its last minutes are not lost.
 """
-import datetime
+from __future__ import annotations
+
 import os
 import time
-from duneapi.api import DuneAPI
-from duneapi.types import DuneQuery
-from dotenv import load_dotenv
+from collections.abc import Mapping
+from datetime import date, datetime, timedelta, timezone
+from typing import TYPE_CHECKING, Any, Optional
 
-from .utils import store_as_json_file
+from .freshness import record_freshness, strip_block_times
+from .instrumentation import instrumented
+from .local_env import dune_connection
+from .query_cache import cache_ttl, cached_fetch_with_time
+from .utils import consume, date_range, store_as_json_file
 from .queries import build_query_for_affiliate_data
 
+if TYPE_CHECKING:
+    from duneapi.api import DuneAPI
+    from duneapi.types import DuneQuery
+
 JOB_FREQUENCY_IN_MINUTES = 5
+SECONDS_PER_DAY = 24 * 60 * 60
 
 
-def build_query_for_todays_trading_volume() -> str:
+def days_to_query(now: datetime) -> list[date]:
     """
-    Constructs appropriate query for fetching today's trading data.
+    Days (UTC) whose trading data is fetched at `now`: today and, within the first
+    job interval after midnight, also the day before.
     """
-    today = datetime.date.today() - datetime.timedelta(minutes=JOB_FREQUENCY_IN_MINUTES)
-    tomorrow = today + datetime.timedelta(days=1)
-    start_date = f'\'{today.strftime("%Y-%m-%d")}\''
-    end_date = f'\'{tomorrow.strftime("%Y-%m-%d")}\''
+    now = now.astimezone(timezone.utc)
+    lagged = now - timedelta(minutes=JOB_FREQUENCY_IN_MINUTES)
+    return date_range(lagged.date(), now.date())
+
+
+def day_timestamp(day: date) -> int:
+    """Timestamp of the start (UTC) of `day`, as used in user data file names"""
+    return int(datetime(day.year, day.month, day.day, tzinfo=timezone.utc).timestamp())
+
+
+def row_day(row: Mapping[str, Any]) -> date:
+    """Day of a row of the affiliate query (e.g. `2021-10-18T00:00:00+00:00`)"""
+    return datetime.fromisoformat(str(row["day"])).date()
+
+
+def build_query_for_todays_trading_volume(now: Optional[datetime] = None) -> str:
+    """
+    Constructs appropriate query for fetching today's trading data
+    (along with yesterday's shortly after midnight, see `days_to_query`).
+    """
+    days = days_to_query(now or datetime.now(timezone.utc))
+    start_date = f"'{days[0]:%Y-%m-%d}'"
+    end_date = f"'{days[-1] + timedelta(days=1):%Y-%m-%d}'"
 
     return build_query_for_affiliate_data(start_date, end_date)
 
 
-if __name__ == "__main__":
-    load_dotenv()
-    # initialize the environment
-    dune = DuneAPI.new_from_environment()
+def todays_trading_data_query(now: datetime) -> DuneQuery:
+    """Query of the trading data of the days to fetch at `now`"""
+    # pylint: disable=import-outside-toplevel
+    from duneapi.types import DuneQuery
 
-    time_of_request = int(time.time())
-    dune_query = DuneQuery(
+    return DuneQuery(
         query_id=int(os.getenv("QUERY_ID_TODAYS_TRADING_DATA", "249240")),
-        raw_sql=build_query_for_todays_trading_volume(),
+        raw_sql=build_query_for_todays_trading_volume(now),
+    )
+
+
+def store_todays_trading_data_locally(dune: DuneAPI) -> None:
+    """
+    Computes today's trading data with the local affiliate engine,
+    only fetching the trades since its previous run.
+    """
+    # pylint: disable=import-outside-toplevel
+    from .affiliate_engine import update_affiliate_state
+
+    time_of_request = int(time.time())
+    today = time_of_request // SECONDS_PER_DAY
+    keep_days = int(os.getenv("AFFILIATE_KEEP_DAYS", "2"))
+    state = update_affiliate_state(
+        dune,
+        data_folder=os.environ.get("DUNE_DATA_FOLDER", "./data/dune_data"),
+        overlap=int(os.getenv("AFFILIATE_TRADES_OVERLAP", str(30 * 60))),
+        keep_days=keep_days,
     )
+    downloaded_at = time.time()
+    # Trades ingested late (e.g. after midnight) also update the files of earlier days.
+    for day in sorted(state.changed_days | {today}):
+        if day >= today - keep_days:
+            store_as_json_file(state.rows(day), time_of_request, day * SECONDS_PER_DAY)
+    record_freshness("todays_trading_data", state.watermark, downloaded_at)
+
+
+@instrumented("todays_trading_data")
+def store_todays_trading_data(dune: DuneAPI) -> None:
+    """Fetches today's trading data and stores it"""
+    if os.getenv("TODAYS_TRADING_DATA_LOCAL") == "1":
+        store_todays_trading_data_locally(dune)
+        return
+    time_of_request = int(time.time())
+    now = datetime.fromtimestamp(time_of_request, tz=timezone.utc)
     # fetch data
-    data = dune.fetch(dune_query)
-    data_set = {"user_data": data, "time_of_download": time_of_request}
-    store_as_json_file(data_set)
+    data, downloaded_at = cached_fetch_with_time(
+        dune, todays_trading_data_query(now), ttl=cache_ttl("todays_trading_data", 60)
+    )
+    newest: dict[str, Optional[float]] = {}
+    rows_by_day: dict[date, list[Any]] = {day: [] for day in days_to_query(now)}
+    for row in strip_block_times(consume(data), newest):
+        rows_by_day.setdefault(row_day(row), []).append(row)
+    for day, rows in rows_by_day.items():
+        store_as_json_file(consume(rows), time_of_request, day_timestamp(day))
+    record_freshness("todays_trading_data", newest["block_time"], downloaded_at)
+
+
+if __name__ == "__main__":
+    store_todays_trading_data(dune_connection())
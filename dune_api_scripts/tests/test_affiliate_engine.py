@@ -0,0 +1,144 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from .. import affiliate_engine
+from ..affiliate_engine import AffiliateState, day_string, fetch_trades
+
+REFERRER = "0x" + "ee" * 20
+REFERRERS = {"0xreferral": "\\x" + "ee" * 20, "0xplain": None}
+DAY = 19000
+
+
+def trade(owner, seconds, index, usd_value, app_data="0xplain"):
+    hours, minutes = divmod(seconds // 60, 60)
+    return {
+        "owner": owner,
+        "block_time": f"2022-01-08T{hours:02d}:{minutes:02d}:{seconds % 60:02d}+00:00",
+        "tx_hash": f"0xtx{seconds}",
+        "evt_index": index,
+        "app_data": app_data,
+        "usd_value": usd_value,
+    }
+
+
+TRADES = [
+    trade("0xa", 60, 0, 10.0, app_data="0xreferral"),
+    trade("0xa", 120, 1, 5.0),
+    trade("0xb", 180, 0, 1.0),
+    trade("0xc", 240, 0, None, app_data="0xreferral"),
+    trade("0xc", 3600, 2, 2.5),
+]
+
+
+class TestAffiliateState(unittest.TestCase):
+    def test_rows_have_query_shape(self):
+        state = AffiliateState()
+        self.assertEqual(state.ingest(TRADES, REFERRERS, overlap=600), 5)
+        self.assertEqual(
+            state.rows(DAY),
+            [
+                {
+                    "owner": "0xa",
+                    "day": day_string(DAY),
+                    "total_referred_volume": None,
+                    "referrals": [],
+                    "number_of_trades": 2,
+                    "cowswap_usd_volume": 15.0,
+                    "usd_volume_all_exchanges": 0,
+                },
+                {
+                    "owner": "0xb",
+                    "day": day_string(DAY),
+                    "total_referred_volume": None,
+                    "referrals": [],
+                    "number_of_trades": 1,
+                    "cowswap_usd_volume": 1.0,
+                    "usd_volume_all_exchanges": 0,
+                },
+                {
+                    "owner": "0xc",
+                    "day": day_string(DAY),
+                    "total_referred_volume": None,
+                    "referrals": [],
+                    "number_of_trades": 2,
+                    "cowswap_usd_volume": 2.5,
+                    "usd_volume_all_exchanges": 0,
+                },
+                {
+                    "owner": REFERRER,
+                    "day": day_string(DAY),
+                    "total_referred_volume": 17.5,
+                    "referrals": ["0xa", "0xc"],
+                    "number_of_trades": None,
+                    "cowswap_usd_volume": None,
+                    "usd_volume_all_exchanges": 0,
+                },
+            ],
+        )
+        self.assertEqual(day_string(DAY), "2022-01-08T00:00:00+00:00")
+
+    def test_incremental_ingestion_with_overlap(self):
+        batch = AffiliateState()
+        batch.ingest(TRADES, REFERRERS, overlap=600)
+        incremental = AffiliateState()
+        self.assertEqual(incremental.ingest(TRADES[:3], REFERRERS, overlap=600), 3)
+        # Overlapping trades are only counted once.
+        self.assertEqual(incremental.ingest(TRADES[1:], REFERRERS, overlap=600), 2)
+        self.assertEqual(incremental.rows(DAY), batch.rows(DAY))
+        self.assertEqual(incremental.watermark, batch.watermark)
+        # Only trades within the overlap are remembered.
+        self.assertEqual(list(incremental.recent_trades), ["0xtx3600/2"])
+
+    def test_referrers_resolved_later(self):
+        state = AffiliateState()
+        state.ingest(TRADES, {}, overlap=600)
+        self.assertEqual(len(state.rows(DAY)), 3)
+        state.resolve_referrers(REFERRERS)
+        referrer_row = state.rows(DAY)[-1]
+        self.assertEqual(referrer_row["owner"], REFERRER)
+        self.assertEqual(referrer_row["total_referred_volume"], 17.5)
+
+    def test_persistence(self):
+        state = AffiliateState()
+        state.ingest(TRADES, REFERRERS, overlap=600)
+        with tempfile.TemporaryDirectory() as data_folder:
+            path = os.path.join(data_folder, "affiliate_state.json.gz")
+            state.save(data_folder, path)
+            loaded = AffiliateState.load(path)
+        self.assertEqual(loaded.rows(DAY), state.rows(DAY))
+        self.assertEqual(loaded.owners, state.owners)
+        self.assertEqual(loaded.recent_trades, state.recent_trades)
+        loaded.prune(DAY + 1)
+        self.assertEqual(loaded.rows(DAY), [])
+
+    def test_changed_days(self):
+        state = AffiliateState()
+        state.ingest(TRADES, REFERRERS, overlap=600)
+        self.assertEqual(state.changed_days, {DAY})
+        late = trade("0xd", 86400 + 60, 0, 1.0)
+        late["block_time"] = "2022-01-09T00:01:00+00:00"
+        state.changed_days.clear()
+        state.ingest([late], REFERRERS, overlap=600)
+        self.assertEqual(state.changed_days, {DAY + 1})
+
+
+class TestFetchTrades(unittest.TestCase):
+    @mock.patch.object(affiliate_engine, "cached_fetch", return_value=TRADES)
+    def test_fetches_via_cache_at_own_query(self, cached_fetch):
+        with mock.patch.dict(os.environ, {"QUERY_ID_AFFILIATE_TRADES": "42"}):
+            trades = fetch_trades("dune", "affiliate-trades.sql", "Since", 0)
+        self.assertEqual(trades, TRADES)
+        query = cached_fetch.call_args[0][1]
+        self.assertEqual(query.query_id, 42)
+        self.assertIn("1970-01-01 00:00:00", query.raw_sql)
+
+    def test_requires_query_id(self):
+        with mock.patch.dict(os.environ), self.assertRaises(KeyError):
+            os.environ.pop("QUERY_ID_AFFILIATE_TRADES", None)
+            fetch_trades("dune", "affiliate-trades.sql", "Since", 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,25 @@
+import unittest
+
+from ..benchmarks import BENCHMARKS, Measurement, regressions, run_benchmarks
+
+
+class TestBenchmarks(unittest.TestCase):
+    def test_all_paths_run(self):
+        results = run_benchmarks([100], list(BENCHMARKS))
+        self.assertEqual(set(results), set(BENCHMARKS))
+        for by_size in results.values():
+            self.assertGreater(by_size["100"].rows_per_second, 0)
+            self.assertGreater(by_size["100"].peak_bytes, 0)
+
+    def test_regressions(self):
+        baseline = {"path": {"100": {"rows_per_second": 1000, "peak_bytes": 1000}}}
+        within = {"path": {"100": Measurement(rows_per_second=700, peak_bytes=1400)}}
+        self.assertEqual(regressions(within, baseline, threshold=1.5), [])
+        slower = {"path": {"100": Measurement(rows_per_second=600, peak_bytes=1600)}}
+        self.assertEqual(len(regressions(slower, baseline, threshold=1.5)), 2)
+        # Paths and sizes without baseline are not compared.
+        self.assertEqual(regressions(slower, {}, threshold=1.5), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+import io
+import json
+import os
+import random
+import tempfile
+import unittest
+
+from ..binary_snapshot import (
+    BinarySnapshot,
+    export_snapshot,
+    snapshot_path,
+    verify_snapshot,
+    write_snapshot,
+)
+
+
+def random_rows(rng, size):
+    owners = [f"0x{rng.getrandbits(160):040x}" for _ in range(size // 3 + 1)]
+    return [
+        {
+            "owner": rng.choice(owners),
+            "day": f"2022-03-{1 + i % 28:02d}T00:00:00+00:00",
+            "total_referred_volume": rng.random() if i % 4 == 0 else None,
+            "referrals": rng.sample(owners, min(2, len(owners))) if i % 4 == 0 else [],
+            "number_of_trades": rng.randint(1, 9) if i % 7 else None,
+            "cowswap_usd_volume": rng.random() * 1000,
+            "usd_volume_all_exchanges": 0,
+        }
+        for i in range(size)
+    ]
+
+
+class TestBinarySnapshot(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.json_path = os.path.join(self.folder.name, "user_data_from1.json")
+        self.rows = random_rows(random.Random(1), 500)
+        with open(self.json_path, "w", encoding="utf-8") as file:
+            json.dump({"user_data": self.rows, "time_of_download": 1234}, file)
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_round_trip_matches_json(self):
+        os.environ["USER_DATA_BINARY"] = "1"
+        try:
+            path = export_snapshot(self.folder.name, self.json_path, verify=True)
+        finally:
+            del os.environ["USER_DATA_BINARY"]
+        self.assertEqual(path, snapshot_path(self.folder.name, self.json_path))
+
+        with BinarySnapshot(path) as snapshot:
+            self.assertEqual(snapshot.time_of_download, 1234)
+            owners = {row["owner"] for row in self.rows}
+            for owner in owners:
+                self.assertEqual(
+                    snapshot.lookup(owner),
+                    [row for row in self.rows if row["owner"] == owner],
+                )
+            self.assertEqual(snapshot.lookup("0x" + "00" * 20), [])
+            self.assertEqual(snapshot.lookup("0x" + "ff" * 20), [])
+
+    def test_detects_differences(self):
+        path = os.path.join(self.folder.name, "snapshot.bin")
+        self.rows[3]["number_of_trades"] = 42
+        with open(path, "wb") as file:
+            write_snapshot(file, self.rows, 1234)
+        with self.assertRaises(ValueError):
+            verify_snapshot(self.json_path, path)
+
+    def test_disabled_by_default(self):
+        self.assertIsNone(export_snapshot(self.folder.name, self.json_path))
+
+    def test_empty_snapshot(self):
+        buffer = io.BytesIO()
+        self.assertEqual(write_snapshot(buffer, [], 0), len(buffer.getvalue()))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,178 @@
+import json
+import os
+import tempfile
+import unittest
+from datetime import datetime, timezone
+from unittest import mock
+from pathlib import Path
+
+from .. import compact_user_data as compaction
+from .. import store_query_result_for_todays_trading_data as todays_trading_data
+from ..compact_user_data import compact_user_data
+
+DAY = 24 * 60 * 60
+# 2022-03-30
+FIRST_DAY = 19081 * DAY
+
+
+def iso_day(day):
+    return datetime.fromtimestamp(day, tz=timezone.utc).isoformat()
+
+
+def row(owner, day, trades):
+    return {
+        "owner": owner,
+        "day": day,
+        "number_of_trades": trades,
+        "cowswap_usd_volume": 1.0,
+        "total_referred_volume": None,
+        "referrals": [],
+    }
+
+
+class TestCompactUserData(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.user_data = Path(self.folder.name) / "user_data"
+        self.state = Path(self.folder.name) / "user_data_state"
+        os.makedirs(self.user_data)
+        os.makedirs(self.state)
+        patcher = mock.patch.dict(
+            os.environ,
+            {"DUNE_DATA_FOLDER": self.folder.name, "AFFILIATE_KEEP_DAYS": "1"},
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def write(self, name, rows, time_of_download):
+        with open(self.user_data / name, "w", encoding="utf-8") as file:
+            json.dump({"user_data": rows, "time_of_download": time_of_download}, file)
+
+    def read(self, name):
+        with open(self.user_data / name, encoding="utf-8") as file:
+            return json.load(file)
+
+    def test_compacts_closed_days_into_monthly_snapshots(self):
+        days = [FIRST_DAY + i * DAY for i in range(4)]
+        self.write("user_data_entire_history.json", [row("0xa", "d0", 1)], 1)
+        self.write(f"user_data_from{days[0]}.json", [row("0xa", "d0", 1)], days[0])
+        # Later download of the same (owner, day) wins.
+        self.write(
+            f"user_data_from{days[1]}.json",
+            [row("0xa", "d0", 2), row("0xb", "d1", 1)],
+            days[1],
+        )
+        # April
+        self.write(f"user_data_from{days[2]}.json", [row("0xc", "d2", 1)], days[2])
+        self.write(f"user_data_from{days[3]}.json", [row("0xd", "d3", 1)], days[3])
+        (self.state / f"user_data_from{days[0]}.digests.json").write_text("{}")
+
+        # The previous day may still be rewritten, so it is kept.
+        compact_user_data(self.folder.name, today=days[3] + DAY)
+
+        self.assertEqual(
+            sorted(os.listdir(self.user_data)),
+            [
+                "user_data_entire_history.json",
+                f"user_data_from{days[3]}.json",
+                "user_data_snapshot_2022-03.json",
+                "user_data_snapshot_2022-04.json",
+            ],
+        )
+        march = self.read("user_data_snapshot_2022-03.json")
+        self.assertEqual(march["time_of_download"], days[1])
+        self.assertEqual(
+            sorted(march["user_data"], key=lambda r: r["owner"]),
+            [row("0xa", "d0", 2), row("0xb", "d1", 1)],
+        )
+        self.assertEqual(os.listdir(self.state), [])
+
+        # A late file of a compacted month is merged into its snapshot.
+        self.write(f"user_data_from{days[2]}.json", [row("0xc", "d2", 5)], days[2] + 1)
+        compact_user_data(self.folder.name, today=days[3] + DAY)
+        april = self.read("user_data_snapshot_2022-04.json")
+        self.assertEqual(april["user_data"], [row("0xc", "d2", 5)])
+        self.assertEqual(april["time_of_download"], days[2] + 1)
+
+    def test_snapshot_is_never_served_along_with_its_daily_files(self):
+        days = [FIRST_DAY + i * DAY for i in range(3)]
+        for i, day in enumerate(days):
+            self.write(f"user_data_from{day}.json", [row(f"0x{i}", "d", 1)], day)
+        retire = compaction.retire
+
+        def checked_retire(data_folder, daily_file):
+            self.assertNotIn(
+                "user_data_snapshot_2022-03.json", os.listdir(self.user_data)
+            )
+            retire(data_folder, daily_file)
+
+        with mock.patch.object(compaction, "retire", side_effect=checked_retire):
+            compact_user_data(self.folder.name, today=days[2] + DAY)
+        self.assertEqual(self.owner_totals(), {"0x0": 1, "0x1": 1, "0x2": 1})
+
+    def test_interrupted_compaction_is_completed(self):
+        days = [FIRST_DAY + i * DAY for i in range(2)]
+        for i, day in enumerate(days):
+            self.write(f"user_data_from{day}.json", [row(f"0x{i}", "d", 1)], day)
+        with mock.patch.object(
+            compaction, "publish_snapshot", side_effect=RuntimeError("killed")
+        ), self.assertRaises(RuntimeError):
+            compact_user_data(self.folder.name, today=days[1] + 2 * DAY)
+        # Nothing was served twice (or lost) meanwhile.
+        self.assertEqual(self.owner_totals(), {"0x0": 1, "0x1": 1})
+
+        compact_user_data(self.folder.name, today=days[1] + 2 * DAY)
+        self.assertEqual(
+            os.listdir(self.user_data), ["user_data_snapshot_2022-03.json"]
+        )
+        self.assertEqual(self.owner_totals(), {"0x0": 1, "0x1": 1})
+        staging = Path(self.folder.name) / "user_data_compaction"
+        self.assertEqual(os.listdir(staging), [])
+
+    def owner_totals(self):
+        totals = {}
+        for name in os.listdir(self.user_data):
+            for record in self.read(name)["user_data"]:
+                totals[record["owner"]] = (
+                    totals.get(record["owner"], 0) + record["number_of_trades"]
+                )
+        return totals
+
+    def test_days_rewritten_after_midnight_are_not_counted_twice(self):
+        today = FIRST_DAY + 3 * DAY
+        day_before, yesterday = today - 2 * DAY, today - DAY
+        self.write(
+            f"user_data_from{day_before}.json",
+            [row("0xa", iso_day(day_before), 1)],
+            day_before,
+        )
+        # Written shortly before midnight, missing the last trade of the day.
+        self.write(
+            f"user_data_from{yesterday}.json",
+            [row("0xa", iso_day(yesterday), 2)],
+            today,
+        )
+        just_after_midnight = today + 3 * 60
+        compact_user_data(self.folder.name, today=today)
+
+        rows = [row("0xa", iso_day(yesterday), 3), row("0xa", iso_day(today), 1)]
+        with mock.patch.object(
+            todays_trading_data, "build_query_for_affiliate_data", return_value=""
+        ), mock.patch.object(
+            todays_trading_data,
+            "cached_fetch_with_time",
+            return_value=(rows, just_after_midnight),
+        ), mock.patch(
+            "time.time", return_value=just_after_midnight
+        ):
+            todays_trading_data.store_todays_trading_data(None)
+        compact_user_data(self.folder.name, today=today)
+
+        self.assertEqual(self.owner_totals(), {"0xa": 5})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,91 @@
+import datetime
+import json
+import os
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from .. import store_query_result_for_entire_history_trading_data as entire_history
+from ..store_query_result_for_entire_history_trading_data import (
+    HISTORY_START,
+    merge_shards,
+    shard_file,
+    store_entire_history,
+)
+from ..utils import month_windows, open_for_writing
+
+
+class TestMergeShards(unittest.TestCase):
+    def setUp(self):
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        self.folder = Path(folder.name)
+        patch = mock.patch.dict(os.environ, {"DUNE_DATA_FOLDER": folder.name})
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.history = self.folder / "user_data_entire_history.json"
+        self.shard = self.folder / "shard.json.gz"
+        with open_for_writing(self.shard, compress=True) as file:
+            json.dump({"user_data": [{"owner": "0xa"}], "time_of_download": 1}, file)
+
+    def test_merged_file(self):
+        merge_shards([self.shard], self.history)
+        with open(self.history, encoding="utf-8") as file:
+            self.assertEqual(
+                json.load(file),
+                {"user_data": [{"owner": "0xa"}], "time_of_download": 1},
+            )
+
+    def test_failed_merge_leaves_no_partial_file(self):
+        broken = self.folder / "broken.json.gz"
+        with open_for_writing(broken, compress=True) as file:
+            file.write('{"user_data": [')
+        with self.assertRaises(ValueError):
+            merge_shards([self.shard, broken], self.history)
+        self.assertFalse(self.history.exists())
+
+
+class TestStoreEntireHistory(unittest.TestCase):
+    def setUp(self):
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        self.folder = Path(folder.name)
+        patch = mock.patch.dict(os.environ, {"DUNE_DATA_FOLDER": folder.name})
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.shard_dir = self.folder / "user_data_shards"
+        os.makedirs(self.shard_dir)
+
+    def write_shard(self, path, owner):
+        with open_for_writing(path, compress=True) as file:
+            json.dump({"user_data": [{"owner": owner}], "time_of_download": 1}, file)
+
+    @mock.patch.object(
+        entire_history, "build_query_for_affiliate_data", return_value="select 1"
+    )
+    @mock.patch.object(entire_history, "fetch", return_value=[])
+    def test_open_shard_is_downloaded_again_and_shards_are_removed(self, fetch, _build):
+        today = datetime.date.today()
+        windows = month_windows(HISTORY_START, today, 12)
+        closed, open_shard = windows[0], windows[-1]
+        self.write_shard(shard_file(self.shard_dir, *closed), "0xclosed")
+        # The open shard of a previous run, and one named after its former end.
+        self.write_shard(shard_file(self.shard_dir, *open_shard), "0xstale")
+        orphan = self.shard_dir / f"user_data_{open_shard[0]}_{open_shard[0]}.json.gz"
+        self.write_shard(orphan, "0xorphan")
+
+        store_entire_history(None, months_per_shard=12, max_workers=1)
+
+        fetched = [call.args[1].name for call in fetch.call_args_list]
+        self.assertEqual(len(fetched), len(windows) - 1)
+        self.assertNotIn(f"Trading data from {closed[0]} to {closed[1]}", fetched)
+        self.assertIn(f"Trading data from {open_shard[0]} to {today}", fetched)
+        history = self.folder / "user_data" / "user_data_entire_history.json"
+        with open(history, encoding="utf-8") as file:
+            self.assertEqual(json.load(file)["user_data"], [{"owner": "0xclosed"}])
+        self.assertEqual(os.listdir(self.shard_dir), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
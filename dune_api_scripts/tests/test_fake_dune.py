@@ -0,0 +1,142 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import requests
+from duneapi.types import DuneQuery
+
+from ..fake_dune import (
+    FakeDuneAPI,
+    FakeDuneConfig,
+    MissingRecording,
+    recording_path,
+    scale_rows,
+)
+from ..store_query_result_all_distinct_app_data import (
+    app_data_query,
+    store_all_distinct_app_data,
+)
+from ..update.utils import ViewUpdate, refresh_all
+from ..utils import open_for_writing
+
+OWNER = "0x" + "ab" * 20
+APP_DATA_QUERY_ID = 1
+
+
+def record(folder, query, rows):
+    with open_for_writing(recording_path(folder, query), compress=True) as file:
+        json.dump(rows, file)
+
+
+class TestFakeDune(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.addCleanup(self.folder.cleanup)
+        record(self.folder.name, self.query(), [{"owner": OWNER, "volume": 1}])
+
+    def query(self, query_id=7, raw_sql="select 1"):
+        return DuneQuery(query_id=query_id, raw_sql=raw_sql, name="Test")
+
+    def test_replays_recordings(self):
+        dune = FakeDuneAPI(FakeDuneConfig(recordings=self.folder.name))
+        self.assertEqual(dune.fetch(self.query()), [{"owner": OWNER, "volume": 1}])
+        # Queries without recording fail instead of returning no rows.
+        with self.assertRaises(MissingRecording):
+            dune.fetch(self.query(query_id=8))
+        with self.assertRaises(MissingRecording):
+            dune.fetch(self.query(raw_sql="select 2"))
+
+    def test_recordings_are_keyed_by_sql(self):
+        # Different queries share query ids, e.g. the affiliate query of each day.
+        record(self.folder.name, self.query(raw_sql="select 2"), [{"volume": 2}])
+        dune = FakeDuneAPI(FakeDuneConfig(recordings=self.folder.name))
+        self.assertEqual(dune.fetch(self.query(raw_sql="select 2")), [{"volume": 2}])
+        self.assertEqual(dune.fetch(self.query()), [{"owner": OWNER, "volume": 1}])
+
+    def test_scales_rows(self):
+        rows = scale_rows([{"owner": OWNER, "volume": 1}], 3)
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(rows[0]["owner"], OWNER)
+        self.assertEqual(len({row["owner"] for row in rows}), 3)
+        self.assertTrue(all(len(row["owner"]) == 42 for row in rows))
+        dune = FakeDuneAPI(FakeDuneConfig(recordings=self.folder.name, rows=1000))
+        self.assertEqual(len(dune.fetch(self.query())), 1000)
+
+    def test_injects_failures(self):
+        failing = FakeDuneAPI(FakeDuneConfig(self.folder.name, error_rate=1.0))
+        report = refresh_all(failing, [ViewUpdate("view", self.query())], 0)
+        self.assertIn("Injected execution failure", report.failed["view"])
+        timing_out = FakeDuneAPI(FakeDuneConfig(self.folder.name, timeout_rate=1.0))
+        with self.assertRaises(requests.Timeout):
+            timing_out.fetch(self.query())
+
+    def test_latency(self):
+        dune = FakeDuneAPI(FakeDuneConfig(self.folder.name, latency=0.05))
+        report = refresh_all(dune, [ViewUpdate("view", self.query())], 0.01)
+        self.assertEqual(report.succeeded, ["view"])
+
+    def test_store_script_end_to_end(self):
+        dune = FakeDuneAPI(FakeDuneConfig(recordings=self.folder.name))
+        environment = {
+            "DUNE_DATA_FOLDER": self.folder.name,
+            "QUERY_ID_ALL_APP_DATA": str(APP_DATA_QUERY_ID),
+        }
+        with mock.patch.dict(os.environ, environment):
+            record(
+                self.folder.name,
+                app_data_query("2021-10-09 00:00:00"),
+                [{"appdata": '"0x01"'}],
+            )
+            store_all_distinct_app_data(dune)
+        path = os.path.join(self.folder.name, "app_data", "distinct_app_data.json")
+        with open(path, encoding="utf-8") as file:
+            self.assertEqual(json.load(file)["app_data"], [{"appdata": '"0x01"'}])
+
+    def test_app_data_is_downloaded_incrementally(self):
+        dune = FakeDuneAPI(FakeDuneConfig(recordings=self.folder.name))
+        environment = {
+            "DUNE_DATA_FOLDER": self.folder.name,
+            "QUERY_ID_ALL_APP_DATA": str(APP_DATA_QUERY_ID),
+            "DUNE_CACHE_TTL_ALL_APP_DATA": "0",
+            "APP_DATA_OVERLAP": "60",
+        }
+        path = os.path.join(self.folder.name, "app_data", "distinct_app_data.json")
+        with mock.patch.dict(os.environ, environment), mock.patch.object(
+            dune, "initiate_query", wraps=dune.initiate_query
+        ) as initiate_query:
+            record(
+                self.folder.name,
+                app_data_query("2021-10-09 00:00:00"),
+                [{"appdata": '"0x02"', "block_time": "2022-03-01T12:00:00+00:00"}],
+            )
+            store_all_distinct_app_data(dune)
+            self.assertIn(
+                "> '2021-10-09 00:00:00'", initiate_query.call_args[0][0].raw_sql
+            )
+
+            record(
+                self.folder.name,
+                app_data_query("2022-03-01 11:59:00"),
+                [
+                    {"appdata": '"0x02"', "block_time": "2022-03-01T12:00:00+00:00"},
+                    {"appdata": '"0x01"', "block_time": "2022-03-02T12:00:00+00:00"},
+                ],
+            )
+            store_all_distinct_app_data(dune)
+            self.assertIn(
+                "> '2022-03-01 11:59:00'", initiate_query.call_args[0][0].raw_sql
+            )
+        with open(path, encoding="utf-8") as file:
+            self.assertEqual(
+                json.load(file)["app_data"],
+                [{"appdata": '"0x01"'}, {"appdata": '"0x02"'}],
+            )
+        log = os.path.join(self.folder.name, "app_data_state", "hashes.ndjson")
+        with open(log, encoding="utf-8") as file:
+            self.assertEqual(file.read().split(), ['"\\"0x02\\""', '"\\"0x01\\""'])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from ..freshness import (
+    block_timestamp,
+    percentile,
+    record_freshness,
+    stale_jobs,
+    strip_block_times,
+)
+
+NOON = block_timestamp("2022-01-08T12:00:00+00:00")
+
+
+class TestFreshness(unittest.TestCase):
+    def setUp(self):
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        self.folder = folder.name
+        patch = mock.patch.dict(
+            os.environ, {"DUNE_DATA_FOLDER": self.folder, "FRESHNESS_LOG_SIZE": "3"}
+        )
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_block_times_are_stripped(self):
+        rows = [
+            {"owner": "0xa", "newest_block_time": "2022-01-08T11:00:00+00:00"},
+            {"owner": "0xb", "newest_block_time": None},
+            {"owner": "0xc", "newest_block_time": "2022-01-08 12:00:00"},
+        ]
+        newest = {}
+        self.assertEqual(
+            list(strip_block_times(rows, newest)),
+            [{"owner": "0xa"}, {"owner": "0xb"}, {"owner": "0xc"}],
+        )
+        self.assertEqual(newest["block_time"], NOON)
+
+    def test_percentile(self):
+        lags = [float(lag) for lag in range(1, 101)]
+        self.assertEqual(percentile(lags, 50), 50.0)
+        self.assertEqual(percentile(lags, 99), 99.0)
+        self.assertEqual(percentile([7.0], 90), 7.0)
+
+    def test_rolling_log_and_status(self):
+        for lag in [100, 10, 20, 30]:
+            record_freshness("job", NOON, NOON + lag - 1, committed_at=NOON + lag)
+        summary = record_freshness("job", None, NOON, committed_at=NOON + 40)
+
+        log_file = os.path.join(self.folder, "freshness", "job.jsonl")
+        with open(log_file, encoding="utf-8") as file:
+            self.assertEqual(
+                [json.loads(line)["lag"] for line in file], [20.0, 30.0, None]
+            )
+        self.assertEqual(summary["samples"], 2)
+        self.assertEqual(summary["lag_percentiles"]["p50"], 20.0)
+        self.assertEqual(summary["lag_percentiles"]["p99"], 30.0)
+
+        status_file = os.path.join(self.folder, "freshness_status.json")
+        with open(status_file, encoding="utf-8") as file:
+            self.assertEqual(json.load(file), {"job": summary})
+        metrics_file = os.path.join(
+            self.folder, "metrics", "dune_bridge_freshness_job.prom"
+        )
+        with open(metrics_file, encoding="utf-8") as file:
+            self.assertIn(
+                'dune_bridge_freshness_lag_seconds{job="job",quantile="0.5"} 20.0\n',
+                file.read(),
+            )
+
+    def test_stale_jobs(self):
+        status = {
+            "fresh": {"lag": 10.0, "committed_at": NOON},
+            "lagging": {"lag": 7200.0, "committed_at": NOON},
+            "stopped": {"lag": None, "committed_at": NOON - 7200},
+        }
+        self.assertEqual(stale_jobs(status, 3600, NOON + 60), ["lagging", "stopped"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+import os
+import subprocess
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+ENTRY_MODULES = [
+    "dune_api_scripts.compact_user_data",
+    "dune_api_scripts.daemon",
+    "dune_api_scripts.freshness",
+    "dune_api_scripts.store_query_result_all_distinct_app_data",
+    "dune_api_scripts.store_query_result_for_entire_history_trading_data",
+    "dune_api_scripts.store_query_result_for_todays_trading_data",
+    "dune_api_scripts.update.user_retention",
+    "dune_api_scripts.update_appdata_view",
+]
+# Cumulative import time allowed per entry module (in microseconds).
+IMPORT_BUDGET_US = 300_000
+# Modules that are slow to import and must only be imported when used.
+DEFERRED_MODULES = ["duneapi.api", "duneapi.types", "web3"]
+
+
+def import_profile(module: str) -> tuple[int, list[str]]:
+    """Imports `module` in a fresh interpreter without any Dune credentials"""
+    env = {
+        key: value
+        for key, value in os.environ.items()
+        if key not in ("DUNE_USER", "DUNE_PASSWORD")
+    }
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-X",
+            "importtime",
+            "-c",
+            f"import sys, {module}; print(' '.join(sys.modules))",
+        ],
+        cwd=ROOT,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    cumulative_us = next(
+        int(line.split("|")[1])
+        for line in result.stderr.splitlines()
+        if line.startswith("import time:") and line.split("|")[2].strip() == module
+    )
+    return cumulative_us, result.stdout.split()
+
+
+class TestImportTime(unittest.TestCase):
+    def test_entry_modules_import_within_budget(self):
+        for module in ENTRY_MODULES:
+            with self.subTest(module=module):
+                cumulative_us, loaded_modules = import_profile(module)
+                for deferred in DEFERRED_MODULES:
+                    self.assertNotIn(deferred, loaded_modules)
+                self.assertLess(cumulative_us, IMPORT_BUDGET_US)
+
+
+if __name__ == "__main__":
+    unittest.main()
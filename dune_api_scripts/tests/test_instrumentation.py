@@ -0,0 +1,88 @@
+import json
+import os
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from ..instrumentation import in_current_run, instrumented, instrumented_run, stage
+
+
+def fetch_rows(rows):
+    with stage("await_results") as measurement:
+        measurement.rows = rows
+
+
+@instrumented("inner_job")
+def inner_job():
+    with stage("write") as measurement:
+        measurement.bytes = 10
+
+
+class TestInstrumentation(unittest.TestCase):
+    def setUp(self):
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        self.folder = folder.name
+        patch = mock.patch.dict(os.environ, {"DUNE_DATA_FOLDER": self.folder})
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def run_log(self, name="run_log.jsonl"):
+        with open(os.path.join(self.folder, name), encoding="utf-8") as file:
+            return [json.loads(line) for line in file]
+
+    def test_stages_are_accumulated_and_exported(self):
+        with instrumented_run("job"):
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                list(executor.map(in_current_run(fetch_rows), [3, 4]))
+            inner_job()
+        # Stages outside of runs are ignored.
+        fetch_rows(5)
+
+        (entry,) = self.run_log()
+        self.assertEqual(entry["job"], "job")
+        self.assertEqual(entry["status"], "succeeded")
+        self.assertEqual(set(entry["stages"]), {"await_results", "inner_job", "write"})
+        self.assertEqual(entry["stages"]["await_results"]["count"], 2)
+        self.assertEqual(entry["stages"]["await_results"]["rows"], 7)
+        self.assertEqual(entry["stages"]["write"]["bytes"], 10)
+
+        metrics_file = os.path.join(self.folder, "metrics", "dune_bridge_job.prom")
+        with open(metrics_file, encoding="utf-8") as file:
+            metrics = file.read()
+        self.assertIn('dune_bridge_run_success{job="job"} 1\n', metrics)
+        self.assertIn(
+            'dune_bridge_stage_rows{job="job",stage="await_results"} 7\n', metrics
+        )
+        self.assertEqual(
+            os.listdir(os.path.join(self.folder, "metrics")), ["dune_bridge_job.prom"]
+        )
+
+    def test_failed_runs(self):
+        with self.assertRaises(RuntimeError):
+            with instrumented_run("job"):
+                raise RuntimeError("failed")
+        with self.assertRaises(SystemExit):
+            with instrumented_run("job"):
+                raise SystemExit()
+        self.assertEqual(
+            [entry["status"] for entry in self.run_log()], ["failed", "exited"]
+        )
+
+    def test_run_log_is_rotated(self):
+        for job in ["first", "second"]:
+            with instrumented_run(job):
+                pass
+        size = os.path.getsize(os.path.join(self.folder, "run_log.jsonl"))
+        with mock.patch.dict(os.environ, {"RUN_LOG_MAX_BYTES": str(size + 1)}):
+            for job in ["third", "fourth"]:
+                with instrumented_run(job):
+                    pass
+        rotated = [entry["job"] for entry in self.run_log("run_log.jsonl.1")]
+        self.assertEqual(rotated, ["first", "second", "third"])
+        self.assertEqual([entry["job"] for entry in self.run_log()], ["fourth"])
+
+
+if __name__ == "__main__":
+    unittest.main()
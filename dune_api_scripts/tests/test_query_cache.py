@@ -0,0 +1,93 @@
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from duneapi.types import DuneQuery, QueryParameter
+
+from .. import query_cache
+from ..query_cache import QueryCache, cached_fetch_with_time
+
+
+def query(sql: str, day: str = "2022-01-01 00:00:00") -> DuneQuery:
+    return DuneQuery(
+        query_id=1,
+        raw_sql=sql,
+        name="test",
+        parameters=[QueryParameter.date_type("DateFor", day)],
+    )
+
+
+class TestQueryCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache = QueryCache(self.tmp.name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_key_depends_on_sql_and_parameters(self):
+        self.assertEqual(
+            QueryCache.key(query("select 1")), QueryCache.key(query("select 1"))
+        )
+        self.assertNotEqual(
+            QueryCache.key(query("select 1")), QueryCache.key(query("select 2"))
+        )
+        self.assertNotEqual(
+            QueryCache.key(query("select 1")),
+            QueryCache.key(query("select 1", "2022-01-02 00:00:00")),
+        )
+
+    def test_get_and_expiry(self):
+        records = [{"day": "2022-01-01", "retained": "1"}]
+        self.assertIsNone(self.cache.get(query("select 1"), ttl=60))
+        self.cache.put(query("select 1"), records)
+        self.assertEqual(self.cache.get(query("select 1"), ttl=60), records)
+        self.assertIsNone(self.cache.get(query("select 2"), ttl=60))
+
+        entry = next(self.cache.path.glob("*.json.gz"))
+        fetched_at = time.time() - 120
+        os.utime(entry, (fetched_at, fetched_at))
+        self.assertIsNone(self.cache.get(query("select 1"), ttl=60))
+        self.assertEqual(self.cache.get(query("select 1"), ttl=180), records)
+
+    def test_evicts_least_recently_used(self):
+        records = [{"value": "x" * 1000}]
+        self.cache.put(query("select 1"), records)
+        self.cache.put(query("select 2"), records)
+        entry_size = next(self.cache.path.glob("*.json.gz")).stat().st_size
+        now = time.time()
+        for age, sql in [(30, "select 1"), (20, "select 2")]:
+            entry = self.cache.path / f"{QueryCache.key(query(sql))}.json.gz"
+            os.utime(entry, (now - age, now - age))
+        # Using the older entry makes the other one least recently used.
+        self.assertIsNotNone(self.cache.get(query("select 1"), ttl=60))
+
+        self.cache.max_bytes = 2 * entry_size + entry_size // 2
+        self.cache.put(query("select 3"), records)
+        self.assertIsNotNone(self.cache.get(query("select 1"), ttl=60))
+        self.assertIsNone(self.cache.get(query("select 2"), ttl=60))
+        self.assertIsNotNone(self.cache.get(query("select 3"), ttl=60))
+
+    @mock.patch.object(query_cache, "fetch", return_value=[{"value": "1"}])
+    def test_download_time_of_cached_results(self, fetch):
+        records, downloaded_at = cached_fetch_with_time(
+            None, query("select 1"), ttl=60, cache=self.cache
+        )
+        self.assertEqual(records, [{"value": "1"}])
+        self.assertAlmostEqual(downloaded_at, time.time(), delta=5)
+
+        entry = next(self.cache.path.glob("*.json.gz"))
+        fetched_at = time.time() - 30
+        os.utime(entry, (fetched_at, fetched_at))
+        records, downloaded_at = cached_fetch_with_time(
+            None, query("select 1"), ttl=60, cache=self.cache
+        )
+        self.assertEqual(records, [{"value": "1"}])
+        self.assertEqual(downloaded_at, fetched_at)
+        self.assertEqual(fetch.call_count, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
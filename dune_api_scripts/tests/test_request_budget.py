@@ -0,0 +1,158 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import requests
+from duneapi.types import DuneQuery
+
+from ..fake_dune import FakeDuneAPI, FakeDuneConfig, json_response, recording_path
+from ..instrumentation import instrumented_run
+from ..query_cache import fetch
+from ..utils import open_for_writing
+from ..request_budget import (
+    BudgetConfig,
+    CircuitOpenError,
+    RequestBudget,
+    budgeted,
+    job_priority,
+)
+
+
+class FakeClock:
+    def __init__(self):
+        self.time = 1000.0
+
+    def now(self):
+        return self.time
+
+    def sleep(self, seconds):
+        self.time += seconds
+
+
+def response(status_code):
+    result = requests.Response()
+    result.status_code = status_code
+    return result
+
+
+class TestRequestBudget(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.addCleanup(self.folder.cleanup)
+        self.clock = FakeClock()
+
+    def budget(self, **config):
+        return RequestBudget(
+            self.folder.name, BudgetConfig(**config), self.clock.now, self.clock.sleep
+        )
+
+    def test_token_bucket(self):
+        budget = self.budget(capacity=2, rate=1)
+        budget.acquire(priority=0)
+        budget.acquire(priority=0)
+        self.assertEqual(self.clock.time, 1000.0)
+        budget.acquire(priority=0)
+        self.assertAlmostEqual(self.clock.time, 1001.0, delta=0.3)
+
+    def test_urgent_requests_preempt_bulk_ones(self):
+        budget = self.budget()
+        # A more urgent request of another process is waiting.
+        with budget.state() as state:
+            state["waiters"]["other"] = [0, self.clock.time + 2]
+        budget.acquire(priority=3)
+        self.assertGreaterEqual(self.clock.time, 1002.0)
+        # Requests of the same priority don't wait for each other.
+        with budget.state() as state:
+            state["waiters"]["other"] = [3, self.clock.time + 2]
+        start = self.clock.time
+        budget.acquire(priority=3)
+        self.assertEqual(self.clock.time, start)
+
+    def test_backoff_and_circuit_breaker(self):
+        budget = self.budget(
+            failure_threshold=3, cooldown=60, base_backoff=1, retries=0
+        )
+        budget.request(lambda: response(429), priority=0)
+        budget.request(lambda: response(502), priority=0)
+        # Backs off for 2 seconds after the second failure.
+        start = self.clock.time
+        budget.request(lambda: response(200), priority=0)
+        self.assertGreaterEqual(self.clock.time, start + 2)
+
+        for _ in range(3):
+            budget.request(lambda: response(503), priority=0)
+        with self.assertRaises(CircuitOpenError):
+            budget.acquire(priority=0)
+        # The circuit is shared with all other processes.
+        with self.assertRaises(CircuitOpenError):
+            self.budget().acquire(priority=0)
+        self.clock.time += 60
+        budget.request(lambda: response(200), priority=0)
+        with open(os.path.join(self.folder.name, "dune_budget.json")) as file:
+            self.assertEqual(json.load(file)["failures"], 0)
+
+    def test_budgeted_connection(self):
+        budget = self.budget(failure_threshold=2, cooldown=60, retries=0)
+        dune = budgeted(
+            FakeDuneAPI(FakeDuneConfig(self.folder.name, http_error_rate=1.0)), budget
+        )
+        with mock.patch.dict(
+            os.environ, {"DUNE_DATA_FOLDER": self.folder.name}
+        ), instrumented_run("entire_history"):
+            for _ in range(2):
+                dune.post_dune_request(None)
+            with self.assertRaises(CircuitOpenError):
+                dune.post_dune_request(None)
+
+    def test_logins_take_tokens(self):
+        budget = self.budget(capacity=1, rate=1)
+        dune = budgeted(FakeDuneAPI(FakeDuneConfig(self.folder.name)), budget)
+        dune.login()
+        start = self.clock.time
+        dune.login()
+        self.assertAlmostEqual(self.clock.time, start + 1, delta=0.3)
+
+    def test_failed_requests_are_retried_after_backoff(self):
+        budget = self.budget(base_backoff=5)
+        responses = iter([response(502), response(429), response(200)])
+        start = self.clock.time
+        self.assertEqual(
+            budget.request(lambda: next(responses), priority=0).status_code, 200
+        )
+        # Backed off for 5 and 10 seconds before the retries.
+        self.assertGreaterEqual(self.clock.time, start + 15)
+
+        failing = self.budget(retries=2)
+        with self.assertRaises(requests.ConnectionError):
+            failing.request(mock.Mock(side_effect=requests.ConnectionError), 0)
+
+    def test_failure_while_polling_does_not_fail_fetch(self):
+        query = DuneQuery(query_id=7, raw_sql="select 1", name="Test")
+        with open_for_writing(
+            recording_path(self.folder.name, query), compress=True
+        ) as file:
+            json.dump([{"volume": 1}], file)
+        dune = FakeDuneAPI(FakeDuneConfig(self.folder.name))
+        send = dune.post_dune_request
+        failed = []
+
+        def post_dune_request(post, is_get=False):
+            if post.data["operationName"] == "GetExecution" and not failed:
+                failed.append(post)
+                return json_response({"error": "Injected error"}, status_code=502)
+            return send(post, is_get)
+
+        dune.post_dune_request = post_dune_request
+        budgeted(dune, self.budget())
+        self.assertEqual(fetch(dune, query), [{"volume": 1}])
+        self.assertEqual(len(failed), 1)
+
+    def test_job_priority(self):
+        self.assertLess(job_priority("todays_trading_data"), job_priority("retention"))
+        self.assertEqual(job_priority(None), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+import random
+import unittest
+from datetime import date, timedelta
+
+from ..update.retention_engine import compute_retention, epoch_day
+from ..update.user_retention import Retention
+
+
+def brute_force_retention(rows, day, num_days):
+    """Classification of retention-on-date.sql, trader by trader"""
+    today = epoch_day(day)
+    first, cow, other = {}, {}, {}
+    for row in rows:
+        trader, source, active = row["trader"], row["source"], int(row["day"])
+        if source == "first_trade":
+            first[trader] = active
+        else:
+            recent = {"cow": cow, "other": other}[source]
+            recent[trader] = recent.get(trader, False) or (
+                active <= today <= active + num_days - 1
+            )
+    counts = {"retained": 0, "hybrid": 0, "lost": 0, "gone": 0}
+    for trader, first_day in first.items():
+        if first_day >= today - num_days:
+            continue
+        cow_recent, other_recent = cow.get(trader, False), other.get(trader, False)
+        if cow_recent and not other_recent:
+            counts["retained"] += 1
+        elif cow_recent and other_recent:
+            counts["hybrid"] += 1
+        elif other_recent:
+            counts["lost"] += 1
+        else:
+            counts["gone"] += 1
+    return Retention(day=day, **counts)
+
+
+def random_activity(rng, start, days, traders):
+    rows = []
+    for i in range(traders):
+        trader = f"\\x{i:040x}"
+        first_day = epoch_day(start) - 60 + rng.randrange(days + 60)
+        rows.append({"trader": trader, "source": "first_trade", "day": str(first_day)})
+        for source in ["cow", "other"]:
+            for _ in range(rng.randrange(6)):
+                active = first_day + 1 + rng.randrange(days + 30)
+                rows.append({"trader": trader, "source": source, "day": str(active)})
+    # Activity on other DEXs of traders without CoW Protocol trades is ignored.
+    rows.append({"trader": "\\xff", "source": "other", "day": str(epoch_day(start))})
+    return rows
+
+
+class TestRetentionEngine(unittest.TestCase):
+    def test_matches_per_day_classification(self):
+        rng = random.Random(1)
+        start, end = date(2021, 6, 1), date(2021, 9, 30)
+        rows = random_activity(rng, start, (end - start).days, traders=300)
+        computed = [
+            Retention(*counts)
+            for counts in compute_retention(rows, start, end, num_days=30)
+        ]
+        self.assertEqual(len(computed), (end - start).days + 1)
+        for record in computed:
+            self.assertEqual(record, brute_force_retention(rows, record.day, 30))
+
+    def test_single_trader(self):
+        start = date(2021, 6, 1)
+        first = epoch_day(start) - 31
+        rows = [
+            {"trader": "a", "source": "first_trade", "day": str(first)},
+            {"trader": "a", "source": "cow", "day": str(first + 2)},
+            {"trader": "a", "source": "other", "day": str(first + 20)},
+        ]
+        records = [
+            Retention(*counts)
+            for counts in compute_retention(rows, start, start + timedelta(days=20), 30)
+        ]
+        # Eligible from first + 31 = start, the last day the cow trade is recent.
+        self.assertEqual(records[0], Retention(start, 0, 1, 0, 0))
+        self.assertEqual(records[18], Retention(start + timedelta(days=18), 0, 0, 1, 0))
+        self.assertEqual(records[19], Retention(start + timedelta(days=19), 0, 0, 0, 1))
+
+
+if __name__ == "__main__":
+    unittest.main()
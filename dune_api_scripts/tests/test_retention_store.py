@@ -0,0 +1,109 @@
+import os
+import tempfile
+import unittest
+from datetime import date, timedelta
+from unittest import mock
+
+from ..update import user_retention
+from ..update.retention_store import FIRST_DAY, RetentionStore
+from ..update.user_retention import Retention
+
+
+def days(count, start=FIRST_DAY + timedelta(days=1)):
+    return [(start + timedelta(days=i), i, 2 * i, 3, 4) for i in range(count)]
+
+
+def render(counts):
+    return str(Retention(*counts))
+
+
+class TestRetentionStore(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.folder.name, "retention.sqlite")
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_resumes_from_latest_day(self):
+        store = RetentionStore.open(self.path)
+        self.assertEqual(store.latest_day(), FIRST_DAY)
+        store.append(days(3))
+        store.close()
+
+        store = RetentionStore.open(self.path)
+        self.assertEqual(store.latest_day(), date(2021, 5, 31))
+        self.assertEqual(list(store.rows()), days(3))
+        store.close()
+
+    def test_rejects_gaps(self):
+        store = RetentionStore.open(self.path)
+        with self.assertRaises(ValueError):
+            store.append(days(2, start=FIRST_DAY + timedelta(days=2)))
+        self.assertEqual(store.latest_day(), FIRST_DAY)
+        store.close()
+
+    def test_values_match_full_rendering(self):
+        store = RetentionStore.open(self.path)
+        self.assertEqual(store.values(render), "")
+        rows = days(5)
+        store.append(rows[:3])
+        store.values(render)
+        store.append(rows[3:])
+        self.assertEqual(
+            store.values(render), ",\n             ".join(map(render, rows))
+        )
+        # Already rendered days are not rendered again.
+        self.assertEqual(store.values(lambda _: "unexpected"), store.values(render))
+        store.close()
+
+    def test_migrates_legacy_csv(self):
+        legacy_csv = os.path.join(self.folder.name, "retention.csv")
+        with open(legacy_csv, "w", encoding="utf-8") as file:
+            file.write("day,retained,hybrid,lost,gone")
+            file.write("\n2021-05-29,0,0,3,4\n2021-05-30,1,2,3,4\n2021-06-01,5,5,5,5")
+        store = RetentionStore.open(self.path, legacy_csv)
+        # Only the contiguous range of days is taken over.
+        self.assertEqual(list(store.rows()), days(2))
+        store.close()
+
+
+def fake_range_fetch(_dune, query, ttl):
+    """Rows of the range query (in no particular order), skipping 2021-06-03"""
+    del ttl
+    parameters = {p.key: p.value for p in query.parameters}
+    start, end = parameters["StartDate"].date(), parameters["EndDate"].date()
+    return [
+        {"day": str(day), "retained": "1", "hybrid": "2", "lost": "3", "gone": "4"}
+        for day in reversed(user_retention.date_range(start, end))
+        if day != date(2021, 6, 3)
+    ]
+
+
+@mock.patch.dict(os.environ, {"DUNE_QUERY_ID": "1"})
+@mock.patch.object(user_retention, "cached_fetch", side_effect=fake_range_fetch)
+class TestRetentionRange(unittest.TestCase):
+    def test_chunks_are_yielded_in_order(self, fetch):
+        start = date(2021, 6, 4)
+        missing = user_retention.date_range(start, start + timedelta(days=6))
+        results = user_retention.fetch_retention_concurrently(
+            None, missing, max_workers=2, chunk_days=3
+        )
+        self.assertEqual([r.day for r in results], missing)
+        self.assertEqual(fetch.call_count, 3)
+        # The final single day chunk shares the SQL of the concurrent range chunks.
+        queries = [call.args[1] for call in fetch.call_args_list]
+        self.assertEqual(len({query.raw_sql for query in queries}), 1)
+        self.assertEqual(
+            {query.parameters[0].value.date() for query in queries},
+            {start, start + timedelta(days=3), start + timedelta(days=6)},
+        )
+
+    def test_missing_days_raise(self, _fetch):
+        missing = user_retention.date_range(date(2021, 6, 1), date(2021, 6, 5))
+        with self.assertRaises(RuntimeError):
+            list(user_retention.fetch_retention_concurrently(None, missing, 1, 30))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,38 @@
+import threading
+import unittest
+
+from ..scheduler import Job, Scheduler
+
+
+class TestScheduler(unittest.TestCase):
+    def test_runs_due_jobs_without_overlap(self):
+        release = threading.Event()
+        started = []
+
+        def slow_job(dune):
+            started.append(dune)
+            release.wait(timeout=5)
+
+        def failing_job(_):
+            raise RuntimeError("boom")
+
+        slow = Job(name="slow", interval=10, run=slow_job)
+        failing = Job(name="failing", interval=30, run=failing_job)
+        scheduler = Scheduler(dune="connection", jobs=[slow, failing])
+
+        self.assertEqual(scheduler.tick(now=0), 10)
+        # slow job is still running when due again, so it is skipped.
+        self.assertEqual(scheduler.tick(now=10), 20)
+        release.set()
+        scheduler.shutdown()
+
+        self.assertEqual(started, ["connection"])
+        self.assertEqual(slow.stats.runs, 1)
+        self.assertEqual(slow.stats.skipped, 1)
+        self.assertEqual(failing.stats.runs, 1)
+        self.assertEqual(failing.stats.failures, 1)
+        self.assertFalse(slow.running)
+
+
+if __name__ == "__main__":
+    unittest.main()
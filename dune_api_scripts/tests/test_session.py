@@ -0,0 +1,68 @@
+import threading
+import unittest
+from unittest import mock
+
+from ..session import DuneSession, logged_in
+
+
+class FakeClock:
+    def __init__(self):
+        self.time = 1000.0
+
+    def now(self):
+        return self.time
+
+
+class TestDuneSession(unittest.TestCase):
+    def test_logs_in_again_once_expired(self):
+        clock = FakeClock()
+        login = mock.Mock()
+        session = DuneSession(login, max_age=60, now=clock.now)
+        session.refresh_if_expired()
+        clock.time += 61
+        session.refresh_if_expired()
+        session.refresh_if_expired()
+        self.assertEqual(login.call_count, 1)
+
+    def test_login_waits_for_requests_in_flight(self):
+        events = []
+        session = DuneSession(lambda: events.append("login"), max_age=60)
+        release = threading.Event()
+
+        def request():
+            with session.request():
+                release.wait(timeout=5)
+                events.append("request")
+
+        in_flight = threading.Thread(target=request)
+        in_flight.start()
+        while session.active_requests == 0:
+            threading.Event().wait(0.01)
+        login = threading.Thread(target=session.refresh, args=(session.now(),))
+        login.start()
+        release.set()
+        in_flight.join()
+        login.join()
+        self.assertEqual(events, ["request", "login"])
+
+    def test_rejected_session_logs_in_and_resends(self):
+        dune = mock.Mock()
+        dune.post_dune_request.side_effect = [
+            RuntimeError("Failed to fetch auth token", "expired"),
+            "response",
+        ]
+        login = dune.login
+        logged_in(dune, max_age=3600)
+        self.assertEqual(dune.post_dune_request("post"), "response")
+        self.assertEqual(login.call_count, 1)
+        # Other errors are not retried.
+        send = mock.Mock(side_effect=RuntimeError("query failed"))
+        other = mock.Mock(post_dune_request=send)
+        logged_in(other, max_age=3600)
+        with self.assertRaises(RuntimeError):
+            other.post_dune_request("post")
+        self.assertEqual(send.call_count, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
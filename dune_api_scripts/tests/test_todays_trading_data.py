@@ -0,0 +1,63 @@
+import json
+import os
+import tempfile
+import unittest
+from datetime import date, datetime, timezone
+from unittest import mock
+
+from .. import store_query_result_for_todays_trading_data as todays_trading_data
+
+
+def row(owner, day):
+    return {
+        "owner": owner,
+        "day": f"{day}T00:00:00+00:00",
+        "number_of_trades": 1,
+        "newest_block_time": f"{day}T00:01:00+00:00",
+    }
+
+
+class TestTodaysTradingData(unittest.TestCase):
+    def test_days_to_query(self):
+        self.assertEqual(
+            todays_trading_data.days_to_query(
+                datetime(2022, 1, 9, 0, 3, tzinfo=timezone.utc)
+            ),
+            [date(2022, 1, 8), date(2022, 1, 9)],
+        )
+        self.assertEqual(
+            todays_trading_data.days_to_query(
+                datetime(2022, 1, 9, 12, 0, tzinfo=timezone.utc)
+            ),
+            [date(2022, 1, 9)],
+        )
+
+    @mock.patch.object(
+        todays_trading_data, "build_query_for_affiliate_data", return_value="select 1"
+    )
+    @mock.patch.object(todays_trading_data, "cached_fetch_with_time")
+    def test_files_are_named_by_query_day(self, fetch, _build):
+        # Cached results, downloaded at 2022-01-09 00:02 UTC
+        rows = [row("0xa", "2022-01-08"), row("0xb", "2022-01-09")]
+        fetch.return_value = (rows, 1641686520)
+        with tempfile.TemporaryDirectory() as folder, mock.patch.dict(
+            os.environ, {"DUNE_DATA_FOLDER": folder}
+        ), mock.patch("time.time", return_value=1641686580):
+            # 2022-01-09 00:03 UTC
+            todays_trading_data.store_todays_trading_data(None)
+            for day, owner in [(1641600000, "0xa"), (1641686400, "0xb")]:
+                path = os.path.join(folder, "user_data", f"user_data_from{day}.json")
+                with open(path, encoding="utf-8") as file:
+                    rows = json.load(file)["user_data"]
+                self.assertEqual([r["owner"] for r in rows], [owner])
+                self.assertNotIn("newest_block_time", rows[0])
+            status_file = os.path.join(folder, "freshness_status.json")
+            with open(status_file, encoding="utf-8") as file:
+                status = json.load(file)["todays_trading_data"]
+            # Newest trade at 2022-01-09 00:01 UTC
+            self.assertEqual(status["newest_block_time"], 1641686460)
+            self.assertEqual(status["downloaded_at"], 1641686520)
+
+
+if __name__ == "__main__":
+    unittest.main()
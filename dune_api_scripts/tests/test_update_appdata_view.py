@@ -0,0 +1,55 @@
+import tempfile
+import unittest
+
+from ..update.utils import Environment
+from ..update_appdata_view import app_data_view_updates, raw_app_data_partitions
+
+
+class TestRawAppDataPartitions(unittest.TestCase):
+    def test_partitions_are_stable(self):
+        with tempfile.TemporaryDirectory() as data_folder:
+            content_map = {f"0x0{i}": {} for i in range(5)}
+            self.assertEqual(
+                raw_app_data_partitions(content_map, data_folder, 2),
+                [["0x00", "0x01"], ["0x02", "0x03"], ["0x04"]],
+            )
+            # New hashes are appended, removed ones don't shift the others.
+            del content_map["0x01"]
+            content_map["0x05"] = {}
+            content_map["0x0a"] = {}
+            self.assertEqual(
+                raw_app_data_partitions(content_map, data_folder, 2),
+                [["0x00"], ["0x02", "0x03"], ["0x04", "0x05"], ["0x0a"]],
+            )
+            # Changing the partition size starts over.
+            self.assertEqual(
+                raw_app_data_partitions(content_map, data_folder, 3),
+                [["0x00", "0x02", "0x03"], ["0x04", "0x05", "0x0a"]],
+            )
+
+
+class TestAppDataViewUpdates(unittest.TestCase):
+    def test_pages_are_combined_under_the_unpaged_view(self):
+        pages = {0: "('0x00', '{}')", 2: "('0x04', '{}')"}
+        raw_0, raw_2, union, parsed = app_data_view_updates(Environment.STAGING, pages)
+        self.assertEqual(union.name, "raw_app_data_barn")
+        self.assertEqual(union.depends_on, [raw_0.name, raw_2.name])
+        self.assertIn(
+            "dune_user_generated.cow_protocol_raw_app_data_{{Environment}} (hash",
+            union.query.raw_sql,
+        )
+        for page in pages:
+            self.assertIn(
+                f"cow_protocol_raw_app_data_{{{{Environment}}}}_page_{page}",
+                union.query.raw_sql,
+            )
+        # The parsed app data is built on top of the combined view.
+        self.assertEqual(parsed.depends_on, [union.name])
+        self.assertIn(
+            "from dune_user_generated.cow_protocol_raw_app_data_{{Environment}}\n",
+            parsed.query.raw_sql,
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,202 @@
+import os
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+import requests
+
+from ..update.utils import Environment, ViewUpdate, refresh_all, refresh_environments
+
+
+class FakeResponse:
+    def __init__(self, status):
+        self.status = status
+
+    def json(self):
+        return {"data": {"get_execution": self.status}}
+
+
+class FakeDune:
+    """Executions finish after a fixed number of polls (or fail if that is None)"""
+
+    def __init__(self, polls_until_done):
+        self.polls_until_done = polls_until_done
+        self.polls = {}
+        self.executed = []
+        self.running = set()
+        self.max_concurrent = 0
+
+    def initiate_query(self, query):
+        pass
+
+    def execute(self, query_id, parameters):
+        job_id = f"job-{len(self.executed)}"
+        self.executed.append(query_id)
+        self.polls[job_id] = (query_id, 0)
+        self.running.add(job_id)
+        self.max_concurrent = max(self.max_concurrent, len(self.running))
+        return job_id
+
+    def post_dune_request(self, post, is_get):
+        query_id, polls = self.polls[post]
+        polls += 1
+        self.polls[post] = (query_id, polls)
+        status = dict.fromkeys(
+            [
+                "execution_succeeded",
+                "execution_failed",
+                "execution_queued",
+                "execution_running",
+            ]
+        )
+        required = self.polls_until_done[query_id]
+        if required is None:
+            status["execution_failed"] = {"type": "FAILED"}
+        elif polls >= required:
+            status["execution_succeeded"] = {"runtime": 1}
+        else:
+            status["execution_running"] = {}
+        if status["execution_running"] is None:
+            self.running.discard(post)
+        return FakeResponse(status)
+
+
+def update(name, query_id, depends_on=(), raw_sql=None):
+    query = SimpleNamespace(
+        name=name,
+        query_id=query_id,
+        raw_sql=raw_sql or f"sql of {name}",
+        parameters=[],
+        get_execution=lambda job_id: job_id,
+    )
+    return ViewUpdate(name=name, query=query, depends_on=list(depends_on))
+
+
+class TestRefreshAll(unittest.TestCase):
+    def test_independent_updates_run_concurrently(self):
+        dune = FakeDune({1: 3, 2: 3, 3: 1})
+        report = refresh_all(
+            dune,
+            [
+                update("raw_0", 1),
+                update("raw_1", 2),
+                update("parsed", 3, ["raw_0", "raw_1"]),
+            ],
+            initial_backoff=0,
+        )
+        self.assertEqual(report.succeeded, ["raw_0", "raw_1", "parsed"])
+        self.assertEqual(report.failed, {})
+        self.assertEqual(dune.max_concurrent, 2)
+        self.assertEqual(dune.executed, [1, 2, 3])
+
+    def test_same_query_is_not_executed_concurrently(self):
+        dune = FakeDune({1: 2})
+        report = refresh_all(dune, [update("a", 1), update("b", 1)], initial_backoff=0)
+        self.assertEqual(report.succeeded, ["a", "b"])
+        self.assertEqual(dune.max_concurrent, 1)
+
+    def test_failures_propagate_to_dependents(self):
+        dune = FakeDune({1: None, 2: 1, 3: 1})
+        report = refresh_all(
+            dune,
+            [
+                update("raw", 1),
+                update("other", 2),
+                update("parsed", 3, ["raw", "other"]),
+                update("cyclic", 2, ["cyclic"]),
+            ],
+            initial_backoff=0,
+        )
+        self.assertEqual(report.succeeded, ["other"])
+        self.assertEqual(set(report.failed), {"raw", "parsed", "cyclic"})
+        self.assertEqual(report.failed["parsed"], "a dependency failed")
+        self.assertEqual(report.failed["cyclic"], "unsatisfiable dependencies")
+        with self.assertRaises(RuntimeError):
+            report.raise_for_failures()
+
+    def test_request_errors_fail_single_updates(self):
+        class UnreliableDune(FakeDune):
+            def execute(self, query_id, parameters):
+                if query_id == 1:
+                    raise requests.ConnectionError("connection reset")
+                return super().execute(query_id, parameters)
+
+            def post_dune_request(self, post, is_get):
+                if self.polls[post][0] == 2:
+                    raise ValueError("malformed response")
+                return super().post_dune_request(post, is_get)
+
+        dune = UnreliableDune({2: 1, 3: 1, 4: 1})
+        report = refresh_all(
+            dune,
+            [
+                update("raw", 1),
+                update("other", 2),
+                update("parsed", 4, ["raw"]),
+                update("independent", 3),
+            ],
+            initial_backoff=0,
+        )
+        self.assertEqual(report.succeeded, ["independent"])
+        self.assertIn("ConnectionError", report.failed["raw"])
+        self.assertIn("ValueError", report.failed["other"])
+        self.assertEqual(report.failed["parsed"], "a dependency failed")
+
+
+class TestRefreshEnvironments(unittest.TestCase):
+    def setUp(self):
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        patch = mock.patch.dict(os.environ, {"DUNE_DATA_FOLDER": folder.name})
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_environments_are_reported_separately(self):
+        dune = FakeDune({1: 2, 2: None})
+        reports = refresh_environments(
+            dune,
+            {
+                Environment.STAGING: [update("view_barn", 1, raw_sql="same")],
+                Environment.PRODUCTION: [
+                    update("view_prod", 1, raw_sql="same"),
+                    update("other_prod", 2),
+                ],
+            },
+            initial_backoff=0,
+        )
+        # Updates of the same SQL (differing in parameters only) run concurrently.
+        self.assertEqual(dune.max_concurrent, 3)
+        self.assertEqual(reports[Environment.STAGING].succeeded, ["view_barn"])
+        self.assertEqual(reports[Environment.STAGING].failed, {})
+        self.assertEqual(reports[Environment.PRODUCTION].succeeded, ["view_prod"])
+        self.assertEqual(list(reports[Environment.PRODUCTION].failed), ["other_prod"])
+
+    def test_unchanged_updates_are_skipped(self):
+        def updates(raw_sql):
+            return {
+                Environment.TEST: [
+                    update("page_0", 1),
+                    update("page_1", 2, raw_sql=raw_sql),
+                    update("view", 3, depends_on=["page_0", "page_1"]),
+                ]
+            }
+
+        dune = FakeDune({1: 1, 2: 1, 3: 1})
+        refresh_environments(dune, updates("v1"), initial_backoff=0)
+        self.assertEqual(dune.executed, [1, 2, 3])
+
+        # Only the changed update runs, without waiting for skipped dependencies.
+        report = refresh_environments(dune, updates("v2"), initial_backoff=0)
+        self.assertEqual(dune.executed, [1, 2, 3, 2])
+        self.assertEqual(report[Environment.TEST].succeeded, ["page_1"])
+        self.assertEqual(report[Environment.TEST].skipped, ["page_0", "view"])
+
+        refresh_environments(dune, updates("v2"), initial_backoff=0)
+        self.assertEqual(dune.executed, [1, 2, 3, 2])
+        refresh_environments(dune, updates("v2"), initial_backoff=0, force=True)
+        self.assertEqual(dune.executed, [1, 2, 3, 2, 1, 2, 3])
+
+
+if __name__ == "__main__":
+    unittest.main()
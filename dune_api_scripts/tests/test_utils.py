@@ -1,7 +1,23 @@
+import io
+import json
+import os
+import re
+import tempfile
 import time
 import unittest
+from datetime import date
+from unittest import mock
 
-from ..utils import ensure_that_download_is_recent, dune_address
+from ..utils import (
+    build_string_for_affiliate_referrals_pairs,
+    consume,
+    dune_address,
+    ensure_that_download_is_recent,
+    month_windows,
+    referrer_index,
+    store_as_json_file,
+    write_json_stream,
+)
 
 
 class MyTestCase(unittest.TestCase):
@@ -18,6 +34,139 @@ class MyTestCase(unittest.TestCase):
             dune_address(hex_address), "\\xca8e1b4e6846bdd9c59befb38a036cfbaa5f3737"
         )
 
+    def test_month_windows(self):
+        self.assertEqual(
+            month_windows(date(2021, 11, 15), date(2022, 2, 10)),
+            [
+                (date(2021, 11, 15), date(2021, 12, 1)),
+                (date(2021, 12, 1), date(2022, 1, 1)),
+                (date(2022, 1, 1), date(2022, 2, 1)),
+                (date(2022, 2, 1), date(2022, 2, 10)),
+            ],
+        )
+        self.assertEqual(
+            month_windows(date(2021, 3, 1), date(2021, 9, 1), months=4),
+            [
+                (date(2021, 3, 1), date(2021, 7, 1)),
+                (date(2021, 7, 1), date(2021, 9, 1)),
+            ],
+        )
+        self.assertEqual(month_windows(date(2021, 3, 1), date(2021, 3, 1)), [])
+        with self.assertRaises(ValueError):
+            month_windows(date(2021, 3, 1), date(2021, 9, 1), months=0)
+
+    def test_write_json_stream(self):
+        records = [{"owner": "0x1", "referrals": ["0x2"]}, {"owner": "0x3"}]
+        file = io.StringIO()
+        count = write_json_stream(
+            file, "user_data", consume(records), {"time_of_download": 1630333791}
+        )
+        self.assertEqual(count, 2)
+        self.assertEqual(records, [])
+        self.assertEqual(
+            json.loads(file.getvalue()),
+            {
+                "user_data": [{"owner": "0x1", "referrals": ["0x2"]}, {"owner": "0x3"}],
+                "time_of_download": 1630333791,
+            },
+        )
+
+        file = io.StringIO()
+        write_json_stream(file, "app_data", [], {})
+        self.assertEqual(json.loads(file.getvalue()), {"app_data": []})
+
+    def test_store_as_json_file_tracks_changed_rows(self):
+        rows = [
+            {"owner": "0x1", "day": "2022-01-01T00:00:00+00:00", "number_of_trades": 1},
+            {"owner": "0x2", "day": "2022-01-01T00:00:00+00:00", "number_of_trades": 2},
+        ]
+        with tempfile.TemporaryDirectory() as data_folder, mock.patch.dict(
+            os.environ, {"DUNE_DATA_FOLDER": data_folder}
+        ):
+            user_data = os.path.join(data_folder, "user_data")
+            state = os.path.join(data_folder, "user_data_state")
+
+            store_as_json_file([dict(row) for row in rows], 1)
+            (file_name,) = os.listdir(user_data)
+            with open(os.path.join(user_data, file_name), encoding="utf-8") as file:
+                self.assertEqual(
+                    json.load(file), {"user_data": rows, "time_of_download": 1}
+                )
+
+            changes_file = os.path.join(
+                state, file_name.replace(".json", ".changes.json")
+            )
+            changed_at = os.stat(changes_file).st_mtime_ns
+            store_as_json_file([dict(row) for row in rows], 2)
+            # Unchanged rows only advance the download time read by the service.
+            with open(os.path.join(user_data, file_name), encoding="utf-8") as file:
+                self.assertEqual(
+                    json.load(file), {"user_data": rows, "time_of_download": 2}
+                )
+            self.assertEqual(os.stat(changes_file).st_mtime_ns, changed_at)
+
+            rows[1]["number_of_trades"] = 3
+            store_as_json_file([dict(row) for row in rows[1:]], 3)
+            with open(os.path.join(user_data, file_name), encoding="utf-8") as file:
+                self.assertEqual(
+                    json.load(file), {"user_data": rows[1:], "time_of_download": 3}
+                )
+            with open(changes_file, encoding="utf-8") as file:
+                self.assertEqual(
+                    json.load(file),
+                    {
+                        "time_of_download": 3,
+                        "changed": ["0x2/2022-01-01T00:00:00+00:00"],
+                        "removed": ["0x1/2022-01-01T00:00:00+00:00"],
+                    },
+                )
+            # Temporary files never end up in the folder scanned by the service.
+            self.assertEqual(os.listdir(user_data), [file_name])
+            self.assertEqual(os.listdir(os.path.join(data_folder, "tmp")), [])
+
+    def test_referrer_index(self):
+        referrer = {"address": "0xca8e1b4e6846bdd9c59befb38a036cfbaa5f3737"}
+        content_map = {
+            "0x01": {"metadata": {"referrer": referrer}},
+            "0x02": {"metadata": {}},
+        }
+        with tempfile.TemporaryDirectory() as data_folder, mock.patch.dict(
+            os.environ,
+            {
+                "DUNE_DATA_FOLDER": data_folder,
+                "APP_DATA_REFERRAL_RELATION_FILE": os.path.join(
+                    data_folder, "app_data.json"
+                ),
+            },
+        ):
+            with open(os.environ["APP_DATA_REFERRAL_RELATION_FILE"], "w") as file:
+                json.dump(content_map, file)
+            self.assertEqual(
+                referrer_index(),
+                {"0x01": "\\xca8e1b4e6846bdd9c59befb38a036cfbaa5f3737", "0x02": None},
+            )
+            self.assertEqual(
+                build_string_for_affiliate_referrals_pairs(),
+                "('0x01','\\xca8e1b4e6846bdd9c59befb38a036cfbaa5f3737')",
+            )
+
+            content_map["0x03"] = {"metadata": {"referrer": referrer}}
+            with open(os.environ["APP_DATA_REFERRAL_RELATION_FILE"], "w") as file:
+                json.dump(content_map, file)
+            self.assertEqual(
+                set(
+                    re.findall(r"\(.*?\)", build_string_for_affiliate_referrals_pairs())
+                ),
+                {
+                    "('0x01','\\xca8e1b4e6846bdd9c59befb38a036cfbaa5f3737')",
+                    "('0x03','\\xca8e1b4e6846bdd9c59befb38a036cfbaa5f3737')",
+                },
+            )
+            with open(
+                os.path.join(data_folder, "app_data_referral_index.json")
+            ) as file:
+                self.assertEqual(len(json.load(file)["referrers"]), 3)
+
 
 if __name__ == "__main__":
     unittest.main()
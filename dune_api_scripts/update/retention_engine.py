@@ -0,0 +1,127 @@
+"""
+Computes user retention for a whole range of days at once from a single export
+of trader activity (see queries/retention-activity.sql), instead of running
+retention-on-date.sql once per day.
+
+For a day D (at midnight) and N = NumDays, a trader counts (as in retention-on-date.sql)
+if their first CoW Protocol trade happened before D - N days. Such a trader is recent
+on CoW Protocol (resp. other DEXs) if they traded there within (D - N days, D].
+With activity given as days (rounded up), a trade on day c is recent on all days in
+[c, c + N - 1], so recency of each trader is a union of intervals of days.
+Counting the traders whose intervals cover each day is done with difference arrays.
+"""
+from __future__ import annotations
+
+from datetime import date, timedelta
+
+import numpy as np
+import numpy.typing as npt
+
+EPOCH = date(1970, 1, 1)
+
+IntArray = npt.NDArray[np.int64]
+# Day along with the number of retained, hybrid, lost and gone traders.
+RetentionCounts = tuple[date, int, int, int, int]
+
+
+def epoch_day(day: date) -> int:
+    """Number of days since 1970-01-01"""
+    return (day - EPOCH).days
+
+
+def recency_intervals(
+    traders: IntArray, days: IntArray, num_days: int
+) -> tuple[IntArray, IntArray, IntArray]:
+    """
+    Merges the intervals [day, day + num_days - 1] of each trader into disjoint ones.
+    Returns traders, first and last days of all merged intervals.
+    """
+    order = np.lexsort((days, traders))
+    traders, days = traders[order], days[order]
+    # An interval starts wherever the previous activity (of the same trader)
+    # is not recent anymore.
+    new_interval = np.ones(len(days), dtype=bool)
+    new_interval[1:] = (traders[1:] != traders[:-1]) | (days[1:] - days[:-1] > num_days)
+    last_of_interval = np.ones(len(days), dtype=bool)
+    last_of_interval[:-1] = new_interval[1:]
+    return (
+        traders[new_interval],
+        days[new_interval],
+        days[last_of_interval] + num_days - 1,
+    )
+
+
+def coverage(starts: IntArray, ends: IntArray, first_day: int, length: int) -> IntArray:
+    """Number of intervals [start, end] covering each of the `length` days from `first_day`"""
+    starts = np.maximum(starts - first_day, 0)
+    ends = np.minimum(ends - first_day, length - 1)
+    valid = starts <= ends
+    changes = np.bincount(starts[valid], minlength=length + 1) - np.bincount(
+        ends[valid] + 1, minlength=length + 1
+    )
+    return np.cumsum(changes[:length]).astype(np.int64)
+
+
+def covered_after(
+    activity: tuple[IntArray, IntArray],
+    eligible_from: IntArray,
+    num_days: int,
+    window: tuple[int, int],
+) -> IntArray:
+    """
+    Number of traders recently active on each day of `window` (first day, length),
+    counting only days on which the trader is eligible.
+    """
+    traders, starts, ends = recency_intervals(*activity, num_days)
+    return coverage(np.maximum(starts, eligible_from[traders]), ends, *window)
+
+
+def parse_activity(
+    rows: list[dict[str, str]]
+) -> tuple[npt.NDArray[np.str_], IntArray, IntArray]:
+    """Sources, (indices of) traders and days of all rows of the activity export"""
+    sources = np.array([row["source"] for row in rows])
+    days = np.array([int(float(row["day"])) for row in rows], dtype=np.int64)
+    _, traders = np.unique(
+        np.array([row["trader"] for row in rows]), return_inverse=True
+    )
+    return sources, traders.astype(np.int64), days
+
+
+def compute_retention(
+    rows: list[dict[str, str]], start: date, end: date, num_days: int = 30
+) -> list[RetentionCounts]:
+    """Retention for every day from `start` until `end` from the rows of the activity export"""
+    sources, traders, days = parse_activity(rows)
+    # Traders only count once their first trade lies more than num_days in the past.
+    eligible_from = np.full(len(rows), np.iinfo(np.int64).max // 2)
+    first_trades = sources == "first_trade"
+    eligible_from[traders[first_trades]] = days[first_trades] + num_days + 1
+
+    window = (epoch_day(start), (end - start).days + 1)
+    eligible = coverage(
+        eligible_from[traders[first_trades]],
+        np.full(first_trades.sum(), window[0] + window[1]),
+        *window,
+    )
+    recent = {
+        source: covered_after(
+            (traders[activity], days[activity]), eligible_from, num_days, window
+        )
+        for source, activity in [
+            ("cow", sources == "cow"),
+            ("other", sources == "other"),
+            ("any", (sources == "cow") | (sources == "other")),
+        ]
+    }
+    hybrid = recent["cow"] + recent["other"] - recent["any"]
+    return [
+        (
+            start + timedelta(days=i),
+            int(recent["cow"][i] - hybrid[i]),
+            int(hybrid[i]),
+            int(recent["other"][i] - hybrid[i]),
+            int(eligible[i] - recent["any"][i]),
+        )
+        for i in range(window[1])
+    ]
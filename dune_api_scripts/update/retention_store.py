@@ -0,0 +1,158 @@
+"""
+SQLite backed store of the user retention counts of consecutive days.
+
+The last stored day and the VALUES rendered for the retention view are kept in a
+small header table, so that a daily run neither parses nor renders all historical
+days again: it only appends (and renders) the new ones.
+"""
+from __future__ import annotations
+
+import csv
+import itertools
+import os
+import sqlite3
+from collections.abc import Callable, Iterable, Iterator
+from datetime import date, timedelta
+from pathlib import Path
+from typing import TYPE_CHECKING, Optional
+
+from dune_api_scripts.instrumentation import stage
+
+if TYPE_CHECKING:
+    from dune_api_scripts.update.retention_engine import RetentionCounts
+
+# Day before the first official day of 30 day retention.
+FIRST_DAY = date(2021, 5, 28)
+# Separator of the VALUES of the retention view.
+VALUES_SEPARATOR = ",\n             "
+
+
+def batched(
+    rows: Iterable[RetentionCounts], size: int
+) -> Iterator[list[RetentionCounts]]:
+    """Groups `rows` into lists of (at most) `size` rows"""
+    iterator = iter(rows)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
+
+
+def read_legacy_csv(path: str | Path) -> list[RetentionCounts]:
+    """Rows of the contiguous range of days of a (former) retention csv file"""
+    with open(path, "r", encoding="utf-8") as file:
+        rows = {date.fromisoformat(row["day"]): row for row in csv.DictReader(file)}
+    contiguous: list[RetentionCounts] = []
+    day = FIRST_DAY + timedelta(days=1)
+    while day in rows:
+        row = rows[day]
+        contiguous.append(
+            (
+                day,
+                int(row["retained"]),
+                int(row["hybrid"]),
+                int(row["lost"]),
+                int(row["gone"]),
+            )
+        )
+        day += timedelta(days=1)
+    return contiguous
+
+
+class RetentionStore:
+    """Retention counts of consecutive days, starting the day after `FIRST_DAY`"""
+
+    def __init__(self, path: str | Path):
+        self.connection = sqlite3.connect(path)
+        with self.connection:
+            self.connection.execute(
+                """
+                create table if not exists retention (
+                    day text primary key,
+                    retained integer not null,
+                    hybrid integer not null,
+                    lost integer not null,
+                    gone integer not null
+                )
+                """
+            )
+            self.connection.execute(
+                "create table if not exists header (key text primary key, value text)"
+            )
+
+    @classmethod
+    def open(
+        cls, path: str | Path, legacy_csv: Optional[str | Path] = None
+    ) -> RetentionStore:
+        """
+        Opens the store at `path`. A new store is initialized with
+        the days of the `legacy_csv` retention file (if there is one).
+        """
+        is_new = not os.path.exists(path)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        store = cls(path)
+        if is_new and legacy_csv is not None and os.path.exists(legacy_csv):
+            rows = read_legacy_csv(legacy_csv)
+            store.append(rows)
+            print(f"Migrated {len(rows)} days of retention from {legacy_csv}")
+        return store
+
+    def close(self) -> None:
+        """Closes the database connection"""
+        self.connection.close()
+
+    def _header(self, key: str) -> Optional[str]:
+        row = self.connection.execute(
+            "select value from header where key = ?", (key,)
+        ).fetchone()
+        return None if row is None else str(row[0])
+
+    def _set_header(self, key: str, value: str) -> None:
+        self.connection.execute(
+            "insert or replace into header (key, value) values (?, ?)", (key, value)
+        )
+
+    def latest_day(self) -> date:
+        """The last day stored (i.e. the day to resume from), `FIRST_DAY` if none"""
+        latest = self._header("latest_day")
+        return FIRST_DAY if latest is None else date.fromisoformat(latest)
+
+    def append(self, rows: list[RetentionCounts]) -> None:
+        """Appends `rows` of the days following `latest_day` in a single transaction"""
+        if not rows:
+            return
+        expected = self.latest_day() + timedelta(days=1)
+        for row in rows:
+            if row[0] != expected:
+                raise ValueError(f"Expected retention of {expected}, got {row[0]}")
+            expected += timedelta(days=1)
+        with self.connection, stage("write_retention") as measurement:
+            self.connection.executemany(
+                "insert into retention values (?, ?, ?, ?, ?)",
+                [(str(day), *counts) for day, *counts in rows],
+            )
+            self._set_header("latest_day", str(rows[-1][0]))
+            measurement.rows = len(rows)
+
+    def rows(self, after: date = FIRST_DAY) -> Iterator[RetentionCounts]:
+        """All rows of days after `after`, in order"""
+        for day, retained, hybrid, lost, gone in self.connection.execute(
+            "select * from retention where day > ? order by day", (str(after),)
+        ):
+            yield date.fromisoformat(day), retained, hybrid, lost, gone
+
+    def values(self, render: Callable[[RetentionCounts], str]) -> str:
+        """
+        The VALUES of all stored days, each rendered by `render`.
+        Only days stored since the previous call are rendered, the others are cached.
+        """
+        with self.connection, stage("render_values") as measurement:
+            rendered_day = self._header("rendered_day")
+            after = (
+                FIRST_DAY if rendered_day is None else date.fromisoformat(rendered_day)
+            )
+            fragments = [self._header("rendered_values") or ""]
+            fragments.extend(map(render, self.rows(after)))
+            values = VALUES_SEPARATOR.join(filter(None, fragments))
+            self._set_header("rendered_values", values)
+            self._set_header("rendered_day", str(self.latest_day()))
+            measurement.rows, measurement.bytes = len(fragments) - 1, len(values)
+        return values
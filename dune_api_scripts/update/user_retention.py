@@ -1,20 +1,30 @@
 """Fetch Retention Data on Given Date from DuneAnalytics"""
 from __future__ import annotations
 
-import csv
+import argparse
 import os
-from dataclasses import dataclass, astuple
+import random
+from collections.abc import Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 
 from datetime import datetime, date, timedelta
+from typing import TYPE_CHECKING
 
-from duneapi.api import DuneAPI
-from duneapi.types import Network, QueryParameter, DuneQuery
 from duneapi.util import open_query
 
-from dune_api_scripts.local_env import DUNE_DATA_DIR, QUERY_DIR, DUNE_CONNECTION
-from dune_api_scripts.update.utils import update_args, Environment, refresh
+from dune_api_scripts.instrumentation import in_current_run, instrumented
+from dune_api_scripts.query_cache import cache_ttl, cached_fetch
+from dune_api_scripts.local_env import DUNE_DATA_DIR, QUERY_DIR, dune_connection
+from dune_api_scripts.update.retention_store import RetentionStore, batched
+from dune_api_scripts.update.utils import update_parser, Environment, ViewUpdate
+from dune_api_scripts.update.utils import raise_for_failed_environments
+from dune_api_scripts.update.utils import refresh_environments, selected_environments
 from dune_api_scripts.utils import date_range
 
+if TYPE_CHECKING:
+    from duneapi.api import DuneAPI
+
 
 @dataclass
 class Retention:
@@ -45,6 +55,9 @@ def fetch_retention_for_date(
     dune: DuneAPI, query_filepath: str, day: date
 ) -> Retention:
     """Initiates and executes Dune query, returning results as Python Objects"""
+    # pylint: disable=import-outside-toplevel
+    from duneapi.types import DuneQuery, Network, QueryParameter
+
     formatted_date = f"{str(day)} 00:00:00"
     retention_query = DuneQuery.from_environment(
         raw_sql=open_query(query_filepath),
@@ -55,19 +68,22 @@ def fetch_retention_for_date(
             QueryParameter.number_type("NumDays", 30),
         ],
     )
-    result = dune.fetch(retention_query)
+    # Retention of past days is final, so results can be cached for long.
+    result = cached_fetch(
+        dune, retention_query, ttl=cache_ttl("retention_on_date", 7 * 24 * 60 * 60)
+    )
     assert len(result) == 1
     return Retention.from_dict(result[0])
 
 
-def update_retention_view(
-    dune: DuneAPI, query_filepath: str, values: list[Retention], env: Environment
-) -> None:
-    """Updates user generated view with retention values"""
-    raw_sql = open_query(query_filepath).replace(
-        "{{Values}}",
-        ",\n             ".join(map(str, values)),
-    )
+def retention_view_update(
+    query_filepath: str, values: str, env: Environment
+) -> ViewUpdate:
+    """Update of the user generated view with (rendered) retention values"""
+    # pylint: disable=import-outside-toplevel
+    from duneapi.types import DuneQuery, Network
+
+    raw_sql = open_query(query_filepath).replace("{{Values}}", values)
     query = DuneQuery(
         raw_sql=raw_sql,
         name="User Retention",
@@ -76,74 +92,278 @@ def update_retention_view(
         network=Network.MAINNET,
         query_id=int(os.environ.get("RETENTION_QUERY", 1103196)),
     )
-    refresh(dune, query)
+    return ViewUpdate(name=f"retention_{env}", query=query)
 
 
-def open_or_create(path: str, file: str) -> tuple[list[Retention], date]:
-    """Opens csv with retention data or creates a new one."""
-    existing_data = []
-    filename = os.path.join(path, file)
+def update_retention_view(
+    dune: DuneAPI,
+    query_filepath: str,
+    values: str,
+    envs: list[Environment],
+    force: bool = False,
+) -> None:
+    """
+    Updates the user generated view of all `envs` (concurrently) with retention values,
+    unless they are unchanged since the last refresh (or `force` is set).
+    """
+    reports = refresh_environments(
+        dune,
+        {env: [retention_view_update(query_filepath, values, env)] for env in envs},
+        force=force,
+    )
+    raise_for_failed_environments(reports)
+
+
+def fetch_retention_for_range(
+    dune: DuneAPI, query_filepath: str, start: date, end: date
+) -> list[Retention]:
+    """Fetches retention of all days from `start` until `end` with a single execution"""
+    # pylint: disable=import-outside-toplevel
+    from duneapi.types import DuneQuery, Network, QueryParameter
+
+    range_query = DuneQuery.from_environment(
+        raw_sql=open_query(query_filepath),
+        name="Retention on Days",
+        network=Network.MAINNET,
+        parameters=[
+            QueryParameter.date_type("StartDate", f"{start} 00:00:00"),
+            QueryParameter.date_type("EndDate", f"{end} 00:00:00"),
+            QueryParameter.number_type("NumDays", 30),
+        ],
+    )
+    result = cached_fetch(
+        dune, range_query, ttl=cache_ttl("retention_on_date", 7 * 24 * 60 * 60)
+    )
+    records = sorted(map(Retention.from_dict, result), key=lambda r: r.day)
+    expected = date_range(start, end)
+    if [record.day for record in records] != expected:
+        missing = sorted(set(expected) - {record.day for record in records})
+        raise RuntimeError(
+            f"Retention from {start} to {end} returned {len(records)} rows "
+            f"for {len(expected)} days (missing {missing})"
+        )
+    return records
+
+
+def fetch_retention_concurrently(
+    dune: DuneAPI, days: list[date], max_workers: int, chunk_days: int = 1
+) -> Iterator[Retention]:
+    """
+    Fetches retention for all `days` in chunks of (at most) `chunk_days` days per
+    execution, with at most `max_workers` executions in flight.
+    Results are yielded in date order, each one as soon as all earlier days are done.
+    All chunks (single days included) use the range query, so that they share the
+    same SQL and only the parameters passed on execution differ. Otherwise
+    concurrent executions of the same query id would run each other's SQL.
+    """
+    chunks = [days[i : i + chunk_days] for i in range(0, len(days), chunk_days)]
+    query_filepath = f"{QUERY_DIR}/retention-range.sql"
+    executor = ThreadPoolExecutor(max_workers=max_workers)
     try:
-        with open(filename, "r", encoding="utf-8") as retention_file:
-            reader = csv.DictReader(retention_file)
-            latest_entry = date(year=2021, month=5, day=28)
-            for row in reader:
-                record = Retention.from_dict(row)
-                if record.day > latest_entry:
-                    latest_entry = record.day
-                existing_data.append(record)
-    except FileNotFoundError:
-        print(f"No file found at {filename}")
-        if not os.path.exists(path):
-            os.makedirs(path)
-        with open(filename, "a", encoding="utf-8") as new_file:
-            new_file.write("day,retained,hybrid,lost,gone")
-        # First official day of 30 day retention
-        latest_entry = datetime.strptime("2021-05-28", "%Y-%m-%d").date()
-
-    return existing_data, latest_entry
-
-
-def fetch_retention_till(
-    dune: DuneAPI, end: date, retention_file_path: str, env: Environment
+        futures = [
+            executor.submit(
+                in_current_run(fetch_retention_for_range),
+                dune,
+                query_filepath,
+                chunk[0],
+                chunk[-1],
+            )
+            for chunk in chunks
+        ]
+        for future in futures:
+            yield from future.result()
+    finally:
+        # Don't wait for (or start) the remaining days when the consumer bails out.
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def fetch_retention_locally(dune: DuneAPI, days: list[date]) -> list[Retention]:
+    """
+    Computes retention for all `days` (a contiguous range) from a single export of
+    trader activity, rather than querying each day separately.
+    """
+    # pylint: disable=import-outside-toplevel
+    from duneapi.types import DuneQuery, Network, QueryParameter
+
+    from dune_api_scripts.update.retention_engine import compute_retention
+
+    start, end = days[0], days[-1]
+    activity_query = DuneQuery.from_environment(
+        raw_sql=open_query(f"{QUERY_DIR}/retention-activity.sql"),
+        name="Retention Activity",
+        network=Network.MAINNET,
+        parameters=[
+            QueryParameter.date_type("StartDate", f"{start} 00:00:00"),
+            QueryParameter.date_type("EndDate", f"{end} 00:00:00"),
+            QueryParameter.number_type("NumDays", 30),
+        ],
+    )
+    rows = cached_fetch(
+        dune, activity_query, ttl=cache_ttl("retention_activity", 60 * 60)
+    )
+    print(f"Computing retention from {len(rows)} activity records")
+    return [Retention(*counts) for counts in compute_retention(rows, start, end, 30)]
+
+
+def validate_retention(
+    dune: DuneAPI, query_filepath: str, records: list[Retention], samples: int
 ) -> None:
-    """Method that loads existing retention data and fetches the rest by day"""
-    existing_data, latest_entry = open_or_create(DUNE_DATA_DIR, "retention.csv")
-
-    start = latest_entry + timedelta(days=1)
-    if start > end:
-        # This happens when the script is fully updated and latest_entry = end
-        print(
-            f"User Retention already up to date! "
-            f"Nothing to do until tomorrow {end + timedelta(days=1)}"
+    """
+    Compares (a random sample of) locally computed `records`
+    against the results of the per day query.
+    """
+    for record in random.sample(records, min(samples, len(records))):
+        expected = fetch_retention_for_date(dune, query_filepath, record.day)
+        if record != expected:
+            raise RuntimeError(
+                f"Local retention {record} differs from Dune result {expected}"
+            )
+    print(f"Validated local retention on {min(samples, len(records))} sampled days")
+
+
+def store_missing_retention(  # pylint: disable=too-many-arguments
+    dune: DuneAPI,
+    store: RetentionStore,
+    missing_dates: list[date],
+    max_workers: int,
+    local: bool,
+    chunk_days: int,
+) -> None:
+    """
+    Fetches the retention of all `missing_dates` (see `fetch_retention_till`)
+    and appends it to `store`.
+    """
+    results: Iterable[Retention]
+    if local:
+        results = computed = fetch_retention_locally(dune, missing_dates)
+        validate_retention(
+            dune,
+            f"{QUERY_DIR}/retention-on-date.sql",
+            computed,
+            samples=int(os.environ.get("RETENTION_VALIDATION_SAMPLES", 3)),
         )
-        return
-    missing_dates = date_range(start, end)
-    print(f"Fetching Retention from {start} to {end} (yesterday)")
-
-    for day in missing_dates:
-        print(f"fetching retention data for day {str(day)}")
-        day_result = fetch_retention_for_date(
-            dune, query_filepath=f"{QUERY_DIR}/retention-on-date.sql", day=day
+    else:
+        results = fetch_retention_concurrently(
+            dune, missing_dates, max_workers=max_workers, chunk_days=chunk_days
         )
-        existing_data.append(day_result)
-        print("Got results", day_result)
-        with open(retention_file_path, "a", encoding="utf-8") as csv_file:
-            csv_file.write("\n" + ",".join([str(t) for t in astuple(day_result)]))
 
-    update_retention_view(
-        dune,
-        query_filepath=f"{QUERY_DIR}/retention-complete.sql",
-        values=existing_data,
-        env=env,
+    # Days are committed strictly in order (in batches), so that a crashed run
+    # can be resumed from the last day committed to the store.
+    batch_size = int(os.environ.get("RETENTION_BATCH_SIZE", 30))
+    rows = ((r.day, r.retained, r.hybrid, r.lost, r.gone) for r in results)
+    for batch in batched(rows, batch_size):
+        store.append(batch)
+        print(f"Stored retention from {batch[0][0]} to {batch[-1][0]}")
+
+
+def fetch_retention_till(  # pylint: disable=too-many-arguments
+    dune: DuneAPI,
+    end: date,
+    store_path: str,
+    envs: list[Environment],
+    max_workers: int = 1,
+    local: bool = False,
+    chunk_days: int = 1,
+    force: bool = False,
+) -> None:
+    """
+    Method that loads existing retention data and fetches the rest
+    in chunks of `chunk_days` days, running up to `max_workers` queries concurrently.
+    With `local` the missing days are computed from a single activity export instead.
+    The view is refreshed unless it is unchanged since its last refresh
+    (or `force` is set).
+    """
+    store = RetentionStore.open(
+        store_path,
+        legacy_csv=os.path.join(os.path.dirname(store_path), "retention.csv"),
     )
+    try:
+        start = store.latest_day() + timedelta(days=1)
+        if start > end:
+            # This happens when the script is fully updated and latest_entry = end
+            print(
+                f"User Retention already up to date! "
+                f"Nothing to fetch until tomorrow {end + timedelta(days=1)}"
+            )
+        else:
+            print(f"Fetching Retention from {start} to {end} (yesterday)")
+            store_missing_retention(
+                dune,
+                store,
+                date_range(start, end),
+                max_workers=max_workers,
+                local=local,
+                chunk_days=chunk_days,
+            )
+
+        update_retention_view(
+            dune,
+            query_filepath=f"{QUERY_DIR}/retention-complete.sql",
+            values=store.values(lambda counts: str(Retention(*counts))),
+            envs=envs,
+            force=force,
+        )
+    finally:
+        store.close()
 
 
-if __name__ == "__main__":
+def retention_args() -> argparse.Namespace:
+    """Arguments used to pass table environment name and backfill concurrency"""
+    parser = update_parser()
+    parser.add_argument(
+        "--max-workers",
+        type=int,
+        default=int(os.environ.get("RETENTION_MAX_WORKERS", 4)),
+        help="Maximum number of daily retention queries executed concurrently",
+    )
+    parser.add_argument(
+        "--local",
+        action="store_true",
+        default=os.environ.get("RETENTION_LOCAL", "") == "1",
+        help="Compute all missing days locally from a single activity export",
+    )
+    parser.add_argument(
+        "--chunk-days",
+        type=int,
+        default=int(os.environ.get("RETENTION_CHUNK_DAYS", 30)),
+        help="Number of days fetched per retention query (1 queries day by day)",
+    )
+    return parser.parse_args()
+
+
+@instrumented("retention")
+def update_retention(  # pylint: disable=too-many-arguments
+    dune: DuneAPI,
+    env: Environment | list[Environment],
+    max_workers: int = 1,
+    local: bool = False,
+    chunk_days: int = 1,
+    force: bool = False,
+) -> None:
+    """
+    Fetches all missing retention data until yesterday and updates the view
+    of one or several environments (if changed, or `force` is set).
+    """
     fetch_retention_till(
-        dune=DUNE_CONNECTION,
+        dune=dune,
         # use one day before today since today's values aren't yet finalized.
         end=datetime.today().date() - timedelta(days=1),
-        retention_file_path="/".join([DUNE_DATA_DIR, "retention.csv"]),
-        env=update_args().environment,
+        store_path=os.path.join(DUNE_DATA_DIR, "retention.sqlite"),
+        envs=env if isinstance(env, list) else [env],
+        max_workers=max_workers,
+        local=local,
+        chunk_days=chunk_days,
+        force=force,
+    )
+
+
+if __name__ == "__main__":
+    args = retention_args()
+    update_retention(
+        dune_connection(),
+        selected_environments(args),
+        args.max_workers,
+        args.local,
+        args.chunk_days,
+        args.force,
     )
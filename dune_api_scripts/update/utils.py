@@ -1,11 +1,23 @@
 """
 A few project level Enums
 """
+from __future__ import annotations
+
 import argparse
+import hashlib
+import json
+import os
+import time
+from dataclasses import dataclass, field, replace
 from enum import Enum
+from typing import TYPE_CHECKING, Callable, Optional
+
+from dune_api_scripts.instrumentation import stage
+from dune_api_scripts.utils import load_json_or_default, write_json_atomically
 
-from duneapi.api import DuneAPI
-from duneapi.types import QueryParameter, DuneQuery
+if TYPE_CHECKING:
+    from duneapi.api import DuneAPI
+    from duneapi.types import QueryParameter, DuneQuery
 
 
 class Environment(Enum):
@@ -20,24 +32,260 @@ class Environment(Enum):
 
     def as_query_param(self) -> QueryParameter:
         """Converts Environment to Dune Query Parameter"""
+        # pylint: disable=import-outside-toplevel
+        from duneapi.types import QueryParameter
+
         return QueryParameter.enum_type(
             "Environment", str(self), [str(e) for e in Environment]
         )
 
 
-def refresh(dune: DuneAPI, query: DuneQuery) -> None:
-    """Updates and executes `query`"""
-    dune.initiate_query(query)
-    job_id = dune.execute_query(query)
-    # TODO - This blocking call waits for execution to finish (could be removed)
-    dune.get_results(query, job_id)
-    print(
-        f"{query.name} successfully updated: https://dune.xyz/queries/{query.query_id}"
+@dataclass
+class ViewUpdate:
+    """
+    A query updating a view, to be executed once all updates
+    it `depends_on` (referenced by name) succeeded.
+    """
+
+    name: str
+    query: DuneQuery
+    depends_on: list[str] = field(default_factory=list)
+    # Invoked once the update has been executed successfully.
+    on_success: Optional[Callable[[], None]] = None
+
+
+@dataclass
+class RefreshReport:
+    """Outcome of a set of view updates"""
+
+    succeeded: list[str] = field(default_factory=list)
+    failed: dict[str, str] = field(default_factory=dict)
+    # Updates not executed since they were published unchanged before.
+    skipped: list[str] = field(default_factory=list)
+
+    def raise_for_failures(self) -> None:
+        """Raises a RuntimeError if any update failed"""
+        if self.failed:
+            raise RuntimeError(f"Failed view updates: {self.failed}")
+
+
+def view_fingerprint(update: ViewUpdate) -> str:
+    """Digest of everything an update publishes: its query id, SQL and parameters"""
+    query = update.query
+    payload = json.dumps(
+        [
+            query.query_id,
+            query.raw_sql,
+            [[parameter.key, str(parameter.value)] for parameter in query.parameters],
+        ]
     )
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
 
 
-def update_args() -> argparse.Namespace:
-    """Arguments used to pass table environment name"""
+class PublishedViews:
+    """
+    Fingerprints of the last successful update of each view of an environment
+    (by query id and update name), persisted in `view_fingerprints/{env}.json`.
+    """
+
+    def __init__(self, data_folder: str, env: Environment):
+        self.data_folder = data_folder
+        self.path = os.path.join(data_folder, "view_fingerprints", f"{env}.json")
+        self.fingerprints: dict[str, str] = load_json_or_default(self.path, {})
+
+    @staticmethod
+    def key(update: ViewUpdate) -> str:
+        """Key of the fingerprint of `update`"""
+        return f"{update.query.query_id}/{update.name}"
+
+    def unchanged(self, update: ViewUpdate) -> bool:
+        """Whether `update` was published before with the same fingerprint"""
+        return self.fingerprints.get(self.key(update)) == view_fingerprint(update)
+
+    def tracked(self, update: ViewUpdate, skipped: list[str]) -> ViewUpdate:
+        """
+        `update` recording its fingerprint once it succeeded,
+        no longer depending on `skipped` updates.
+        """
+        fingerprint = view_fingerprint(update)
+
+        def on_success() -> None:
+            if update.on_success is not None:
+                update.on_success()
+            self.fingerprints[self.key(update)] = fingerprint
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            write_json_atomically(self.data_folder, self.path, self.fingerprints)
+
+        return replace(
+            update,
+            depends_on=[dep for dep in update.depends_on if dep not in skipped],
+            on_success=on_success,
+        )
+
+
+def execution_finished(dune: DuneAPI, query: DuneQuery, job_id: str) -> bool:
+    """
+    Checks (without waiting) whether execution `job_id` of `query` has finished.
+    Raises a RuntimeError if the execution failed.
+    """
+    response = dune.post_dune_request(query.get_execution(job_id), is_get=True)
+    status = response.json()["data"]["get_execution"]
+    if status["execution_failed"] is not None:
+        raise RuntimeError(f"execution failed with {status['execution_failed']}")
+    return status["execution_succeeded"] is not None
+
+
+def update_errors() -> tuple[type[Exception], ...]:
+    """
+    Errors failing a single update: failed executions, request errors
+    and malformed responses.
+    """
+    # pylint: disable=import-outside-toplevel
+    from requests import RequestException
+
+    return (RuntimeError, KeyError, ValueError, RequestException)
+
+
+def refresh_all(  # pylint: disable=too-many-branches
+    dune: DuneAPI,
+    updates: list[ViewUpdate],
+    initial_backoff: float = 1.0,
+    max_backoff: float = 30.0,
+) -> RefreshReport:
+    """
+    Executes all `updates`, each as soon as its dependencies succeeded,
+    polling all outstanding executions in a single loop with exponential backoff.
+    Updates of the same query are executed one after another, since each one
+    replaces the query's SQL, unless their SQL is the same (e.g. updates of several
+    environments only differing in parameters). Updates depending on failed ones
+    are not executed. Errors of a single update (see `update_errors`) fail
+    that update only.
+    """
+    pending = {update.name: update for update in updates}
+    running: dict[str, tuple[ViewUpdate, str]] = {}
+    report = RefreshReport()
+    backoff = initial_backoff
+    while pending or running:
+        busy_queries = {
+            update.query.query_id: update.query.raw_sql
+            for update, _ in running.values()
+        }
+        for name, update in list(pending.items()):
+            if any(dep in report.failed for dep in update.depends_on):
+                report.failed[name] = "a dependency failed"
+                del pending[name]
+            elif all(dep in report.succeeded for dep in update.depends_on) and (
+                busy_queries.get(update.query.query_id, update.query.raw_sql)
+                == update.query.raw_sql
+            ):
+                del pending[name]
+                try:
+                    with stage("initiate_query"):
+                        dune.initiate_query(update.query)
+                    with stage("execute"):
+                        job_id = dune.execute(
+                            update.query.query_id, update.query.parameters
+                        )
+                except update_errors() as err:
+                    report.failed[name] = repr(err)
+                    continue
+                running[name] = (update, job_id)
+                busy_queries[update.query.query_id] = update.query.raw_sql
+        if not running:
+            # Nothing could be started: dependencies are unknown or cyclic.
+            for name, update in pending.items():
+                report.failed[name] = (
+                    "a dependency failed"
+                    if any(dep in report.failed for dep in update.depends_on)
+                    else "unsatisfiable dependencies"
+                )
+            break
+
+        time.sleep(backoff)
+        progressed = False
+        for name, (update, job_id) in list(running.items()):
+            try:
+                with stage("poll"):
+                    if not execution_finished(dune, update.query, job_id):
+                        continue
+            except update_errors() as err:
+                report.failed[name] = repr(err)
+            else:
+                report.succeeded.append(name)
+                if update.on_success is not None:
+                    update.on_success()
+                print(
+                    f"{update.query.name} successfully updated: "
+                    f"https://dune.xyz/queries/{update.query.query_id}"
+                )
+            del running[name]
+            progressed = True
+        backoff = initial_backoff if progressed else min(2 * backoff, max_backoff)
+    return report
+
+
+def refresh(dune: DuneAPI, query: DuneQuery) -> None:
+    """Updates and executes `query`, waiting for the execution to finish"""
+    refresh_all(dune, [ViewUpdate(name=query.name, query=query)]).raise_for_failures()
+
+
+def refresh_environments(
+    dune: DuneAPI,
+    updates: dict[Environment, list[ViewUpdate]],
+    initial_backoff: float = 1.0,
+    force: bool = False,
+) -> dict[Environment, RefreshReport]:
+    """
+    Executes the updates of all environments concurrently on the same connection,
+    reporting the outcome of each environment separately.
+    Updates already published with the same SQL and parameters are skipped,
+    unless `force` is set. Names of updates must be unique across environments.
+    """
+    data_folder = os.environ.get("DUNE_DATA_FOLDER", "./data/dune_data")
+    skipped: dict[Environment, list[str]] = {}
+    to_run: list[ViewUpdate] = []
+    for env, env_updates in updates.items():
+        published = PublishedViews(data_folder, env)
+        skipped[env] = [
+            update.name
+            for update in env_updates
+            if not force and published.unchanged(update)
+        ]
+        to_run.extend(
+            published.tracked(update, skipped[env])
+            for update in env_updates
+            if update.name not in skipped[env]
+        )
+    combined = refresh_all(dune, to_run, initial_backoff)
+    reports = {}
+    for env, env_updates in updates.items():
+        names = {update.name for update in env_updates}
+        reports[env] = RefreshReport(
+            succeeded=[name for name in combined.succeeded if name in names],
+            failed={
+                name: err for name, err in combined.failed.items() if name in names
+            },
+            skipped=skipped[env],
+        )
+        print(
+            f"Environment {env}: {len(reports[env].succeeded)} updates succeeded, "
+            f"{len(reports[env].failed)} failed, "
+            f"{len(reports[env].skipped)} skipped (unchanged)"
+        )
+    return reports
+
+
+def raise_for_failed_environments(reports: dict[Environment, RefreshReport]) -> None:
+    """Raises a RuntimeError if any update of any environment failed"""
+    failed = {
+        str(env): report.failed for env, report in reports.items() if report.failed
+    }
+    if failed:
+        raise RuntimeError(f"Failed view updates by environment: {failed}")
+
+
+def update_parser() -> argparse.ArgumentParser:
+    """Argument parser used to pass table environment name"""
     # TODO - it would be a lot easier to pass Environment and an ENV var.
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -47,4 +295,26 @@ def update_args() -> argparse.Namespace:
         choices=list(Environment),
         default=Environment.TEST,
     )
-    return parser.parse_args()
+    parser.add_argument(
+        "--environments",
+        type=Environment,
+        choices=list(Environment),
+        nargs="+",
+        help="Update all of these environments at once (instead of --environment)",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Refresh all views, even those unchanged since their last refresh",
+    )
+    return parser
+
+
+def selected_environments(args: argparse.Namespace) -> list[Environment]:
+    """Environments selected by the arguments of `update_parser`"""
+    return list(args.environments or [args.environment])
+
+
+def update_args() -> argparse.Namespace:
+    """Arguments used to pass table environment name"""
+    return update_parser().parse_args()
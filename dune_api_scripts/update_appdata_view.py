@@ -1,34 +1,166 @@
 """Modifies and executed dune query for today's data"""
+from __future__ import annotations
+
+import os
 from os import getenv
 import sys
 import logging
+from typing import TYPE_CHECKING, Any, Optional
 
-from duneapi.api import DuneAPI
-from duneapi.types import DuneQuery, Network
 from duneapi.util import open_query
 
-from dune_api_scripts.update.utils import Environment, refresh, update_args
-from dune_api_scripts.utils import app_data_entries
+from dune_api_scripts.instrumentation import instrumented, stage
+from dune_api_scripts.local_env import dune_connection
+from dune_api_scripts.update.utils import (
+    Environment,
+    ViewUpdate,
+    raise_for_failed_environments,
+    refresh_environments,
+    selected_environments,
+    update_args,
+)
+from dune_api_scripts.utils import (
+    app_data_entry,
+    load_app_data_content_map,
+    load_json_or_default,
+    write_json_atomically,
+)
+
+if TYPE_CHECKING:
+    from duneapi.api import DuneAPI
+    from duneapi.types import DuneQuery
+
+# Number of app data hashes per page of the raw app data view.
+PARTITION_SIZE = int(getenv("RAW_APP_DATA_PARTITION_SIZE", "1000"))
+
+
+def raw_app_data_partitions(
+    content_map: dict[str, Any], data_folder: str, partition_size: int
+) -> list[list[str]]:
+    """
+    Splits all app data hashes into partitions of (at most) `partition_size` hashes.
+    Hashes keep their position across runs (new ones are appended to the end),
+    so that only the last partition changes as new app data comes in.
+    """
+    state_file = os.path.join(data_folder, "raw_app_data_partitions.json")
+    state = load_json_or_default(state_file, {})
+    if state.get("partition_size") != partition_size:
+        state = {"partition_size": partition_size, "hashes": []}
+    # Hashes that disappeared leave a hole, instead of shifting all following hashes.
+    hashes: list[Optional[str]] = [
+        app_hash if app_hash in content_map else None for app_hash in state["hashes"]
+    ]
+    hashes.extend(sorted(content_map.keys() - set(state["hashes"])))
+    os.makedirs(data_folder, exist_ok=True)
+    write_json_atomically(
+        data_folder, state_file, {"partition_size": partition_size, "hashes": hashes}
+    )
+    return [
+        [app_hash for app_hash in hashes[i : i + partition_size] if app_hash]
+        for i in range(0, len(hashes), partition_size)
+    ]
+
+
+def raw_app_data_page_query(page: int, env: Environment, values: str) -> DuneQuery:
+    """
+    Query (re)creating the `page`-th page of the RAW App Data View.
+    `QUERY_ID_RAW_APP_DATA` may list several (comma separated) query ids,
+    which are assigned to pages round-robin, so that pages can be updated concurrently.
+    """
+    # pylint: disable=import-outside-toplevel
+    from duneapi.types import DuneQuery, Network
+
+    query_ids = getenv("QUERY_ID_RAW_APP_DATA", "1032460").split(",")
+    return DuneQuery(
+        name=f"Raw App Data Mapping (Page {page})",
+        description="",
+        raw_sql=open_query("./dune_api_scripts/queries/raw_app_data.sql")
+        .replace("{{Page}}", str(page))
+        .replace("{{VALUES}}", values),
+        network=Network.MAINNET,
+        parameters=[env.as_query_param()],
+        query_id=int(query_ids[page % len(query_ids)]),
+    )
+
+
+def rendered_raw_app_data_pages() -> dict[int, str]:
+    """
+    VALUES of all (non-empty) pages of the RAW App Data View.
+    They don't depend on the environment, so they are rendered once for all of them.
+    """
+    data_folder = getenv("DUNE_DATA_FOLDER", "./data/dune_data")
+    content_map = load_app_data_content_map()
+    partitions = raw_app_data_partitions(content_map, data_folder, PARTITION_SIZE)
+    return {
+        page: ",".join(
+            app_data_entry(app_hash, content_map[app_hash]) for app_hash in app_hashes
+        )
+        for page, app_hashes in enumerate(partitions)
+        if app_hashes
+    }
+
+
+def raw_app_data_updates(
+    env: Environment, rendered_pages: Optional[dict[int, str]] = None
+) -> tuple[list[ViewUpdate], list[int]]:
+    """
+    Returns the updates of all pages of the RAW App Data View,
+    along with all pages making up the entire view.
+    Pages whose content is unchanged are skipped by `refresh_environments`.
+    """
+    if rendered_pages is None:
+        rendered_pages = rendered_raw_app_data_pages()
+    updates = [
+        ViewUpdate(
+            name=f"raw_app_data_{env}_page_{page}",
+            query=raw_app_data_page_query(page, env, values),
+        )
+        for page, values in rendered_pages.items()
+    ]
+    pages = list(rendered_pages)
+    print(f"Raw app data consists of {len(pages)} pages")
+    return updates, pages
 
 
-def update_raw_app_data(dune: DuneAPI, env: Environment) -> None:
-    """Updates the RAW App Data View"""
-    values = app_data_entries()
+def raw_app_data_union_update(
+    env: Environment, pages: list[int], depends_on: list[str]
+) -> ViewUpdate:
+    """
+    Update of the RAW App Data View combining all given `pages`, published under the
+    name of the view before it was split into pages (e.g. for other consumers).
+    Its query id defaults to the first one of `QUERY_ID_RAW_APP_DATA`, as it is only
+    executed once all pages are updated.
+    """
+    # pylint: disable=import-outside-toplevel
+    from duneapi.types import DuneQuery, Network
+
+    raw_app_data_pages = "\n    union all\n    ".join(
+        "select * from dune_user_generated.cow_protocol_raw_app_data_{{Environment}}"
+        f"_page_{page}"
+        for page in pages
+    )
+    query_id = getenv(
+        "QUERY_ID_RAW_APP_DATA_UNION",
+        getenv("QUERY_ID_RAW_APP_DATA", "1032460").split(",")[0],
+    )
     query = DuneQuery(
         name="Raw App Data Mapping",
         description="",
-        raw_sql=open_query("./dune_api_scripts/queries/raw_app_data.sql").replace(
-            "{{VALUES}}", values
+        raw_sql=open_query("./dune_api_scripts/queries/raw_app_data_union.sql").replace(
+            "{{RawAppDataPages}}", raw_app_data_pages
         ),
         network=Network.MAINNET,
         parameters=[env.as_query_param()],
-        query_id=int(getenv("QUERY_ID_RAW_APP_DATA", "1032460")),
+        query_id=int(query_id),
     )
-    refresh(dune, query)
+    return ViewUpdate(name=f"raw_app_data_{env}", query=query, depends_on=depends_on)
 
 
-def update_parsed_app_data(dune: DuneAPI, env: Environment) -> None:
-    """Updates the Parsed App Data View"""
+def parsed_app_data_update(env: Environment, depends_on: list[str]) -> ViewUpdate:
+    """Update of the Parsed App Data View, built on top of the RAW App Data View"""
+    # pylint: disable=import-outside-toplevel
+    from duneapi.types import DuneQuery, Network
+
     query = DuneQuery(
         name="Parsed App Data",
         description="",
@@ -37,15 +169,50 @@ def update_parsed_app_data(dune: DuneAPI, env: Environment) -> None:
         parameters=[env.as_query_param()],
         query_id=int(getenv("QUERY_ID_PARSED_APP_DATA", "1032466")),
     )
-    refresh(dune, query)
+    return ViewUpdate(name=f"parsed_app_data_{env}", query=query, depends_on=depends_on)
+
+
+def app_data_view_updates(
+    env: Environment, rendered_pages: Optional[dict[int, str]] = None
+) -> list[ViewUpdate]:
+    """
+    Updates of all changed raw app data pages, followed by the raw app data view
+    combining them and the parsed app data built on top of it.
+    """
+    with stage("build_sql") as measurement:
+        raw_updates, pages = raw_app_data_updates(env, rendered_pages)
+        union = raw_app_data_union_update(
+            env, pages, [update.name for update in raw_updates]
+        )
+        updates = raw_updates + [union, parsed_app_data_update(env, [union.name])]
+        measurement.bytes = sum(len(update.query.raw_sql) for update in updates)
+    return updates
+
+
+@instrumented("app_data_views")
+def update_app_data_views(
+    dune: DuneAPI, environment: Environment | list[Environment], force: bool = False
+) -> None:
+    """
+    Update raw and parsed app data of one or several environments.
+    The payload is rendered once and all environments are updated concurrently.
+    Views unchanged since their last refresh are skipped, unless `force` is set.
+    """
+    environments = environment if isinstance(environment, list) else [environment]
+    with stage("build_sql"):
+        rendered_pages = rendered_raw_app_data_pages()
+    reports = refresh_environments(
+        dune,
+        {env: app_data_view_updates(env, rendered_pages) for env in environments},
+        force=force,
+    )
+    raise_for_failed_environments(reports)
 
 
-def main(environment: Environment) -> int:
+def main(environments: list[Environment], force: bool = False) -> int:
     """Update raw and parsed app data"""
-    dune_connection = DuneAPI.new_from_environment()
     try:
-        update_raw_app_data(dune_connection, environment)
-        update_parsed_app_data(dune_connection, environment)
+        update_app_data_views(dune_connection(), environments, force)
         return 0
     except (RuntimeError, AssertionError):
         logging.exception("Failed update run due to an error!")
@@ -54,4 +221,4 @@ def main(environment: Environment) -> int:
 
 if __name__ == "__main__":
     args = update_args()
-    sys.exit(main(environment=args.environment))
+    sys.exit(main(environments=selected_environments(args), force=args.force))
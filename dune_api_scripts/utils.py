@@ -2,60 +2,267 @@
 A collection of utility methods for date manipulation, environment constructors,
 parsing, reading and writing files.
 """
+import functools
+import gzip
+import hashlib
 import json
 import os
 import sys
 import time
+import uuid
 
+from collections.abc import Iterable, Iterator, Mapping
 from datetime import date, timedelta
 
 from pathlib import Path
-from typing import Any
+from typing import Any, Optional, TextIO, TypeVar
 
+from dune_api_scripts.binary_snapshot import export_snapshot
+from dune_api_scripts.instrumentation import stage
 
-def store_as_json_file(data_set: dict[str, object]) -> None:
+Record = TypeVar("Record")
+
+
+def store_as_json_file(
+    records: Iterable[Any], time_of_download: int, day: Optional[int] = None
+) -> None:
     """
-    Writes data set to json file.
+    Writes user data records of `day` (a day timestamp, defaulting to the current day)
+    to json file. The file is replaced atomically, so that readers never observe
+    partial files. Changed (owner, day) keys are listed in a sidecar file in
+    `user_data_state/`, which is left untouched when no row changed.
     """
-    file_path = Path(os.environ["DUNE_DATA_FOLDER"] + "/user_data/")
+    data_folder = os.environ["DUNE_DATA_FOLDER"]
+    file_path = Path(data_folder + "/user_data/")
+    state_path = Path(data_folder + "/user_data_state/")
     os.makedirs(file_path, exist_ok=True)
-    downloaded_data_timestamp = int(time.time())
-    download_day_timestamp = (downloaded_data_timestamp // (24 * 60 * 60)) * (
-        24 * 60 * 60
+    os.makedirs(state_path, exist_ok=True)
+    if day is None:
+        day = (int(time.time()) // (24 * 60 * 60)) * (24 * 60 * 60)
+    file_name = f"user_data_from{day}"
+    target = os.path.join(file_path, f"{file_name}.json")
+    digests_file = os.path.join(state_path, f"{file_name}.digests.json")
+
+    tmp_file = temporary_path(data_folder, f"{file_name}.json")
+    row_digests = write_user_data(tmp_file, records, time_of_download)
+
+    previous_digests = load_json_or_default(digests_file, {})
+    # Unchanged rows are still published, as the service reports the latest
+    # `time_of_download` of all files as the time its data was last updated.
+    os.replace(tmp_file, target)
+    export_snapshot(data_folder, target)
+    if previous_digests == row_digests:
+        print(f"No changes to the rows of {target}, only updated its download time")
+        return
+    print("Written updates to: " + target)
+
+    changes = {
+        "time_of_download": time_of_download,
+        "changed": sorted(
+            key
+            for key, digest in row_digests.items()
+            if previous_digests.get(key) != digest
+        ),
+        "removed": sorted(set(previous_digests) - set(row_digests)),
+    }
+    write_json_atomically(
+        data_folder, os.path.join(state_path, f"{file_name}.changes.json"), changes
     )
-    file_name = Path(f"user_data_from{download_day_timestamp}.json")
-    with open(os.path.join(file_path, file_name), "w+", encoding="utf-8") as file:
-        json.dump(data_set, file, ensure_ascii=False, indent=4)
-    print("Written updates to: " + os.path.join(file_path, file_name))
+    write_json_atomically(data_folder, digests_file, row_digests)
+
+
+def write_user_data(
+    path: Path, records: Iterable[Any], time_of_download: int
+) -> dict[str, str]:
+    """Writes user data records to `path`, returning the content digest of each row"""
+    row_digests: dict[str, str] = {}
+    with stage("write_user_data") as measurement, open_for_writing(path) as file:
+        measurement.rows = write_json_stream(
+            file,
+            "user_data",
+            track_row_digests(records, row_digests),
+            {"time_of_download": time_of_download},
+        )
+        measurement.bytes = file.tell()
+    return row_digests
+
+
+def row_key(record: Mapping[str, Any]) -> str:
+    """Key identifying a user data record: `{owner}/{day}`"""
+    return f"{record['owner']}/{record['day']}"
+
+
+def track_row_digests(
+    records: Iterable[Mapping[str, Any]], digests: dict[str, str]
+) -> Iterator[Mapping[str, Any]]:
+    """Passes through `records`, storing the content digest of each row in `digests`"""
+    for record in records:
+        content = json.dumps(record, sort_keys=True, ensure_ascii=False)
+        digests[row_key(record)] = hashlib.sha1(content.encode("utf-8")).hexdigest()
+        yield record
+
+
+def temporary_path(data_folder: str, file_name: str) -> Path:
+    """
+    Returns a unique path to write `file_name` to before moving it in place.
+    It lives in its own folder of `data_folder`, so that it is on the same file system
+    as the final file but not in any of the folders scanned by the service.
+    """
+    tmp_folder = Path(data_folder + "/tmp/")
+    os.makedirs(tmp_folder, exist_ok=True)
+    return tmp_folder / f"{file_name}.{os.getpid()}.{uuid.uuid4().hex}"
+
+
+def write_json_atomically(data_folder: str, path: str | Path, content: Any) -> None:
+    """Writes `content` as json to `path`, replacing any existing file atomically"""
+    tmp_file = temporary_path(data_folder, Path(path).name)
+    with open(tmp_file, "w", encoding="utf-8") as file:
+        json.dump(content, file, ensure_ascii=False)
+    os.replace(tmp_file, path)
+
+
+def load_json_or_default(path: str | Path, default: Any) -> Any:
+    """Loads json file at `path`, returning `default` if it doesn't exist"""
+    try:
+        with open(path, encoding="utf-8") as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return default
+
+
+def open_for_writing(path: str | Path, compress: bool = False) -> TextIO:
+    """Opens text file for writing, gzip compressed if `compress` is set"""
+    if compress:
+        return gzip.open(path, "wt", encoding="utf-8")
+    return open(path, "w", encoding="utf-8")
+
+
+def open_for_reading(path: str | Path) -> TextIO:
+    """Opens text file for reading, decompressing files ending on `.gz`"""
+    if str(path).endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8")
+    return open(path, "r", encoding="utf-8")
+
+
+def write_json_stream(
+    file: TextIO, key: str, records: Iterable[Any], fields: Mapping[str, Any]
+) -> int:
+    """
+    Writes the json object `{key: [*records], **fields}` record by record,
+    so that memory does not grow with the number of records.
+    `fields` are only serialized after all records were consumed
+    (and hence may still be filled in while consuming them).
+    Returns the number of records written.
+    """
+    file.write("{" + json.dumps(key) + ": [")
+    count = 0
+    for record in records:
+        file.write(",\n" if count else "\n")
+        file.write(json.dumps(record, ensure_ascii=False))
+        count += 1
+    file.write("\n]")
+    for name, value in fields.items():
+        file.write(f", {json.dumps(name)}: {json.dumps(value, ensure_ascii=False)}")
+    file.write("}\n")
+    return count
+
+
+def consume(records: list[Record]) -> Iterator[Record]:
+    """
+    Yields (in order) and removes the records of an already materialized result,
+    so that each record can be freed as soon as it was processed.
+    Note that this empties `records`.
+    """
+    records.reverse()
+    while records:
+        yield records.pop()
 
 
 def build_string_for_affiliate_referrals_pairs() -> str:
     """Constructs a string of affiliate-referral pairs."""
-    content_dict = load_app_data_content_map()
     # Building value pairs "(appDataHash, referral),"
-    pair_list = []
-    for app_id, content in content_dict.items():
-        # TODO - I feel like this is a bit shady
-        referral = content["metadata"]["referrer"]
-        if referral:
-            pair_list.append(f"('{app_id}','{dune_address(referral['address'])}')")
-
-    return ",".join(pair_list)
+    return ",".join(
+        f"('{app_id}','{referrer}')"
+        for app_id, referrer in referrer_index().items()
+        if referrer is not None
+    )
 
 
-def load_app_data_content_map() -> Any:
-    """Loads and returns App Data file from persistent storage"""
+def app_data_referral_file() -> Path:
+    """Returns path of the App Data file, or exits if it doesn't exist yet"""
     file_path = Path(os.environ["APP_DATA_REFERRAL_RELATION_FILE"])
     if not file_path.is_file():
         # Must wait for the app_data-referrals relationships to be created,
         # in order to construct the query correctly.
         print("APP_DATA_REFERRAL_RELATION_FILE not yet created by service")
         sys.exit()
+    return file_path
+
 
-    with open(file_path, encoding="utf-8") as json_file:
+def load_app_data_content_map() -> Any:
+    """
+    Loads and returns App Data file from persistent storage.
+    The file is parsed at most once per process for each version of it,
+    so the returned map is shared and must not be modified.
+    """
+    file_path = app_data_referral_file()
+    stat = file_path.stat()
+    return _parse_app_data_file(str(file_path), stat.st_mtime_ns, stat.st_size)
+
+
+@functools.lru_cache(maxsize=1)
+def _parse_app_data_file(path: str, mtime_ns: int, size: int) -> Any:
+    # Modification time and size are only part of the cache key.
+    del mtime_ns, size
+    with open(path, encoding="utf-8") as json_file:
         return json.load(json_file)
 
 
+def referrer_of(content: Any) -> Optional[str]:
+    """Returns the referrer (as dune address) of App Data `content`, if any"""
+    referrer = (content.get("metadata") or {}).get("referrer")
+    if not referrer:
+        return None
+    return dune_address(referrer["address"])
+
+
+def referrer_index() -> dict[str, Optional[str]]:
+    """
+    Returns the referrer (as dune address) of every hash in the App Data file.
+    The index is persisted in the dune data folder and invalidated by modification
+    time and size of the App Data file, in which case only new hashes are scanned.
+    The returned index is shared within the process and must not be modified.
+    """
+    file_path = app_data_referral_file()
+    stat = file_path.stat()
+    return _referrer_index(str(file_path), stat.st_mtime_ns, stat.st_size)
+
+
+@functools.lru_cache(maxsize=1)
+def _referrer_index(path: str, mtime_ns: int, size: int) -> dict[str, Optional[str]]:
+    data_folder = os.environ.get("DUNE_DATA_FOLDER", "./data/dune_data")
+    index_file = os.path.join(data_folder, "app_data_referral_index.json")
+    version = [path, mtime_ns, size]
+    index = load_json_or_default(index_file, {"version": None, "referrers": {}})
+    referrers: dict[str, Optional[str]] = index["referrers"]
+    if index["version"] == version:
+        return referrers
+
+    with stage("load_app_data"):
+        content_map = load_app_data_content_map()
+    for app_hash in referrers.keys() - content_map.keys():
+        del referrers[app_hash]
+    new_hashes = content_map.keys() - referrers.keys()
+    for app_hash in new_hashes:
+        referrers[app_hash] = referrer_of(content_map[app_hash])
+    print(f"Indexed {len(new_hashes)} new app data hashes")
+    os.makedirs(data_folder, exist_ok=True)
+    write_json_atomically(
+        data_folder, index_file, {"version": version, "referrers": referrers}
+    )
+    return referrers
+
+
 def dune_address(hex_address: str) -> str:
     """
     transforms hex address (beginning with 0x) to dune compatible
@@ -67,12 +274,15 @@ def dune_address(hex_address: str) -> str:
 def app_data_entries() -> str:
     """Constructs a string of app data hash => content pairs."""
     content_dict = load_app_data_content_map()
-    pair_list = [
-        f"('{appId}','{json.dumps(data)}')" for appId, data in content_dict.items()
-    ]
+    pair_list = [app_data_entry(appId, data) for appId, data in content_dict.items()]
     return ",".join(pair_list)
 
 
+def app_data_entry(app_id: str, content: Any) -> str:
+    """Constructs a single app data hash => content pair."""
+    return f"('{app_id}','{json.dumps(content)}')"
+
+
 def open_downloaded_history_file() -> Path:
     """Opens and returns the entire user data history file."""
     entire_history_path = Path(os.environ["DUNE_DATA_FOLDER"] + "/user_data")
@@ -107,3 +317,21 @@ def date_range(start: date, end: date) -> list[date]:
         results.append(curr_date)
         curr_date += timedelta(days=1)
     return results
+
+
+def month_windows(start: date, end: date, months: int = 1) -> list[tuple[date, date]]:
+    """
+    Splits the half open range [start, end) into consecutive windows,
+    each ending on the first of the month `months` calendar months later
+    (or on `end` for the last window).
+    """
+    if months < 1:
+        raise ValueError(f"Can't split date range into windows of {months} months")
+    windows = []
+    window_start = start
+    while window_start < end:
+        month_index = window_start.year * 12 + window_start.month - 1 + months
+        window_end = min(date(month_index // 12, month_index % 12 + 1, 1), end)
+        windows.append((window_start, window_end))
+        window_start = window_end
+    return windows